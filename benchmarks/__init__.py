@@ -0,0 +1,16 @@
+"""Benchmarks for monomotapa.
+Run from the top level directory (where config.json lives) e.g.
+python -m benchmarks.metadata"""
+import time
+
+
+def requests_per_second(client, path, count, before=None):
+    """GET path count times with a flask test client, return requests/sec.
+    If supplied before() is called ahead of each request (and timed)."""
+    start = time.time()
+    for _ in range(count):
+        if before:
+            before()
+        client.get(path)
+    elapsed = time.time() - start
+    return count / elapsed
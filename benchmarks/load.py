@@ -0,0 +1,228 @@
+"""Load test the event loop server against the threaded WSGI server.
+
+Generates a synthetic site (see suite.py) and serves it, in a separate
+process, first from the threaded WSGI server used by suite.py and then
+from the event loop server (see monomotapa/server.py). With --slow
+clients connected to each, every one having sent only part of its
+request and then waiting, it makes --requests requests for a page over
+--concurrency client threads. Reports throughput, p50/p99 latency and
+failed requests, plus the threads and resident memory of the server
+process while the slow clients were connected, and writes the results
+as json so runs can be compared across commits.
+
+Run from the top level directory:
+python -m benchmarks.load --slow 2000 --output load.json
+"""
+import os
+import os.path
+import sys
+import json
+import time
+import shutil
+import socket
+import urllib2
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+
+from benchmarks.suite import generate_site, git_revision, page_name
+from benchmarks.suite import summarize
+
+# run in a fresh process in the site directory, prints the port
+CHILD = '''
+import sys, resource
+soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+from monomotapa import app
+if %(mode)r == 'event':
+    from monomotapa.server import Server
+    server = Server(app, ('127.0.0.1', 0), %(workers)d,
+            timeout=%(timeout)d)
+    port = server.server_address[1]
+else:
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+    server = make_server('127.0.0.1', 0, app, threaded=True,
+            request_handler=QuietHandler)
+    server.request_queue_size = 1024
+    port = server.server_port
+print(port)
+sys.stdout.flush()
+server.serve_forever()
+'''
+
+MODES = ['wsgi', 'event']
+
+
+def start_child(directory, repository, mode, options):
+    """start serving the site in a new process, returns (process,
+    base url)"""
+    code = CHILD % {'mode' : mode, 'workers' : options.workers,
+            'timeout' : options.timeout}
+    env = dict(os.environ, PYTHONPATH=repository)
+    process = subprocess.Popen([sys.executable, '-c', code],
+            cwd=directory, env=env, stdout=subprocess.PIPE)
+    port = int(process.stdout.readline())
+    return process, 'http://127.0.0.1:%d' % port
+
+
+def process_status(pid):
+    """returns (threads, resident memory in KB) of process pid, from
+    /proc, or (None, None)"""
+    values = {}
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                values[name] = value.strip()
+    except IOError:
+        return None, None
+    return (int(values.get('Threads', '0')),
+            int(values.get('VmRSS', '0 kB').split()[0]))
+
+
+def connect_slow(base_url, count):
+    """returns list of sockets that have sent part of a request"""
+    host, port = base_url.rsplit('/', 1)[-1].split(':')
+    sockets = []
+    for _ in range(count):
+        try:
+            sock = socket.create_connection((host, int(port)), 5)
+            sock.sendall('GET / HTTP/1.1\r\nHost: %s\r\n' % host)
+        except socket.error:
+            break
+        sockets.append(sock)
+    return sockets
+
+
+def fetch(url, timeout):
+    """GET url, returns False if it failed"""
+    try:
+        urllib2.urlopen(url, timeout=timeout).read()
+    except (urllib2.URLError, socket.error):
+        return False
+    return True
+
+
+def bench(base_url, path, count, concurrency, timeout):
+    """request path count times using concurrency threads, returns
+    (timings, failures, elapsed)"""
+    url = base_url + path
+    timings = []
+    failures = [0]
+    lock = threading.Lock()
+    def worker(requests):
+        mine = []
+        failed = 0
+        for _ in range(requests):
+            before = time.time()
+            if fetch(url, timeout):
+                mine.append(time.time() - before)
+            else:
+                failed += 1
+        with lock:
+            timings.extend(mine)
+            failures[0] += failed
+    threads = [threading.Thread(target=worker, args=(count // concurrency,))
+            for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return timings, failures[0], time.time() - start
+
+
+def run(options):
+    """generate site, load test each server, return results"""
+    repository = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='monomotapa-load-')
+    path = '/' + page_name(options.pages // 2)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    results = []
+    try:
+        generate_site(directory, options.pages, options.size, options.nav)
+        for mode in MODES:
+            process, base_url = start_child(directory, repository, mode,
+                    options)
+            sockets = []
+            try:
+                fetch(base_url + path, options.request_timeout)
+                sockets = connect_slow(base_url, options.slow)
+                # give the server time to accept them
+                time.sleep(1)
+                threads, rss = process_status(process.pid)
+                timings, failures, elapsed = bench(base_url, path,
+                        options.requests, options.concurrency,
+                        options.request_timeout)
+                result = summarize(mode, path, timings or [0], elapsed)
+                result.update({'slow_clients' : len(sockets),
+                    'failures' : failures, 'server_threads' : threads,
+                    'server_rss_kb' : rss})
+                results.append(result)
+            finally:
+                for sock in sockets:
+                    sock.close()
+                process.terminate()
+                process.wait()
+    finally:
+        shutil.rmtree(directory)
+    return {'revision' : git_revision(repository),
+            'python' : sys.version.split()[0],
+            'time' : time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'options' : vars(options), 'results' : results}
+
+
+def report(results):
+    """print results as a table"""
+    print('%-6s %6s %10s %9s %9s %9s %8s %10s' % ('server', 'slow',
+        'req/s', 'p50 ms', 'p99 ms', 'failures', 'threads', 'RSS KB'))
+    for result in results['results']:
+        print('%-6s %6d %10.1f %9.2f %9.2f %9d %8s %10s' % (
+            result['driver'], result['slow_clients'],
+            result['requests_per_second'], result['p50_ms'],
+            result['p99_ms'], result['failures'], result['server_threads'],
+            result['server_rss_kb']))
+
+
+def parse_args(argv):
+    """returns options from command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--pages', type=int, default=200,
+            help='number of markdown pages')
+    parser.add_argument('--size', type=int, default=4096,
+            help='approximate size of each page in bytes')
+    parser.add_argument('--nav', type=int, default=20,
+            help='number of navigation entries')
+    parser.add_argument('--slow', type=int, default=1000,
+            help='slow clients to hold open')
+    parser.add_argument('--requests', type=int, default=2000,
+            help='requests to make')
+    parser.add_argument('--concurrency', type=int, default=16,
+            help='client threads making requests')
+    parser.add_argument('--workers', type=int, default=8,
+            help='worker threads for the event loop server')
+    parser.add_argument('--timeout', type=int, default=60,
+            help='idle timeout (seconds) for the event loop server')
+    parser.add_argument('--request-timeout', type=float, default=10,
+            help='seconds before a request counts as failed')
+    parser.add_argument('--output', default='load_output.json',
+            help='file to write json results to')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    options = parse_args(argv)
+    results = run(options)
+    report(results)
+    with open(options.output, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,28 @@
+"""Compare requests/sec on / and /<path:page> with the metadata registry
+warm against clearing it before every request (i.e. re-reading
+defaults.json, pages.json and navigation.json on each hit, as before)."""
+import sys
+
+from monomotapa import app
+from monomotapa.metadata import registry
+from benchmarks import requests_per_second
+
+PATHS = ['/', '/colophon']
+
+
+def main(count=500):
+    client = app.test_client()
+    print('%-12s %12s %12s %8s' % ('path', 'reload/s', 'registry/s', 'gain'))
+    for path in PATHS:
+        # warm up
+        client.get(path)
+        cold = requests_per_second(client, path, count, registry.clear)
+        warm = requests_per_second(client, path, count)
+        print('%-12s %12.1f %12.1f %7.2fx' % (path, cold, warm, warm / cold))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
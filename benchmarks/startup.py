@@ -0,0 +1,140 @@
+"""Benchmark cold starts: import time and first request latency.
+
+Generates a synthetic site (see suite.py) then, in a fresh python
+process each time, imports monomotapa and requests a page, /source and
+the page again, with preload off and then on. Reports (medians over
+--runs processes) the time taken to import the app, for each of the
+requests, and which of the heavier modules were loaded by the import,
+and writes the results as json so runs can be compared across commits.
+
+Run from the top level directory:
+python -m benchmarks.startup --runs 5 --output startup.json
+"""
+import os
+import os.path
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from benchmarks.suite import generate_site, git_revision, page_name
+
+# modules we would rather not import until they are needed
+HEAVY_MODULES = ['pygments', 'markdown', 'subprocess']
+
+# run in a fresh process in the site directory, prints json
+CHILD = '''
+import sys, time, json
+start = time.time()
+import monomotapa
+imported = time.time() - start
+loaded = dict((name, name in sys.modules) for name in %(modules)r)
+client = monomotapa.app.test_client()
+timings = {'import' : imported}
+for name, path in %(paths)r:
+    start = time.time()
+    client.get(path)
+    timings[name] = time.time() - start
+print(json.dumps({'timings' : timings, 'loaded' : loaded}))
+'''
+
+
+def run_child(directory, repository, page):
+    """import the app in a new process, returns its results"""
+    paths = [('first_request', '/' + page),
+            ('source', '/source?page=' + page),
+            ('second_request', '/' + page)]
+    code = CHILD % {'modules' : HEAVY_MODULES, 'paths' : paths}
+    env = dict(os.environ, PYTHONPATH=repository)
+    output = subprocess.check_output([sys.executable, '-c', code],
+            cwd=directory, env=env)
+    return json.loads(output.strip().split('\n')[-1])
+
+
+def set_preload(directory, preload):
+    """set preload in the site's config.json"""
+    path = os.path.join(directory, 'config.json')
+    with open(path, 'r') as f:
+        config = json.load(f)
+    config['preload'] = preload
+    # don't share compiled templates between runs
+    config['template_cache_dir'] = False
+    with open(path, 'w') as f:
+        json.dump(config, f)
+
+
+def median(values):
+    """returns median of values"""
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def run(options):
+    """generate site, start the app runs times in each mode,
+    return results"""
+    repository = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='monomotapa-startup-')
+    page = page_name(options.pages // 2)
+    results = []
+    try:
+        generate_site(directory, options.pages, options.size, options.nav)
+        for preload in [False, True]:
+            set_preload(directory, preload)
+            runs = [run_child(directory, repository, page)
+                    for _ in range(options.runs)]
+            timings = dict((name, median([result['timings'][name]
+                for result in runs]) * 1000)
+                for name in runs[0]['timings'])
+            results.append({'preload' : preload, 'timings_ms' : timings,
+                'loaded' : runs[0]['loaded']})
+    finally:
+        shutil.rmtree(directory)
+    return {'revision' : git_revision(repository),
+            'python' : sys.version.split()[0],
+            'time' : time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'options' : vars(options), 'results' : results}
+
+
+def report(results):
+    """print results as a table"""
+    names = ['import', 'first_request', 'source', 'second_request']
+    print('%-8s' % 'preload' + ''.join('%16s' % name for name in names))
+    for result in results['results']:
+        print('%-8s' % result['preload'] + ''.join('%13.1f ms'
+            % result['timings_ms'][name] for name in names))
+    for result in results['results']:
+        loaded = [name for name, value in sorted(result['loaded'].items())
+                if value]
+        print('loaded by import (preload %s): %s' % (result['preload'],
+            ', '.join(loaded) or 'none'))
+
+
+def parse_args(argv):
+    """returns options from command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--pages', type=int, default=200,
+            help='number of markdown pages')
+    parser.add_argument('--size', type=int, default=4096,
+            help='approximate size of each page in bytes')
+    parser.add_argument('--nav', type=int, default=20,
+            help='number of navigation entries')
+    parser.add_argument('--runs', type=int, default=5,
+            help='processes to start in each mode')
+    parser.add_argument('--output', default='startup_output.json',
+            help='file to write json results to')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    options = parse_args(argv)
+    results = run(options)
+    report(results)
+    with open(options.output, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
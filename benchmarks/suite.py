@@ -0,0 +1,252 @@
+"""Benchmark the request path against a synthetic site.
+
+Generates a site with --pages markdown pages of about --size bytes each,
+a pages.json entry for every page and --nav navigation entries, then
+requests /, a page, /source?page=<page> and a page that does not exist,
+first through the flask test client and then over http from a real
+(threaded) WSGI server. For each it reports throughput and
+p50/p99 latency, plus peak RSS, and writes the results as json so runs
+can be compared across commits.
+
+Run from the top level directory:
+python -m benchmarks.suite --pages 1000 --output bench.json
+"""
+import os
+import os.path
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import urllib2
+
+# everything the site needs other than src/ and the json
+# (views.py is displayed by /source)
+SITE_DIRS = ['templates', 'static']
+SITE_FILES = ['defaults.json', 'views.py']
+WORDS = ('monomotapa city whose inhabitants are bounded by deep feelings '
+        'of friendship so that they intuit one another secret needs').split()
+
+
+def page_name(number):
+    """returns name of synthetic page number"""
+    return 'page-%d' % number
+
+
+def markdown_page(number, size):
+    """returns markdown of about size bytes for page number"""
+    paragraphs = ['# Page %d\n' % number]
+    length = 0
+    word = number
+    while length < size:
+        sentence = ' '.join(WORDS[(word + i) % len(WORDS)]
+                for i in range(12))
+        paragraph = '%s *%s*, [link](/%s).\n' % (sentence.capitalize(),
+                WORDS[word % len(WORDS)], page_name(word % (number + 1)))
+        paragraphs.append(paragraph)
+        length += len(paragraph)
+        word += 1
+    return '\n'.join(paragraphs)
+
+
+def generate_site(directory, pages, size, nav):
+    """write a site with pages pages of size bytes and nav navigation
+    entries to directory/monomotapa, with a config.json"""
+    package = os.path.dirname(os.path.abspath(
+        sys.modules['benchmarks'].__file__))
+    source = os.path.join(os.path.dirname(package), 'monomotapa')
+    site = os.path.join(directory, 'monomotapa')
+    os.makedirs(os.path.join(site, 'src'))
+    for name in SITE_DIRS:
+        shutil.copytree(os.path.join(source, name), os.path.join(site, name))
+    for name in SITE_FILES:
+        shutil.copy(os.path.join(source, name), site)
+    entries = {}
+    for number in range(pages):
+        name = page_name(number)
+        with open(os.path.join(site, 'src', name + '.md'), 'w') as f:
+            f.write(markdown_page(number, size))
+        entries[name] = {'title' : 'page %d' % number,
+                'heading' : 'Page %d' % number,
+                'attributes' : {'summary' : 'synthetic page %d' % number}}
+    with open(os.path.join(site, 'src', 'home.md'), 'w') as f:
+        f.write(markdown_page(0, size))
+    entries['index'] = {'src' : 'home.md', 'template' : 'home.html'}
+    with open(os.path.join(site, 'pages.json'), 'w') as f:
+        json.dump(entries, f)
+    order = ['index', 'source'] + [page_name(n)
+            for n in range(min(nav, pages))]
+    navigation = {'nav_order' : order, 'nav_elements' : {
+        'index' : {'link_text' : 'home', 'urlfor' : 'index'},
+        'source' : {'link_text' : 'view the source', 'urlfor' : 'source'}}}
+    with open(os.path.join(site, 'navigation.json'), 'w') as f:
+        json.dump(navigation, f)
+    with open(os.path.join(directory, 'config.json'), 'w') as f:
+        json.dump({'debug' : False, 'enable_unit_tests' : False,
+            'default_title' : 'Benchmark:::'}, f)
+
+
+def summarize(driver, path, timings, elapsed):
+    """returns dict of results for timings (in seconds) of requests"""
+    timings = sorted(timings)
+    def percentile(fraction):
+        return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+    return {'driver' : driver, 'path' : path, 'requests' : len(timings),
+            'requests_per_second' : len(timings) / elapsed,
+            'p50_ms' : percentile(0.5) * 1000,
+            'p99_ms' : percentile(0.99) * 1000}
+
+
+def bench_client(app, path, count):
+    """request path count times with the flask test client"""
+    client = app.test_client()
+    client.get(path)
+    timings = []
+    start = time.time()
+    for _ in range(count):
+        before = time.time()
+        client.get(path)
+        timings.append(time.time() - before)
+    return summarize('test_client', path, timings, time.time() - start)
+
+
+def fetch(url):
+    """GET url, ignoring http errors (e.g. 404)"""
+    try:
+        urllib2.urlopen(url).read()
+    except urllib2.HTTPError as e:
+        e.read()
+
+
+def bench_server(base_url, path, count, concurrency):
+    """request path count times over http using concurrency threads"""
+    url = base_url + path
+    fetch(url)
+    timings = []
+    lock = threading.Lock()
+    def worker(requests):
+        mine = []
+        for _ in range(requests):
+            before = time.time()
+            fetch(url)
+            mine.append(time.time() - before)
+        with lock:
+            timings.extend(mine)
+    threads = [threading.Thread(target=worker, args=(count // concurrency,))
+            for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize('wsgi_server', path, timings, time.time() - start)
+
+
+def start_server(app):
+    """serve app from a threaded WSGI server in a background thread,
+    returns (server, base url)"""
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    class QuietHandler(WSGIRequestHandler):
+        """don't log every request"""
+        def log_request(self, *args, **kwargs):
+            pass
+    server = make_server('127.0.0.1', 0, app, threaded=True,
+            request_handler=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_port
+
+
+def peak_rss():
+    """returns peak resident set size of this process in KB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def git_revision(directory):
+    """returns current commit of directory, or None"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                cwd=directory, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(options):
+    """generate site, run benchmarks, return results"""
+    repository = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='monomotapa-bench-')
+    try:
+        generate_site(directory, options.pages, options.size, options.nav)
+        # the app finds config.json and its files relative to cwd
+        os.chdir(directory)
+        sys.path.insert(0, repository)
+        from monomotapa import app
+        page = page_name(options.pages // 2)
+        paths = ['/', '/' + page, '/source?page=' + page, '/no-such-page']
+        results = []
+        for path in paths:
+            results.append(bench_client(app, path, options.requests))
+        if options.server:
+            server, base_url = start_server(app)
+            try:
+                for path in paths:
+                    results.append(bench_server(base_url, path,
+                        options.requests, options.concurrency))
+            finally:
+                server.shutdown()
+    finally:
+        os.chdir(repository)
+        shutil.rmtree(directory)
+    return {'revision' : git_revision(repository),
+            'python' : sys.version.split()[0],
+            'time' : time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'options' : vars(options), 'peak_rss_kb' : peak_rss(),
+            'results' : results}
+
+
+def report(results):
+    """print results as a table"""
+    print('%-12s %-28s %10s %9s %9s' % ('driver', 'path', 'req/s',
+        'p50 ms', 'p99 ms'))
+    for result in results['results']:
+        print('%-12s %-28s %10.1f %9.2f %9.2f' % (result['driver'],
+            result['path'][:28], result['requests_per_second'],
+            result['p50_ms'], result['p99_ms']))
+    print('peak RSS: %d KB' % results['peak_rss_kb'])
+
+
+def parse_args(argv):
+    """returns options from command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--pages', type=int, default=200,
+            help='number of markdown pages')
+    parser.add_argument('--size', type=int, default=4096,
+            help='approximate size of each page in bytes')
+    parser.add_argument('--nav', type=int, default=20,
+            help='number of navigation entries')
+    parser.add_argument('--requests', type=int, default=500,
+            help='requests per path')
+    parser.add_argument('--concurrency', type=int, default=8,
+            help='client threads for the WSGI server')
+    parser.add_argument('--no-server', dest='server', action='store_false',
+            help='only use the flask test client')
+    parser.add_argument('--output', default='bench_output.json',
+            help='file to write json results to')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    options = parse_args(argv)
+    results = run(options)
+    report(results)
+    with open(options.output, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -37,11 +37,21 @@ You are therefore free to add templates and style sheets under your own terms th
 ough I would be happy if you chose to license them in the same way. 
 """
 from flask import Flask
+from jinja2 import FileSystemBytecodeCache
 import sys
+import os
 app = Flask(__name__)
+# app.logger is created on first use. Create it now so what the other
+# modules log (e.g. monomotapa.search, whose logger is a child of it)
+# is written out
+app.logger
 
 from monomotapa import views
 from monomotapa.config import Config, ConfigError
+from monomotapa import plugin
+from monomotapa import metrics
+from monomotapa import watcher
+from monomotapa import store
 
 # The name of the file not the path
 # It look for it in CWD, the apps main dir, /etc/monomatapa /etc in that order
@@ -63,3 +73,181 @@ try:
     app.config['default_title'] = CONFIG.config['default_title']
 except KeyError:
     app.config['default_title'] = None
+
+try:
+    app.config['markdown_cache_size'] = CONFIG.config['markdown_cache_size']
+except KeyError:
+    app.config['markdown_cache_size'] = 16 * 1024 * 1024
+views.markdown_cache.resize(app.config['markdown_cache_size'])
+
+try:
+    app.config['page_cache_size'] = CONFIG.config['page_cache_size']
+except KeyError:
+    app.config['page_cache_size'] = 32 * 1024 * 1024
+views.page_cache.resize(app.config['page_cache_size'])
+
+try:
+    app.config['pygments_cache_size'] = CONFIG.config['pygments_cache_size']
+except KeyError:
+    app.config['pygments_cache_size'] = 8 * 1024 * 1024
+views.pygments_cache.resize(app.config['pygments_cache_size'])
+
+try:
+    app.config['posts_per_page'] = CONFIG.config['posts_per_page']
+except KeyError:
+    app.config['posts_per_page'] = 10
+
+try:
+    app.config['feed_size'] = CONFIG.config['feed_size']
+except KeyError:
+    app.config['feed_size'] = 20
+
+try:
+    app.config['index_check_interval'] = CONFIG.config['index_check_interval']
+except KeyError:
+    app.config['index_check_interval'] = 2
+views.post_index.interval = app.config['index_check_interval']
+views.route_index.interval = app.config['index_check_interval']
+
+try:
+    app.config['plugin_file'] = CONFIG.config['plugin_file']
+except KeyError:
+    app.config['plugin_file'] = 'monomotapa/plugin.json'
+# load plugins enabled in plugin.json, once
+plugin.plugin_index.load(app.config['plugin_file'], 'monomotapa.plugins')
+
+try:
+    app.config['enable_metrics'] = CONFIG.config['enable_metrics']
+except KeyError:
+    app.config['enable_metrics'] = False
+# only instrument views if enabled, so there is no overhead otherwise
+if app.config['enable_metrics']:
+    metrics.metrics.install(app, views)
+
+try:
+    app.config['enable_compression'] = CONFIG.config['enable_compression']
+except KeyError:
+    app.config['enable_compression'] = True
+
+try:
+    app.config['compression_level'] = CONFIG.config['compression_level']
+except KeyError:
+    app.config['compression_level'] = 6
+views.compressor.level = app.config['compression_level']
+
+try:
+    app.config['compression_min_size'] = CONFIG.config['compression_min_size']
+except KeyError:
+    app.config['compression_min_size'] = 1024
+views.compressor.min_size = app.config['compression_min_size']
+if app.config['enable_compression']:
+    views.compressor.install(app)
+
+try:
+    app.config['search_index_file'] = CONFIG.config['search_index_file']
+except KeyError:
+    app.config['search_index_file'] = os.path.join('monomotapa', 
+            'search.idx')
+views.search_index.path = app.config['search_index_file']
+views.search_index.interval = app.config['index_check_interval']
+views.search_index.load()
+
+try:
+    app.config['search_results'] = CONFIG.config['search_results']
+except KeyError:
+    app.config['search_results'] = 20
+
+# directory for compiled templates shared by all workers. 
+# None (the default) uses a directory in /tmp, false disables the cache
+try:
+    app.config['template_cache_dir'] = CONFIG.config['template_cache_dir']
+except KeyError:
+    app.config['template_cache_dir'] = None
+if app.config['template_cache_dir'] is not False:
+    if (app.config['template_cache_dir'] 
+            and not os.path.isdir(app.config['template_cache_dir'])):
+        os.makedirs(app.config['template_cache_dir'])
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+            app.config['template_cache_dir'])
+views.precompile_templates()
+
+# index front matter in src/ 
+views.frontmatter_index.scan()
+
+# watch src/, templates/ and the json files for changes in the 
+# background, rather than checking them on every request
+try:
+    app.config['watch_files'] = CONFIG.config['watch_files']
+except KeyError:
+    app.config['watch_files'] = False
+
+# used if inotify is not available
+try:
+    app.config['watch_interval'] = CONFIG.config['watch_interval']
+except KeyError:
+    app.config['watch_interval'] = 1.0
+if app.config['watch_files']:
+    watcher.watcher.interval = app.config['watch_interval']
+    watcher.watcher.watch('monomotapa')
+    watcher.watcher.watch(os.path.join('monomotapa', 'src'), recursive=True)
+    watcher.watcher.watch(os.path.join('monomotapa', 'templates'), 
+            recursive=True)
+    watcher.watcher.subscribe(views.invalidate)
+    watcher.watcher.start()
+    views.frontmatter_index.watched = True
+    # start a watcher in each worker, if forked after this
+    app.before_request(watcher.watcher.start)
+
+# share rendered markdown and pages between workers, see store.py
+try:
+    app.config['cache_backend'] = CONFIG.config['cache_backend']
+except KeyError:
+    app.config['cache_backend'] = 'memory'
+
+try:
+    app.config['cache_path'] = CONFIG.config['cache_path']
+except KeyError:
+    app.config['cache_path'] = None
+
+try:
+    app.config['cache_address'] = CONFIG.config['cache_address']
+except KeyError:
+    app.config['cache_address'] = '127.0.0.1:11211'
+
+try:
+    app.config['cache_store_size'] = CONFIG.config['cache_store_size']
+except KeyError:
+    app.config['cache_store_size'] = 256 * 1024 * 1024
+shared_store = store.make_store(app.config['cache_backend'],
+        app.config['cache_path'], app.config['cache_address'],
+        app.config['cache_store_size'])
+if shared_store is not None:
+    # output of different code or config is kept apart
+    version = store.code_version(CONFIG.config)
+    views.markdown_cache.share(shared_store, 'markdown-%s' % version)
+    views.page_cache.share(shared_store, 'page-%s' % version)
+
+# for the event loop server (python run.py serve), see server.py
+try:
+    app.config['server_workers'] = CONFIG.config['server_workers']
+except KeyError:
+    app.config['server_workers'] = 8
+
+try:
+    app.config['server_max_connections'] = CONFIG.config[
+            'server_max_connections']
+except KeyError:
+    app.config['server_max_connections'] = 10000
+
+try:
+    app.config['server_timeout'] = CONFIG.config['server_timeout']
+except KeyError:
+    app.config['server_timeout'] = 60
+
+# render everything before serving, rather than on first request
+try:
+    app.config['preload'] = CONFIG.config['preload']
+except KeyError:
+    app.config['preload'] = False
+if app.config['preload']:
+    views.preload()
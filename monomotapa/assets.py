@@ -0,0 +1,167 @@
+"""Fingerprinted, precompressed static files.
+
+build() copies every file in the static directory to static/build with
+a hash of its contents in its name (e.g. style.3f2a9c1e0b4d.css),
+alongside gzip (and, if the brotli module is installed, brotli)
+compressed copies, and records the names in static/build/manifest.json.
+
+Templates should link static files with asset_url(filename), which
+returns the url of the fingerprinted copy if there is one, otherwise
+the plain static url. As the name of a fingerprinted file changes
+whenever it does, they are served with long lived, immutable
+Cache-Control headers, and the precompressed copy that matches the
+request's Accept-Encoding. The manifest itself changes with every
+build, so is served like any other static file.
+
+A build does not delete the fingerprinted files of earlier builds, as
+pages (and other assets) cached by browsers and proxies may still link
+them. Only files that no build has used for KEEP_AGE are removed.
+
+Usage: python run.py assets
+"""
+import os
+import os.path
+import sys
+import json
+import gzip
+import shutil
+import time
+import hashlib
+import mimetypes
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BUILD_DIR = 'build'
+MANIFEST = 'manifest.json'
+# one year
+MAX_AGE = 365 * 24 * 60 * 60
+# remove fingerprinted files not built for a week
+KEEP_AGE = 7 * 24 * 60 * 60
+# encoding -> extension, in order of preference
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def fingerprint(path):
+    """returns hash of contents of file at path"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()[:12]
+
+
+def fingerprinted_name(filename, digest):
+    """returns filename with digest inserted before the extension"""
+    root, ext = os.path.splitext(filename)
+    return '%s.%s%s' % (root, digest, ext)
+
+
+def compress(path):
+    """write gzip and (if available) brotli copies of path,
+    returns list of files written"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    written = [path + '.gz']
+    # mtime=0 so builds are reproducible
+    with open(path + '.gz', 'wb') as raw:
+        compressed = gzip.GzipFile(os.path.basename(path), 'wb', 9, raw, 0)
+        compressed.write(data)
+        compressed.close()
+    if brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(data))
+        written.append(path + '.br')
+    return written
+
+
+def build(static_dir, keep_age=KEEP_AGE):
+    """fingerprint and compress the files in static_dir into
+    static_dir/build, removing files left by earlier builds that have
+    not been built again for keep_age seconds.
+    Returns the manifest (filename -> fingerprinted name)"""
+    build_dir = os.path.join(static_dir, BUILD_DIR)
+    manifest = {}
+    built = set()
+    for dirpath, dirnames, filenames in os.walk(static_dir):
+        if os.path.abspath(dirpath) == os.path.abspath(build_dir):
+            dirnames[:] = []
+            continue
+        for filename in filenames:
+            if filename.endswith(('.gz', '.br')):
+                continue
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, static_dir)
+            target = fingerprinted_name(name, fingerprint(path))
+            target_path = os.path.join(build_dir, target)
+            if not os.path.isdir(os.path.dirname(target_path)):
+                os.makedirs(os.path.dirname(target_path))
+            # the same name means the same contents, so there is no
+            # need to copy it again, only to mark it as still in use
+            if not (os.path.exists(target_path)
+                    and os.path.exists(target_path + '.gz')):
+                shutil.copyfile(path, target_path)
+                written = [target_path] + compress(target_path)
+            else:
+                written = [target_path] + [target_path + ext
+                        for _, ext in ENCODINGS
+                        if os.path.exists(target_path + ext)]
+                for built_path in written:
+                    os.utime(built_path, None)
+            built.update(os.path.abspath(p) for p in written)
+            manifest[name] = target
+    if not os.path.isdir(build_dir):
+        os.makedirs(build_dir)
+    prune(build_dir, built, time.time() - keep_age)
+    # write then rename, so the manifest is never seen half written
+    path = os.path.join(build_dir, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(path + '.tmp', path)
+    return manifest
+
+
+def prune(build_dir, built, before):
+    """remove files in build_dir, other than the manifest and those in
+    built, last modified before the time before"""
+    for dirpath, dirnames, filenames in os.walk(build_dir):
+        for filename in filenames:
+            path = os.path.abspath(os.path.join(dirpath, filename))
+            if (path in built or path == os.path.abspath(
+                    os.path.join(build_dir, MANIFEST))):
+                continue
+            if os.path.getmtime(path) < before:
+                os.remove(path)
+
+
+def manifest_path(static_dir):
+    """returns path of the manifest written by build()"""
+    return os.path.join(static_dir, BUILD_DIR, MANIFEST)
+
+
+def choose_encoding(accept_encodings, path):
+    """returns (encoding, path of precompressed copy) for the best
+    precompressed copy of path that is acceptable, or (None, path)"""
+    for encoding, ext in ENCODINGS:
+        if accept_encodings[encoding] and os.path.exists(path + ext):
+            return encoding, path + ext
+    return None, path
+
+
+def guess_type(filename):
+    """returns mimetype of filename"""
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def main(argv):
+    """command line entry point"""
+    from monomotapa import app
+    manifest = build(app.static_folder)
+    print("Built %d assets in %s" % (len(manifest),
+        os.path.join(app.static_folder, BUILD_DIR)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
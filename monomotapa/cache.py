@@ -0,0 +1,121 @@
+"""Caches for rendered output"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def sizeof(value):
+    """returns (approximate) size of value in bytes"""
+    if isinstance(value, unicode):
+        return len(value.encode('utf-8'))
+    return len(value)
+
+
+class LRUCache(object):
+    """Least recently used cache bounded by the total size (in bytes)
+    of the values it holds rather than the number of entries.
+    Keeps count of hits and misses.
+    If shared (see share()) values not found are looked for in a store
+    shared with other workers, and values set are also stored there."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.store = None
+        self.namespace = None
+        self.store_hits = 0
+
+    def share(self, store, namespace):
+        """look for values in store too (see store.py), under keys
+        prefixed with namespace. None to stop"""
+        self.store = store
+        self.namespace = namespace
+
+    def store_key(self, key):
+        """returns key in the store for key (which must have a repr
+        that is the same in every process)"""
+        return '%s:%s' % (self.namespace, hashlib.sha1(repr(key)).hexdigest())
+
+    def get(self, key):
+        """returns value for key, or None if not cached"""
+        with self.lock:
+            try:
+                value, size = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                value = None
+            else:
+                # reinsert to mark as most recently used
+                self.entries[key] = (value, size)
+                self.hits += 1
+                return value
+        if self.store is not None:
+            value = self.store.get(self.store_key(key))
+            if value is not None:
+                self.store_hits += 1
+                self._set(key, value)
+        return value
+
+    def set(self, key, value):
+        """adds value to cache, evicting least recently used entries
+        to make room. Values larger than the cache are not stored."""
+        self._set(key, value)
+        if self.store is not None:
+            self.store.set(self.store_key(key), value)
+
+    def _set(self, key, value):
+        """adds value to this cache only"""
+        size = sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            self._evict()
+
+    def resize(self, max_bytes):
+        """change the maximum size of the cache"""
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        """drop least recently used entries until we fit. Hold lock."""
+        while self.size > self.max_bytes:
+            _, (_, size) = self.entries.popitem(last=False)
+            self.size -= size
+
+    def discard(self, match):
+        """remove entries whose key match(key) is true for
+        (from this cache, not the store)"""
+        with self.lock:
+            for key in [key for key in self.entries if match(key)]:
+                self.size -= self.entries.pop(key)[1]
+
+    def clear(self):
+        """empty the cache (not the store), resetting counters"""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+            self.store_hits = 0
+
+    def stats(self):
+        """returns dict of cache statistics"""
+        with self.lock:
+            return {'hits' : self.hits, 'misses' : self.misses,
+                    'entries' : len(self.entries), 'bytes' : self.size,
+                    'max_bytes' : self.max_bytes,
+                    'store_hits' : self.store_hits}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
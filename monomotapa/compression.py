@@ -0,0 +1,111 @@
+"""Compression of responses.
+
+install() adds an after_request handler that gzips (or, if the brotli
+module is installed, brotli compresses) text responses for clients that
+accept it. Bodies smaller than min_size are left alone, as compressing
+them gains nothing.
+
+Pages served by conditional_response have an ETag derived from their
+inputs, so their compressed body is cached in page_cache next to the
+uncompressed one, as (etag, encoding), and each page is only compressed
+once. As the body differs the ETag is made weak. Streamed responses are
+gzipped as they are sent, flushing after each chunk so streaming still
+works.
+
+Set enable_compression, compression_level (1-9) and
+compression_min_size in config.json.
+"""
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# mimetypes worth compressing, other than text/*
+COMPRESSIBLE = set(['application/json', 'application/javascript',
+    'application/xml', 'application/atom+xml', 'application/feed+json',
+    'image/svg+xml'])
+
+
+def compressible(mimetype):
+    """returns True if responses of mimetype should be compressed"""
+    return bool(mimetype) and (mimetype.startswith('text/')
+            or mimetype in COMPRESSIBLE)
+
+
+def choose_encoding(accept_encodings, streamed=False):
+    """returns best encoding acceptable to the client, or None.
+    Streams are only gzipped, as brotli's streaming api differs
+    between its python bindings."""
+    if brotli is not None and not streamed and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(data, encoding, level):
+    """returns data compressed with encoding (gzip or br)"""
+    if encoding == 'br':
+        # brotli's quality goes up to 11
+        return brotli.compress(data, quality=min(level, 11))
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_stream(chunks, level):
+    """yields chunks gzipped, flushing after each one"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class Compressor(object):
+    """compresses responses, caching compressed pages in cache"""
+    def __init__(self, cache, level=6, min_size=1024):
+        self.cache = cache
+        self.level = level
+        self.min_size = min_size
+
+    def install(self, app):
+        """compress responses from app"""
+        @app.after_request
+        def compress_response(response):
+            return self.process(response)
+
+    def process(self, response):
+        """returns response, compressed if the request accepts it"""
+        if (response.status_code != 200 or response.direct_passthrough
+                or 'Content-Encoding' in response.headers
+                or not compressible(response.mimetype)):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = choose_encoding(request.accept_encodings,
+                response.is_streamed)
+        if encoding is None:
+            return response
+        etag, weak = response.get_etag()
+        if response.is_streamed:
+            response.response = compress_stream(response.iter_encoded(),
+                    self.level)
+            response.headers.pop('Content-Length', None)
+        else:
+            body = self.cache.get((etag, encoding)) if etag else None
+            if body is None:
+                data = response.get_data()
+                if len(data) < self.min_size:
+                    return response
+                body = compress(data, encoding, self.level)
+                if etag:
+                    self.cache.set((etag, encoding), body)
+            response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        if etag:
+            response.set_etag(etag, weak=True)
+        return response
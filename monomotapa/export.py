@@ -0,0 +1,347 @@
+"""Export the site as static html, so it can be served without python.
+
+Every page that can be generated from a markdown file in src/
+(or that pages.json/navigation.json points at one) is rendered
+through Page.generate_page and written to outdir/[page]/index.html,
+with the home page as outdir/index.html and the not found page as
+outdir/404.html. Static files are copied to outdir/static.
+Post listings, archives, tag pages, the feeds and the search page
+(without results, there is nothing to run queries) are generated by the
+app, see get_generated_urls, and written to outdir/[url]/index.html,
+or outdir/[url] for the feeds. Links in feeds are absolute, set
+SERVER_NAME in the app's config to the site's so they point to it.
+N.B. /source and /unit-tests are dynamic so are not exported.
+
+Pages are rendered in parallel by a pool of worker processes.
+
+What each page was generated from (its markdown, templates and json) is
+recorded in outdir/.manifest.json, so subsequent exports only re-render
+pages whose inputs have changed (use --all to re-render everything).
+Only a page's own entry in pages.json counts as an input, so adding
+or editing one page there does not cause every other page to be rebuilt.
+Generated pages depend on every post, so they are always generated, but
+only written out if they have changed (their hash is in the manifest).
+
+Usage: python run.py export [--all] outdir [processes]
+"""
+import os
+import os.path
+import sys
+import json
+import shutil
+import hashlib
+from urllib import quote, unquote
+from multiprocessing import Pool
+
+from werkzeug.exceptions import NotFound
+
+from monomotapa import app
+from monomotapa.views import Page, get_page_attributes, src_file
+from monomotapa.views import page_not_found, template_chain
+from monomotapa.views import navigation_templates, post_index, paginate
+
+MANIFEST = '.manifest.json'
+# bump if the manifest format changes
+MANIFEST_VERSION = 2
+
+
+def get_routes():
+    """returns sorted list of every page that has a markdown source
+    (pages generated from the posts are in get_generated_urls)"""
+    pages = get_page_attributes('pages.json')
+    navigation = get_page_attributes('navigation.json')
+    # files that are the src of a differently named page
+    aliased = set()
+    routes = set()
+    for page in pages:
+        if 'src' in pages[page]:
+            aliased.add(pages[page]['src'])
+        routes.add(page)
+    if navigation:
+        routes.update(navigation['nav_order'])
+    srcdir = src_file('src')
+    for dirpath, dirnames, filenames in os.walk(srcdir):
+        for filename in filenames:
+            path = os.path.relpath(os.path.join(dirpath, filename), srcdir)
+            root, ext = os.path.splitext(path)
+            if ext == '.md' and path not in aliased:
+                routes.add(root)
+    return sorted(route for route in routes if has_source(route))
+
+
+def get_generated_urls():
+    """returns sorted list of urls of the pages generated from the posts:
+    listings, archives and tags (every page of each), the feeds and the
+    search page"""
+    post_index.update()
+    per_page = app.config['posts_per_page']
+    listings = [('/posts/', post_index.posts)]
+    listings += [('/archive/%d/' % year, posts)
+            for year, posts in post_index.by_year.items()]
+    listings += [('/archive/%d/%d/' % month, posts)
+            for month, posts in post_index.by_month.items()]
+    listings += [('/tags/%s/' % quote(tag.encode('utf-8'), safe=''), posts)
+            for tag, posts in post_index.by_tag.items()]
+    urls = ['/feed.atom', '/feed.json', '/search']
+    for url, posts in listings:
+        urls.append(url)
+        pages = paginate(posts, 1, per_page)[1]
+        urls.extend('%spage/%d' % (url, number)
+                for number in range(2, pages + 1))
+    return sorted(urls)
+
+
+def has_source(route):
+    """True if the markdown for route exists"""
+    pages = get_page_attributes('pages.json')
+    if route in pages and 'src' in pages[route]:
+        filename = pages[route]['src']
+    else:
+        filename = route + '.md'
+    return os.path.exists(src_file(filename, 'src'))
+
+
+def output_path(outdir, route):
+    """returns path of the file route is written to"""
+    if route == 'index':
+        return os.path.join(outdir, 'index.html')
+    return os.path.join(outdir, route, 'index.html')
+
+
+def generated_path(outdir, url):
+    """returns path of the file generated url is written to"""
+    path = unquote(url).strip('/')
+    if os.path.splitext(path)[1]:
+        return os.path.join(outdir, path)
+    return os.path.join(outdir, path, 'index.html')
+
+
+def url_path(route):
+    """returns url route is served at"""
+    if route == 'index':
+        return '/'
+    return '/' + route
+
+
+def write_file(path, contents):
+    """write contents (unicode, or bytes) to path, creating directories
+    as needed"""
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    if isinstance(contents, unicode):
+        contents = contents.encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(contents)
+
+
+def export_page(args):
+    """render route and write it out. Returns path written, or None
+    if the page could not be found. Run in worker processes."""
+    outdir, route = args
+    with app.test_request_context(url_path(route)):
+        try:
+            contents = Page(route).generate_page()
+        except NotFound:
+            return None
+    path = output_path(outdir, route)
+    write_file(path, contents)
+    return path
+
+
+def export_404(outdir):
+    """write the not found page to outdir/404.html"""
+    with app.test_request_context('/404'):
+        contents, status = page_not_found(None)
+    path = os.path.join(outdir, '404.html')
+    write_file(path, contents)
+    return path
+
+
+def export_generated(outdir, urls, manifest):
+    """generate urls with the app, writing out those that have changed
+    since manifest. Returns (dict of url -> hash, list of paths written)"""
+    previous = manifest.get('generated', {}) if manifest else {}
+    client = app.test_client()
+    hashes = {}
+    written = []
+    for url in urls:
+        response = client.get(url)
+        if response.status_code != 200:
+            continue
+        body = response.get_data()
+        hashes[url] = hashlib.sha1(body).hexdigest()
+        path = generated_path(outdir, url)
+        if previous.get(url) != hashes[url] or not os.path.exists(path):
+            write_file(path, body)
+            written.append(path)
+    return hashes, written
+
+
+def copy_static(outdir):
+    """copy new or changed static files to outdir/static,
+    returns list of files copied"""
+    copied = []
+    staticdir = app.static_folder
+    for dirpath, dirnames, filenames in os.walk(staticdir):
+        target = os.path.normpath(os.path.join(outdir, 'static',
+                os.path.relpath(dirpath, staticdir)))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for filename in filenames:
+            src = os.path.join(dirpath, filename)
+            dest = os.path.join(target, filename)
+            # copy2 preserves mtime so unchanged files can be skipped
+            # (to the second, copies can lose some of the fraction)
+            if static_state(src) != static_state(dest):
+                shutil.copy2(src, dest)
+                copied.append(dest)
+    return copied
+
+
+# Dependency tracking
+
+def file_state(path):
+    """returns [size, mtime] of path or None if it does not exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime]
+
+
+def static_state(path):
+    """returns [size, mtime in whole seconds] of path or None if it
+    does not exist"""
+    state = file_state(path)
+    return state and [state[0], int(state[1])]
+
+
+def entry_state(page):
+    """returns hash of the entry for page in pages.json"""
+    pages = get_page_attributes('pages.json')
+    entry = pages.get(page) if pages else None
+    return hashlib.sha1(json.dumps(entry, sort_keys=True)).hexdigest()
+
+
+def page_dependencies(route):
+    """returns dict of the inputs route is generated from,
+    file path (or pages.json#route) -> state"""
+    if route == '404':
+        files = [src_file(template, 'templates')
+                for template in template_chain('static.html')]
+        files += navigation_templates()
+        files += [src_file('defaults.json'), src_file('pages.json'),
+                src_file('navigation.json')]
+    else:
+        files = Page(route).get_dependencies()
+    dependencies = {}
+    pages_json = src_file('pages.json')
+    for path in files:
+        if path == pages_json:
+            dependencies['pages.json#%s' % route] = entry_state(route)
+        else:
+            dependencies[path] = file_state(path)
+    return dependencies
+
+
+def config_state():
+    """returns the app config that affects every page"""
+    return {'version' : MANIFEST_VERSION,
+            'default_title' : app.config['default_title']}
+
+
+def load_manifest(outdir):
+    """returns the manifest written by the last export, or None"""
+    try:
+        with open(os.path.join(outdir, MANIFEST), 'r') as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if manifest.get('config') != config_state():
+        return None
+    return manifest
+
+
+def save_manifest(outdir, pages, generated):
+    """record pages (route -> dependencies) and generated pages
+    (url -> hash) in outdir"""
+    manifest = {'config' : config_state(), 'pages' : pages,
+            'generated' : generated}
+    with open(os.path.join(outdir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def stale_routes(routes, dependencies, manifest):
+    """returns routes whose dependencies differ from those in manifest"""
+    if manifest is None:
+        return list(routes)
+    previous = manifest['pages']
+    return [route for route in routes
+            if previous.get(route) != dependencies[route]]
+
+
+def remove_page(outdir, route, path=None):
+    """remove output for a page that no longer exists"""
+    if path is None:
+        path = output_path(outdir, route)
+    if os.path.exists(path):
+        os.unlink(path)
+        try:
+            os.removedirs(os.path.dirname(path))
+        except OSError:
+            # not empty (or outdir itself)
+            pass
+
+
+def export(outdir, processes=None, rebuild_all=False):
+    """export site to outdir, using processes workers
+    (defaults to the number of cpus). Unless rebuild_all is True only 
+    pages whose inputs have changed since the last export are rendered.
+    Returns list of files written"""
+    routes = get_routes()
+    dependencies = dict((route, page_dependencies(route))
+            for route in routes + ['404'])
+    manifest = None if rebuild_all else load_manifest(outdir)
+    stale = stale_routes(routes, dependencies, manifest)
+    written = []
+    if stale:
+        jobs = [(outdir, route) for route in stale]
+        pool = Pool(processes)
+        try:
+            written = pool.map(export_page, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        written = [path for path in written if path]
+    if stale_routes(['404'], dependencies, manifest):
+        written.append(export_404(outdir))
+    generated, paths = export_generated(outdir, get_generated_urls(),
+            manifest)
+    written.extend(paths)
+    if manifest is not None:
+        for route in manifest['pages']:
+            if route not in dependencies:
+                remove_page(outdir, route)
+        for url in manifest.get('generated', {}):
+            if url not in generated:
+                remove_page(outdir, url, generated_path(outdir, url))
+    written.extend(copy_static(outdir))
+    save_manifest(outdir, dependencies, generated)
+    return written
+
+
+def main(argv):
+    """command line entry point"""
+    rebuild_all = '--all' in argv
+    argv = [arg for arg in argv if arg != '--all']
+    if not argv:
+        sys.exit(__doc__)
+    outdir = argv[0]
+    processes = int(argv[1]) if len(argv) > 1 else None
+    written = export(outdir, processes, rebuild_all)
+    print("Exported %d files to %s" % (len(written), outdir))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
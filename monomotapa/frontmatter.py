@@ -0,0 +1,237 @@
+"""Front matter: page attributes set in the markdown file itself.
+
+A markdown file in src/ may start with a block of YAML (if PyYAML is
+installed) or JSON between two lines containing only ---, e.g.
+
+    ---
+    {"title": "a post", "template": "post.html", "type": "post",
+    "attributes": {"date": "2014-06-04", "author": "Paul M."}}
+    ---
+
+These take the same values as an entry in pages.json, which takes
+precedence where both set an attribute. The front matter is not rendered.
+A block that doesn't parse as a mapping is not front matter (e.g. it may
+be text between two horizontal rules), so it is rendered as usual.
+
+Front matter for every file in src/ is held in memory in a
+FrontMatterIndex, built at startup, and re-read for a single file when
+that file changes. So looking up a page costs a stat, however many
+pages there are. To pick up new files (e.g. for post listings) the whole
+directory is re-checked by refresh() at most once every interval seconds,
+unless the watcher (see watcher.py) is keeping the index up to date.
+"""
+import os
+import os.path
+import json
+import time
+import datetime
+import threading
+
+from monomotapa.watcher import watcher
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+DELIMITER = '---'
+# shared by every file without front matter
+EMPTY = {}
+
+
+class FrontMatterError(Exception):
+    """front matter could not be parsed"""
+    pass
+
+
+def parse_front_matter(text):
+    """returns dict parsed from front matter text (YAML or JSON)"""
+    try:
+        if yaml is not None:
+            meta = yaml.safe_load(text)
+        else:
+            meta = json.loads(text)
+    except ValueError as e:
+        raise FrontMatterError(str(e))
+    except Exception as e:
+        # yaml.YAMLError
+        raise FrontMatterError(str(e))
+    if meta is None:
+        return EMPTY
+    if not isinstance(meta, dict):
+        raise FrontMatterError("front matter must be a mapping")
+    return normalize(meta)
+
+
+def normalize(value):
+    """convert dates (as parsed by YAML) to ISO strings, as in pages.json"""
+    if isinstance(value, dict):
+        return dict((key, normalize(item)) for key, item in value.items())
+    elif isinstance(value, list):
+        return [normalize(item) for item in value]
+    elif isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def split_front_matter(src):
+    """returns (front matter text or None, body) for markdown src.
+    Only a block that parses as front matter is split off, as when it
+    is read by read_front_matter"""
+    lines = src.split('\n')
+    if not lines or lines[0].strip() != DELIMITER:
+        return None, src
+    for number, line in enumerate(lines[1:], 1):
+        if line.strip() == DELIMITER:
+            text = '\n'.join(lines[1:number])
+            try:
+                parse_front_matter(text)
+            except FrontMatterError:
+                return None, src
+            return text, '\n'.join(lines[number + 1:])
+    # no closing delimiter: not front matter
+    return None, src
+
+
+def read_front_matter(path):
+    """returns dict of front matter in file at path, reading only as
+    far as the closing delimiter"""
+    with open(path, 'r') as f:
+        first = f.readline()
+        if first.strip() != DELIMITER:
+            return EMPTY
+        lines = []
+        for line in f:
+            if line.strip() == DELIMITER:
+                return parse_front_matter(''.join(lines).decode('utf-8'))
+            lines.append(line)
+    return EMPTY
+
+
+class FrontMatterIndex(object):
+    """In memory table of front matter for the markdown files in srcdir,
+    filename (relative to srcdir) -> dict"""
+    def __init__(self, srcdir):
+        self.srcdir = srcdir
+        # filename -> ((inode, size, mtime), front matter)
+        self.entries = {}
+        # incremented whenever an entry is added, changed or removed
+        self.version = 0
+        self.scanned = None
+        # set when the watcher calls get() for changed files
+        self.watched = False
+        self.lock = threading.Lock()
+
+    def scan(self):
+        """(re)index every markdown file in srcdir"""
+        seen = set()
+        for dirpath, dirnames, filenames in os.walk(self.srcdir):
+            for filename in filenames:
+                if filename.endswith('.md'):
+                    path = os.path.join(dirpath, filename)
+                    filename = os.path.relpath(path, self.srcdir)
+                    seen.add(filename)
+                    self.get(filename)
+        with self.lock:
+            for filename in list(self.entries):
+                if filename not in seen:
+                    del self.entries[filename]
+                    self.version += 1
+            self.scanned = time.time()
+
+    def refresh(self, interval):
+        """scan() if it has not been done in the last interval seconds"""
+        if self.watched:
+            return
+        if self.scanned is None or time.time() - self.scanned > interval:
+            self.scan()
+
+    def get(self, filename):
+        """returns front matter for filename (relative to srcdir),
+        re-reading it if the file has changed, or None if it does
+        not exist. Files without (or with unparseable) front matter
+        give an empty dict."""
+        path = os.path.join(self.srcdir, filename)
+        signature = watcher.signature(path)
+        if signature is None:
+            with self.lock:
+                if self.entries.pop(filename, None) is not None:
+                    self.version += 1
+            return None
+        entry = self.entries.get(filename)
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+        try:
+            meta = read_front_matter(path)
+        except (IOError, FrontMatterError):
+            meta = EMPTY
+        with self.lock:
+            self.entries[filename] = (signature, meta)
+            self.version += 1
+        return meta
+
+    def filenames(self):
+        """returns list of indexed files"""
+        return list(self.entries)
+
+    def exists(self, filename):
+        """True if filename exists in srcdir"""
+        return self.get(filename) is not None
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class PageAttributes(object):
+    """Read only view of pages.json combined with front matter,
+    usable in place of the dictionary from pages.json. Lookups are
+    remembered, so create one per request."""
+    def __init__(self, pages, index):
+        self.pages = pages or {}
+        self.index = index
+        self.merged = {}
+
+    def src(self, page):
+        """returns the name of the markdown file for page"""
+        try:
+            return self.pages[page]['src']
+        except KeyError:
+            return page + '.md'
+
+    def routes(self):
+        """returns dict of markdown file (relative to src/) -> the page
+        it is served as, for every markdown file that is"""
+        routes = {}
+        for filename in self.index.filenames():
+            if filename.endswith('.md'):
+                routes[filename] = filename[:-3]
+        for page in self.pages:
+            routes[self.src(page)] = page
+        return routes
+
+    def get(self, page, default=None):
+        """returns merged attributes for page, or default"""
+        try:
+            attributes = self.merged[page]
+        except KeyError:
+            meta = self.index.get(self.src(page))
+            if meta:
+                attributes = dict(meta)
+                attributes.update(self.pages.get(page, EMPTY))
+            elif page in self.pages:
+                attributes = self.pages[page]
+            else:
+                attributes = None
+            self.merged[page] = attributes
+        if attributes is None:
+            return default
+        return attributes
+
+    def __contains__(self, page):
+        return self.get(page) is not None
+
+    def __getitem__(self, page):
+        attributes = self.get(page)
+        if attributes is None:
+            raise KeyError(page)
+        return attributes
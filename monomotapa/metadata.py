@@ -0,0 +1,65 @@
+"""In-process registry for the site's json metadata
+(defaults.json, pages.json, navigation.json).
+
+Each file is parsed once and served from memory. A lookup costs a single
+os.stat: the file is only re-read if its inode, size or mtime has changed
+(so an edit, or a replace via rename, is picked up on the next request).
+If the watcher is running not even that, see watcher.py."""
+import json
+import threading
+
+from monomotapa.watcher import watcher
+
+
+class MetadataFile(object):
+    """A json file held in memory, reloaded when it changes on disk"""
+    def __init__(self, path):
+        self.path = path
+        self.signature = None
+        self.data = None
+        self.lock = threading.Lock()
+
+    def stat(self):
+        """returns (inode, size, mtime) of the file, or None if missing"""
+        return watcher.signature(self.path)
+
+    def get(self):
+        """returns parsed contents of file, reloading if it has changed.
+        Raises IOError if the file does not exist"""
+        signature = self.stat()
+        if signature is None:
+            raise IOError("%s not found" % self.path)
+        if signature != self.signature:
+            with self.lock:
+                # another thread may have got here first
+                if signature != self.signature:
+                    with open(self.path, 'r') as jsonfile:
+                        self.data = json.load(jsonfile)
+                    self.signature = signature
+        return self.data
+
+
+class MetadataRegistry(object):
+    """Holds a MetadataFile for every json file that has been asked for.
+    N.B. the same object is returned to every caller so it must
+    be treated as read only."""
+    def __init__(self):
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """returns parsed json for path. Raises IOError if not found"""
+        try:
+            metafile = self.files[path]
+        except KeyError:
+            with self.lock:
+                metafile = self.files.setdefault(path, MetadataFile(path))
+        return metafile.get()
+
+    def clear(self):
+        """forget everything, forcing a reload on next access"""
+        with self.lock:
+            self.files = {}
+
+
+registry = MetadataRegistry()
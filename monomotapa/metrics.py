@@ -0,0 +1,179 @@
+"""Request timing, exposed in Prometheus text format on /metrics.
+
+Enabled by setting enable_metrics to true in config.json. When enabled
+install() wraps the functions doing the work of a request (json loading,
+navigation, markdown, pygments and template rendering) with timers,
+and times each request as a whole, per route. When disabled nothing is
+wrapped, so there is no overhead at all.
+
+N.B. metrics are per process, so each worker reports its own.
+"""
+import time
+import threading
+from functools import wraps
+
+from flask import request, g
+
+# upper bounds of histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+        0.5, 1.0, 2.5, 5.0)
+
+# functions in views that are timed
+PHASES = ['get_page_attributes', 'top_navigation', 'render_markdown',
+        'render_pygments']
+
+
+class Histogram(object):
+    """counts of observations in BUCKETS, with their sum"""
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """add an observation"""
+        for number, bound in enumerate(BUCKETS):
+            if value <= bound:
+                break
+        else:
+            number = len(BUCKETS)
+        self.counts[number] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """Holds histograms of request and phase times, and counters"""
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        # route -> Histogram
+        self.requests = {}
+        # (phase, route) -> Histogram
+        self.phases = {}
+        # status code -> count
+        self.responses = {}
+        # name -> LRUCache (or anything with stats())
+        self.caches = {}
+
+    def observe_request(self, route, seconds, status):
+        """record time taken by a request and its status"""
+        with self.lock:
+            self.requests.setdefault(route, Histogram()).observe(seconds)
+            self.responses[status] = self.responses.get(status, 0) + 1
+
+    def observe_phase(self, phase, route, seconds):
+        """record time taken by phase"""
+        with self.lock:
+            histogram = self.phases.setdefault((phase, route), Histogram())
+            histogram.observe(seconds)
+
+    def timed(self, phase, func):
+        """returns func wrapped with a timer for phase"""
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe_phase(phase, current_route(),
+                        time.time() - start)
+        return wrapper
+
+    def install(self, app, views):
+        """time requests to app and the phases in views"""
+        self.enabled = True
+        for phase in PHASES:
+            setattr(views, phase, self.timed(phase, getattr(views, phase)))
+        views.Page.generate_page = self.timed('generate_page',
+                views.Page.generate_page)
+        self.caches = {'markdown' : views.markdown_cache,
+                'page' : views.page_cache,
+                'pygments' : views.pygments_cache}
+
+        @app.before_request
+        def start_timer():
+            g.metrics_start = time.time()
+
+        @app.after_request
+        def stop_timer(response):
+            start = getattr(g, 'metrics_start', None)
+            if start is not None:
+                self.observe_request(current_route(), time.time() - start,
+                        response.status_code)
+            return response
+
+    def render(self):
+        """returns metrics in Prometheus text format"""
+        lines = []
+        with self.lock:
+            lines.extend(render_histograms('monomotapa_request_seconds',
+                'Time taken to handle requests',
+                [({'route' : route}, histogram)
+                    for route, histogram in sorted(self.requests.items())]))
+            lines.extend(render_histograms('monomotapa_phase_seconds',
+                'Time spent in each phase of handling requests',
+                [({'phase' : phase, 'route' : route}, histogram)
+                    for (phase, route), histogram
+                    in sorted(self.phases.items())]))
+            lines.append('# HELP monomotapa_responses_total '
+                    'Responses by status code')
+            lines.append('# TYPE monomotapa_responses_total counter')
+            for status, count in sorted(self.responses.items()):
+                lines.append('monomotapa_responses_total%s %d'
+                        % (labels({'status' : status}), count))
+        stats = [(name, cache.stats())
+                for name, cache in sorted(self.caches.items())]
+        for metric, kind, help_text in [
+                ('hits', 'counter', 'Cache hits'),
+                ('misses', 'counter', 'Cache misses'),
+                ('store_hits', 'counter',
+                    'Cache misses found in the shared store'),
+                ('hit_ratio', 'gauge', 'Cache hits / lookups'),
+                ('bytes', 'gauge', 'Size of cached values')]:
+            name = 'monomotapa_cache_%s' % metric
+            if kind == 'counter':
+                name += '_total'
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for cache, values in stats:
+                if metric == 'hit_ratio':
+                    lookups = values['hits'] + values['misses']
+                    value = float(values['hits']) / lookups if lookups else 0
+                else:
+                    value = values[metric]
+                lines.append('%s%s %s' % (name, labels({'cache' : cache}),
+                    value))
+        return '\n'.join(lines) + '\n'
+
+
+def current_route():
+    """returns endpoint of current request, 404 if there is none
+    (or none if there is no request)"""
+    if not request:
+        return 'none'
+    return request.endpoint or '404'
+
+
+def labels(values):
+    """returns Prometheus labels for dict values"""
+    return '{%s}' % ','.join('%s="%s"' % (key, values[key])
+            for key in sorted(values))
+
+
+def render_histograms(name, help_text, histograms):
+    """returns lines for histograms, a list of (labels, Histogram)"""
+    lines = ['# HELP %s %s' % (name, help_text),
+            '# TYPE %s histogram' % name]
+    for values, histogram in histograms:
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+            cumulative += count
+            bucket = dict(values, le=bound)
+            lines.append('%s_bucket%s %d' % (name, labels(bucket), cumulative))
+        lines.append('%s_sum%s %f' % (name, labels(values), histogram.sum))
+        lines.append('%s_count%s %d' % (name, labels(values), histogram.count))
+    return lines
+
+
+metrics = Metrics()
@@ -1,39 +1,47 @@
 import json
-import imp
+import threading
+from importlib import import_module
+
 class Plugin(object):
     """
-    Base Class for Plugins. 
+    Base Class for Plugins.
     =======================
-    All plugins must consist of a single class that inherits from this one. 
-    The class name must be equivalent to the module name. 
-    ie myplugin.py contains  the myplugin class (lower case).
-    Plugins must be installed in the plugins directory
+    All plugins must consist of a single class that inherits from this one.
+    The class name must be equivalent to the module name.
+    ie myplugin.py contains  the myplugin class (lower case,
+    or capitalized: Myplugin).
+    Plugins must be installed in the plugins directory (monomotapa/plugins)
+    see plugins/sampleplugin.py
     To enable a pugin add it to plugin.json as a key value pair, where
-    the key is the plugin name and the value is the target. 
+    the key is the plugin name and the value is the target.
     The target is page, where * is all pages. path/* is also permissible.
-    Each class must 
+    (The target may also be a list of these).
+    Each class must
         1. be capable of taking any set of arbitary key/value pairs via **kwargs
             (you are free to ignore/discard any of them)
-        2. produce as their sole ouput a dictionary through the output method, 
-            that must have a key called 'class_name' 
-            with the value self.__class__.__name__ 
+        2. produce as their sole ouput a dictionary through the output method,
+            that must have a key called 'class_name'
+            with the value self.__class__.__name__
 
         This dictionary will be passed back into the Page/Post etc object
-        in a dictionary called plugins in as the value to a key that is 
-        the same as the module name (i.e. lower class) which will be 
+        in a dictionary called plugins in as the value to a key that is
+        the same as the module name (i.e. lower class) which will be
         added to its vars(self) where it can be used in jinja2 templates.
         It will be passed vars(self) as **kwargs
+
+    Plugins are loaded once, at startup. By default the output for each
+    page is cached, so the plugin is only run the first time a page is
+    requested. Set cacheable = False for plugins whose output changes:
+    it is then run for every request, and pages it applies to are
+    not cached (nor given an ETag).
     """
+    cacheable = True
+
+
+class PluginError(Exception):
+    """plugin could not be loaded"""
     pass
 
-class Sampleplugin(Plugin):
-    """Sample Plugin"""
-    def __init__(self, **kwargs):
-        """takes **kwargs"""
-        self.page = "My name is " + kwargs['page']
-    def output(self):
-        """returns dict"""
-        return {'class_name' : self.__class__.__name__, 'page_name' : self.page}
 
 def load_plugin_conf(plugin_file):
     """Get plugin conf from json file, return dict.
@@ -45,32 +53,112 @@ def load_plugin_conf(plugin_file):
         plugin_conf = {}
     return plugin_conf
 
-def load_plugins(plugin_path, plugin_conf):
+def load_plugins(plugin_package, plugin_conf):
     """Parse plugin conf and checks to see if plugin can be found, and if so
-    load it.Returns a dict identical in format to 
-    plugin_conf (name, applies_to) with loaded modules"""
-    plugins={}
-    for name, applies_to in plugin_conf:
-        filename, pathname, description = imp.find_module(name, plugin_path)
+    load it from plugin_package (e.g. monomotapa.plugins).
+    Returns a dict of name: (plugin class, applies_to)"""
+    plugins = {}
+    for name, applies_to in plugin_conf.items():
         try:
-            imp.load_module(filename, pathname, description)
-            plugins[name] = applies_to
-        finally:
-            if filepath:
-                filepath.close()
+            module = import_module('%s.%s' % (plugin_package, name))
+        except ImportError as e:
+            raise PluginError("Plugin %s not found: %s" % (name, e))
+        plugin_class = (getattr(module, name, None)
+                or getattr(module, name.capitalize(), None))
+        if plugin_class is None:
+            raise PluginError("Plugin %s has no class %s" % (name, name))
+        plugins[name] = (plugin_class, applies_to)
     return plugins
 
-'''
-# importing with indirection using __import__
-# import class
-X = __import__('datetime')
-# assign class 
-z = vars(X)['datetime']
-# or x = X.getattr(module, 'datetime')
-z.now()
-
-# with imp
-file, fpath, desc = imp.find_module(name[, path]) -- search for module
-imp.load_module(name, file, fpath, desc)
-'''
-        
+
+class PluginIndex(object):
+    """Finds the plugins that apply to a page.
+    Targets are compiled into a list of plugins for all pages (*),
+    a dict of exact pages, and a trie of path segments for path/*,
+    so a lookup costs the depth of the page's path not the number
+    of plugins."""
+    def __init__(self):
+        self.plugins = {}
+        self.everywhere = []
+        self.exact = {}
+        # segment -> [plugins for segment/*, {children}]
+        self.trie = {}
+        self.outputs = {}
+        self.lock = threading.Lock()
+        # plugin.json, once loaded
+        self.path = None
+
+    def load(self, plugin_file, plugin_package):
+        """load and index plugins enabled in plugin_file"""
+        self.path = plugin_file
+        self.index(load_plugins(plugin_package, load_plugin_conf(plugin_file)))
+
+    def index(self, plugins):
+        """index plugins (name: (plugin class, applies_to))"""
+        self.plugins = dict((name, plugin[0])
+                for name, plugin in plugins.items())
+        self.everywhere = []
+        self.exact = {}
+        self.trie = {}
+        self.outputs = {}
+        for name in sorted(plugins):
+            targets = plugins[name][1]
+            if isinstance(targets, basestring):
+                targets = [targets]
+            for target in targets:
+                target = target.strip('/')
+                if target == '*':
+                    self.everywhere.append(name)
+                elif target.endswith('/*'):
+                    node = [None, self.trie]
+                    for segment in target[:-2].split('/'):
+                        node = node[1].setdefault(segment, [[], {}])
+                    node[0].append(name)
+                else:
+                    self.exact.setdefault(target, []).append(name)
+
+    def applies_to(self, page):
+        """returns names of plugins that apply to page"""
+        if not self.plugins:
+            return []
+        names = list(self.everywhere)
+        children = self.trie
+        segments = page.strip('/').split('/')
+        # path/* applies to pages below path, not path itself
+        for segment in segments[:-1]:
+            node = children.get(segment)
+            if node is None:
+                break
+            names.extend(node[0])
+            children = node[1]
+        names.extend(self.exact.get(page, []))
+        return names
+
+    def cacheable(self, page):
+        """False if any of the plugins that apply to page aren't
+        cacheable, i.e. the page can't be cached either"""
+        return all(self.plugins[name].cacheable
+                for name in self.applies_to(page))
+
+    def output(self, page, attributes):
+        """returns dict of plugin name: output for plugins that apply
+        to page. attributes (i.e. vars(page)) are passed to the plugin
+        as **kwargs"""
+        outputs = {}
+        for name in self.applies_to(page):
+            key = (name, page)
+            try:
+                outputs[name] = self.outputs[key]
+                continue
+            except KeyError:
+                pass
+            plugin_class = self.plugins[name]
+            result = plugin_class(**attributes).output()
+            if plugin_class.cacheable:
+                with self.lock:
+                    self.outputs[key] = result
+            outputs[name] = result
+        return outputs
+
+
+plugin_index = PluginIndex()
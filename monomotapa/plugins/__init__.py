@@ -0,0 +1 @@
+"""Plugins live here, see monomotapa/plugin.py"""
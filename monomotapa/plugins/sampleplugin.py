@@ -0,0 +1,10 @@
+from monomotapa.plugin import Plugin
+
+class Sampleplugin(Plugin):
+    """Sample Plugin"""
+    def __init__(self, **kwargs):
+        """takes **kwargs"""
+        self.page = "My name is " + kwargs['page']
+    def output(self):
+        """returns dict"""
+        return {'class_name' : self.__class__.__name__, 'page_name' : self.page}
@@ -0,0 +1,132 @@
+"""Index of posts for listings, archives and tags.
+
+A post is any page with "type": "post", set in pages.json or front
+matter. Its "attributes" may contain date (YYYY-MM-DD), date-text,
+author, summary and tags (a list, or a comma separated string).
+
+The index is built in memory, sorted newest first, with the year, month
+and tag archives precomputed. It is rebuilt only when pages.json is
+reloaded or the front matter index changes, so a page of a listing is
+just a slice of a list.
+"""
+import json
+import hashlib
+import threading
+
+from monomotapa.frontmatter import PageAttributes
+
+
+class Post(object):
+    """The attributes of a post needed for listings"""
+    __slots__ = ['name', 'title', 'heading', 'date', 'date_text', 'author',
+            'summary', 'tags', 'src', 'trusted']
+
+    def __init__(self, name, attributes, src):
+        details = attributes.get('attributes') or {}
+        self.name = name
+        self.title = attributes.get('title', name.lower())
+        self.heading = attributes.get('heading', name.capitalize())
+        self.date = details.get('date') or ''
+        self.date_text = details.get('date-text') or self.date
+        self.author = details.get('author')
+        self.summary = details.get('summary')
+        tags = details.get('tags') or []
+        if isinstance(tags, basestring):
+            tags = [tag.strip() for tag in tags.split(',') if tag.strip()]
+        self.tags = tags
+        self.src = src
+        self.trusted = attributes.get('trusted', False)
+
+    @property
+    def year(self):
+        """year as int, or None if undated"""
+        try:
+            return int(self.date[:4])
+        except ValueError:
+            return None
+
+    @property
+    def month(self):
+        """month as int, or None if undated"""
+        try:
+            return int(self.date[5:7])
+        except ValueError:
+            return None
+
+
+def paginate(posts, number, per_page):
+    """returns (posts on page number (from 1), number of pages)"""
+    pages = max(1, (len(posts) + per_page - 1) // per_page)
+    start = (number - 1) * per_page
+    return posts[start:start + per_page], pages
+
+
+class PostIndex(object):
+    """Posts sorted by date (newest first), by year, (year, month) and tag.
+    get_pages returns the current pages.json dictionary, index is the
+    FrontMatterIndex, which is checked for new files at most every
+    interval seconds."""
+    def __init__(self, index, get_pages, interval=2):
+        self.index = index
+        self.get_pages = get_pages
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pages = None
+        self.version = None
+        self.posts = []
+        self.by_year = {}
+        self.by_month = {}
+        self.by_tag = {}
+        # hash of the posts, see build()
+        self.key = None
+
+    def update(self):
+        """rebuild if pages.json or the front matter has changed"""
+        self.index.refresh(self.interval)
+        pages = self.get_pages()
+        if pages is not self.pages or self.index.version != self.version:
+            with self.lock:
+                version = self.index.version
+                self.build(pages)
+                self.pages = pages
+                self.version = version
+        return self
+
+    def build(self, pages):
+        """build index from pages.json and the front matter index"""
+        attributes = PageAttributes(pages, self.index)
+        posts = []
+        for src, page in attributes.routes().items():
+            entry = attributes.get(page)
+            if entry and entry.get('type') == 'post':
+                posts.append(Post(page, entry, src))
+        # newest first, undated last
+        posts.sort(key=lambda post: (post.date, post.name), reverse=True)
+        by_year, by_month, by_tag = {}, {}, {}
+        for post in posts:
+            if post.year:
+                by_year.setdefault(post.year, []).append(post)
+                by_month.setdefault((post.year, post.month), []).append(post)
+            for tag in post.tags:
+                by_tag.setdefault(tag, []).append(post)
+        self.posts = posts
+        self.by_year = by_year
+        self.by_month = by_month
+        self.by_tag = by_tag
+        # changes only when the posts do, so is the same in every
+        # worker and across restarts. Their contents are not included,
+        # pages using them depend on their source files
+        self.key = hashlib.sha1(json.dumps([[getattr(post, name)
+            for name in Post.__slots__] for post in posts])).hexdigest()
+
+    def recent(self, count):
+        """returns count newest posts"""
+        return self.update().posts[:count]
+
+    def years(self):
+        """returns list of years with posts, newest first"""
+        return sorted(self.update().by_year, reverse=True)
+
+    def tags(self):
+        """returns sorted list of tags"""
+        return sorted(self.update().by_tag)
@@ -0,0 +1,66 @@
+"""The set of pages that exist, so requests for ones that don't can be
+turned away without doing any of the work of building a Page.
+
+Valid routes are every page with a markdown source in src/ (named after
+the file, or with a src set in pages.json). The set is rebuilt only when
+pages.json is reloaded or the front matter index changes. Routes not in
+it are checked once, as a new file may not have been indexed yet, and if
+there is no source they are remembered as missing, until something
+changes or MAX_MISSING have been seen.
+"""
+import threading
+
+from monomotapa.frontmatter import PageAttributes
+
+# forget missing routes once there are this many
+MAX_MISSING = 10000
+
+
+class RouteIndex(object):
+    """Pages served from markdown. get_pages returns the current
+    pages.json dictionary, index is the FrontMatterIndex, which is
+    checked for new files at most every interval seconds."""
+    def __init__(self, index, get_pages, interval=2):
+        self.index = index
+        self.get_pages = get_pages
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pages = None
+        self.version = None
+        self.attributes = None
+        self.valid = frozenset()
+        self.missing = set()
+
+    def update(self):
+        """rebuild if pages.json or the front matter has changed"""
+        self.index.refresh(self.interval)
+        pages = self.get_pages()
+        if pages is not self.pages or self.index.version != self.version:
+            with self.lock:
+                version = self.index.version
+                attributes = PageAttributes(pages, self.index)
+                # pages.json may list pages without a source
+                self.valid = frozenset(page for src, page
+                        in attributes.routes().items()
+                        if self.index.exists(src))
+                self.missing = set()
+                self.attributes = attributes
+                self.pages = pages
+                self.version = version
+        return self
+
+    def exists(self, page):
+        """True if page has a markdown source"""
+        self.update()
+        if page in self.valid:
+            return True
+        if page in self.missing:
+            return False
+        # not indexed yet?
+        if self.index.exists(self.attributes.src(page)):
+            return True
+        with self.lock:
+            if len(self.missing) >= MAX_MISSING:
+                self.missing = set()
+            self.missing.add(page)
+        return False
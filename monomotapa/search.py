@@ -0,0 +1,353 @@
+"""Full text search of the markdown in src/.
+
+Every page served from markdown is indexed: the words of its source,
+and of its title, heading and summary (from pages.json or front matter),
+which count WEIGHT times as much. Results are ranked with BM25.
+
+The index is an inverted index (word -> list of (document, count))
+kept in a single file:
+
+    header      MAGIC, FORMAT, length of documents, length of terms
+    documents   json list of [page, src, signature, length, heading,
+                summary, sha1 of the text]
+    terms       json object, word -> [offset, number of postings]
+    postings    (document, count) pairs as little endian unsigned ints
+
+The file is memory mapped, and only the postings for the words searched
+for are read from it. When pages change they are marked deleted and
+reindexed into a small in memory index that is searched alongside the
+file, so updating the index costs the pages that changed, not the whole
+site. Once SAVE_AFTER documents have changed the two are merged and the file
+is rewritten (it is also written if there isn't one).
+
+Build the index with python run.py search (otherwise it is built by the
+first search). The file is set by search_index_file in config.json.
+If it can't be written the error is logged and searches are answered
+from memory; it is not tried again until the next rebuild().
+"""
+import os
+import os.path
+import re
+import sys
+import json
+import math
+import mmap
+import heapq
+import struct
+import hashlib
+import logging
+import threading
+
+from monomotapa.frontmatter import PageAttributes, split_front_matter
+from monomotapa.watcher import watcher
+
+MAGIC = 'MONOSRCH'
+FORMAT = 2
+HEADER = struct.Struct('<8sIII')
+POSTING = struct.Struct('<II')
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+# times words in titles, headings and summaries count
+WEIGHT = 3
+# rewrite the index file after this many documents have been
+# added or removed (a changed page is both)
+SAVE_AFTER = 20
+WORD = re.compile(r'\w+', re.UNICODE)
+# markdown that is not part of the text, for snippets
+MARKUP = re.compile(r'\]\([^)]*\)|[#*_`>\[\]]')
+SNIPPET_LENGTH = 200
+
+log = logging.getLogger(__name__)
+
+
+def tokenize(text):
+    """returns list of (lower case) words in text"""
+    return WORD.findall(text.lower())
+
+
+def read_text(path):
+    """returns text of markdown file at path, without front matter,
+    or None if it can't be read"""
+    try:
+        with open(path, 'r') as f:
+            src = f.read().decode('utf-8', 'replace')
+    except IOError:
+        return None
+    return split_front_matter(src)[1]
+
+
+def snippet(text, terms, length=SNIPPET_LENGTH):
+    """returns (part of text around the first of terms found in it,
+    list of (start, end) of the terms in it)"""
+    text = ' '.join(MARKUP.sub('', text).split())
+    words = [(match.start(), match.end()) for match in WORD.finditer(text)
+            if match.group().lower() in terms]
+    start = 0
+    if words and words[0][0] > length // 4:
+        start = text.rfind(' ', 0, words[0][0] - length // 4) + 1
+    part = text[start:start + length]
+    matches = [(begin - start, end - start) for begin, end in words
+            if begin >= start and end <= start + len(part)]
+    return part, matches
+
+
+class SearchIndex(object):
+    """Inverted index of the pages served from markdown in index.srcdir.
+    get_pages returns the current pages.json dictionary, index is
+    the FrontMatterIndex"""
+    def __init__(self, path, index, get_pages, interval=2):
+        self.path = path
+        self.index = index
+        self.get_pages = get_pages
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pages = None
+        self.version = None
+        # hash of the documents indexed, see update()
+        self.key = None
+        # set when the file can't be written, see save()
+        self.save_failed = False
+        self.clear()
+
+    def clear(self):
+        """forget everything"""
+        self.map = None
+        self.postings_start = 0
+        # word -> [offset, count] in the file
+        self.terms = {}
+        # [page, src, signature, length, heading, summary, digest], by id
+        self.documents = []
+        # page -> document id
+        self.by_page = {}
+        self.deleted = set()
+        # word -> {document id : count}, for pages changed since loaded
+        self.added = {}
+        self.changed = 0
+        self.total_length = 0
+
+    def load(self):
+        """memory map the index file, if there is one"""
+        with self.lock:
+            self._load()
+
+    def _load(self):
+        """memory map the index file. Hold lock"""
+        self.clear()
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return
+        with f:
+            try:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error):
+                # empty file
+                return
+        if len(self.map) < HEADER.size:
+            self.map = None
+            return
+        magic, version, doc_length, term_length = HEADER.unpack_from(
+                self.map)
+        if magic != MAGIC or version != FORMAT:
+            self.map = None
+            return
+        start = HEADER.size
+        self.documents = json.loads(self.map[start:start + doc_length])
+        start += doc_length
+        self.terms = json.loads(self.map[start:start + term_length])
+        self.postings_start = start + term_length
+        for number, document in enumerate(self.documents):
+            self.by_page[document[0]] = number
+            self.total_length += document[3]
+
+    def postings(self, term):
+        """returns list of (document id, count) for term"""
+        postings = []
+        location = self.terms.get(term)
+        if location is not None:
+            offset, count = location
+            values = struct.unpack_from('<%dI' % (count * 2), self.map,
+                    self.postings_start + offset)
+            postings.extend((values[i], values[i + 1])
+                    for i in range(0, len(values), 2)
+                    if values[i] not in self.deleted)
+        postings.extend((number, count) for number, count
+                in self.added.get(term, {}).items()
+                if number not in self.deleted)
+        return postings
+
+    def update(self):
+        """reindex pages that have changed since the last update, if
+        pages.json or the front matter index has changed"""
+        self.index.refresh(self.interval)
+        pages = self.get_pages()
+        if pages is self.pages and self.index.version == self.version:
+            return self
+        with self.lock:
+            version = self.index.version
+            attributes = PageAttributes(pages, self.index)
+            routes = attributes.routes()
+            seen = set()
+            for src, page in routes.items():
+                seen.add(page)
+                path = os.path.join(self.index.srcdir, src)
+                signature = watcher.signature(path)
+                entry = attributes.get(page) or {}
+                heading = entry.get('heading', page.capitalize())
+                details = entry.get('attributes') or {}
+                summary = details.get('summary') or ''
+                text = ' '.join([entry.get('title', ''), heading, summary])
+                number = self.by_page.get(page)
+                if number is not None:
+                    document = self.documents[number]
+                    if (document[1:3] == [src, list(signature or [])]
+                            and document[4:6] == [heading, summary]):
+                        continue
+                    self.remove(page)
+                if signature is not None:
+                    self.add(page, src, path, signature, heading, summary,
+                            text)
+            for page in list(self.by_page):
+                if page not in seen:
+                    self.remove(page)
+            # write the file if there isn't one yet
+            if not self.save_failed and (self.changed >= SAVE_AFTER
+                    or (self.changed and self.map is None)):
+                self.save()
+            # changes only when what is indexed does, so is the same
+            # in every worker and across restarts
+            self.key = hashlib.sha1(json.dumps(sorted(
+                [document[0], document[1]] + document[4:]
+                for number, document in enumerate(self.documents)
+                if number not in self.deleted))).hexdigest()
+            self.pages = pages
+            self.version = version
+        return self
+
+    def add(self, page, src, path, signature, heading, summary, text):
+        """index page. Hold lock"""
+        body = read_text(path)
+        if body is None:
+            return
+        counts = {}
+        for word in tokenize(body):
+            counts[word] = counts.get(word, 0) + 1
+        for word in tokenize(text):
+            counts[word] = counts.get(word, 0) + WEIGHT
+        length = sum(counts.values())
+        number = len(self.documents)
+        digest = hashlib.sha1(body.encode('utf-8')).hexdigest()
+        self.documents.append([page, src, list(signature), length, heading,
+            summary, digest])
+        self.by_page[page] = number
+        self.total_length += length
+        for word, count in counts.items():
+            self.added.setdefault(word, {})[number] = count
+        self.changed += 1
+
+    def remove(self, page):
+        """drop page from the index. Hold lock"""
+        number = self.by_page.pop(page, None)
+        if number is not None:
+            self.deleted.add(number)
+            self.total_length -= self.documents[number][3]
+            self.changed += 1
+
+    def save(self):
+        """write the index (without deleted documents) to the file
+        and map it. Hold lock. If the file can't be written the error
+        is logged, save_failed set and the index left as it is.
+        Returns True if the file was written"""
+        renumber = {}
+        documents = []
+        for number, document in enumerate(self.documents):
+            if number not in self.deleted:
+                renumber[number] = len(documents)
+                documents.append(document)
+        terms = {}
+        postings = []
+        offset = 0
+        for word in sorted(set(self.terms) | set(self.added)):
+            pairs = sorted((renumber[number], count)
+                    for number, count in self.postings(word))
+            if not pairs:
+                continue
+            terms[word] = [offset, len(pairs)]
+            for pair in pairs:
+                postings.append(POSTING.pack(*pair))
+            offset += len(pairs) * POSTING.size
+        doc_data = json.dumps(documents, separators=(',', ':'))
+        term_data = json.dumps(terms, separators=(',', ':'))
+        tmp = '%s.%d' % (self.path, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, FORMAT, len(doc_data),
+                    len(term_data)))
+                f.write(doc_data)
+                f.write(term_data)
+                f.write(''.join(postings))
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            log.error("can't write search index %s: %s", self.path, e)
+            self.save_failed = True
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return False
+        self._load()
+        return True
+
+    def search(self, query, count):
+        """returns list of up to count (document, score) for the pages
+        best matching query, best first. document is [page, src,
+        signature, length, heading, summary, digest]"""
+        self.update()
+        terms = set(tokenize(query))
+        with self.lock:
+            live = len(self.by_page)
+            if not live or not terms:
+                return []
+            average = float(self.total_length) / live
+            scores = {}
+            for term in terms:
+                postings = self.postings(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (live - len(postings) + 0.5)
+                        / (len(postings) + 0.5))
+                for number, tf in postings:
+                    length = self.documents[number][3]
+                    score = idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B
+                        * length / average))
+                    scores[number] = scores.get(number, 0) + score
+            best = heapq.nlargest(count, scores.items(),
+                    key=lambda item: item[1])
+            return [(self.documents[number], score)
+                    for number, score in best]
+
+    def rebuild(self):
+        """reindex everything and write the index file.
+        Returns True if it was written"""
+        with self.lock:
+            self.clear()
+            self.pages = None
+            self.version = None
+            self.save_failed = False
+        self.update()
+        with self.lock:
+            return self.save()
+
+
+def main(argv):
+    """command line entry point: build the index"""
+    from monomotapa import views
+    if not views.search_index.rebuild():
+        sys.exit("Could not write %s" % views.search_index.path)
+    print("Indexed %d pages in %s" % (len(views.search_index.by_page),
+        views.search_index.path))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,529 @@
+"""An event loop HTTP server, for sites with many concurrent clients.
+
+The servers that come with flask (app.run(), and the threaded WSGI
+server in benchmarks/suite.py) use a thread per connection, so every
+slow or kept alive client holds a thread for as long as it is connected.
+This server reads requests and writes responses for every connection in
+a single thread, with asyncore, so a connection costs a socket and its
+buffers. Sockets are watched with epoll where there is one (with poll
+otherwise, so it isn't limited to 1024 of them), and only those whose
+state may have changed are looked at each time round the loop, so
+thousands of idle connections cost next to nothing. Each complete
+request is handed to a fixed pool of worker threads that run the app,
+which is where its blocking file I/O happens, then the response is
+written out by the event loop at whatever rate the client reads it.
+
+Responses are generated in full by the worker before any of it is sent,
+so streamed pages (see stream in pages.json) are not sent a section at
+a time, though they are still cached as they would be otherwise.
+
+Run with python run.py serve [host:port]. The number of workers, the
+maximum number of connections and the number of seconds an idle
+connection is kept open are set by server_workers,
+server_max_connections and server_timeout in config.json.
+"""
+import os
+import sys
+import time
+import errno
+import fcntl
+import Queue
+import select
+import socket
+import urllib
+import asyncore
+import asynchat
+import urlparse
+import threading
+import functools
+import traceback
+from collections import deque
+from email.utils import formatdate
+from cStringIO import StringIO
+
+# requests with longer headers, or bodies, are turned away
+MAX_HEADER = 64 * 1024
+MAX_BODY = 10 * 1024 * 1024
+# responses without a body, so without a Content-Length
+NO_BODY = ('1', '204', '304')
+# seconds between checks for idle connections
+SWEEP_INTERVAL = 1.0
+
+
+class BadRequest(Exception):
+    """request can't be parsed, or is too large. args[0] is the status"""
+    pass
+
+
+def parse_request(data):
+    """returns (method, target, version, list of (name, value)) for the
+    request line and headers in data"""
+    lines = data.lstrip('\r\n').split('\r\n')
+    try:
+        method, target, version = lines[0].split()
+    except ValueError:
+        raise BadRequest('400 Bad Request')
+    if not version.startswith('HTTP/1.'):
+        raise BadRequest('505 HTTP Version Not Supported')
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        if line[0] in ' \t' and headers:
+            # continued from the line before
+            name, value = headers[-1]
+            headers[-1] = (name, value + ' ' + line.strip())
+            continue
+        name, colon, value = line.partition(':')
+        if not colon:
+            raise BadRequest('400 Bad Request')
+        headers.append((name.strip(), value.strip()))
+    return method, target, version, headers
+
+
+def body_length(headers):
+    """returns length of the body of a request with headers. Raises
+    BadRequest for bodies whose length is not given by a single valid
+    Content-Length: chunked (or any other Transfer-Encoding) bodies are
+    not supported, and anything ambiguous could be read differently by
+    a proxy in front of us, which would let requests be smuggled"""
+    lengths = [value for name, value in headers
+            if name.lower() == 'content-length']
+    if [name for name, value in headers
+            if name.lower() == 'transfer-encoding']:
+        if lengths:
+            raise BadRequest('400 Bad Request')
+        raise BadRequest('501 Not Implemented')
+    if not lengths:
+        return 0
+    if len(lengths) > 1 or not lengths[0].isdigit():
+        raise BadRequest('400 Bad Request')
+    return int(lengths[0])
+
+
+def make_environ(request, body, server_address, client_address):
+    """returns WSGI environ for request (as returned by parse_request)"""
+    method, target, version, headers = request
+    if '://' in target:
+        target = urlparse.urlunsplit(('', '') + urlparse.urlsplit(target)[2:])
+    path, _, query = target.partition('?')
+    environ = {'REQUEST_METHOD' : method,
+            'SCRIPT_NAME' : '',
+            'PATH_INFO' : urllib.unquote(path),
+            'QUERY_STRING' : query,
+            'SERVER_NAME' : server_address[0],
+            'SERVER_PORT' : str(server_address[1]),
+            'SERVER_PROTOCOL' : version,
+            'REMOTE_ADDR' : client_address[0],
+            'REMOTE_PORT' : str(client_address[1]),
+            'wsgi.version' : (1, 0),
+            'wsgi.url_scheme' : 'http',
+            'wsgi.input' : StringIO(body),
+            'wsgi.errors' : sys.stderr,
+            'wsgi.multithread' : True,
+            'wsgi.multiprocess' : False,
+            'wsgi.run_once' : False}
+    for name, value in headers:
+        key = name.upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        if key in environ:
+            environ[key] += ',' + value
+        else:
+            environ[key] = value
+    return environ
+
+
+def keep_alive(request):
+    """True if the connection should be kept open after request"""
+    method, target, version, headers = request
+    connection = ','.join(value for name, value in headers
+            if name.lower() == 'connection').lower()
+    if version == 'HTTP/1.0':
+        return 'keep-alive' in connection
+    return 'close' not in connection
+
+
+def run_app(app, environ):
+    """returns (status, headers, body) of app's response to environ"""
+    response = {}
+    chunks = []
+    def start_response(status, headers, exc_info=None):
+        if exc_info and response:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        response['status'] = status
+        response['headers'] = headers
+        return chunks.append
+    try:
+        iterable = app(environ, start_response)
+        try:
+            for chunk in iterable:
+                if chunk:
+                    chunks.append(chunk)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+    except Exception:
+        traceback.print_exc(file=environ['wsgi.errors'])
+        return ('500 Internal Server Error',
+                [('Content-Type', 'text/plain')], 'Internal Server Error')
+    return response['status'], response['headers'], ''.join(chunks)
+
+
+def format_response(status, headers, body, head, keep):
+    """returns response as a string. head is True for HEAD requests,
+    keep if the connection will be kept open"""
+    lines = ['HTTP/1.1 %s' % status]
+    names = set()
+    for name, value in headers:
+        lower = name.lower()
+        if lower in ('connection', 'transfer-encoding'):
+            continue
+        names.add(lower)
+        lines.append('%s: %s' % (name, value))
+    if 'date' not in names:
+        lines.append('Date: %s' % formatdate(usegmt=True))
+    if 'content-length' not in names and not status.startswith(NO_BODY):
+        lines.append('Content-Length: %d' % len(body))
+    lines.append('Connection: %s' % ('keep-alive' if keep else 'close'))
+    if head:
+        body = ''
+    return '\r\n'.join(lines) + '\r\n\r\n' + body
+
+
+class Trigger(asyncore.file_dispatcher):
+    """Runs callbacks in the event loop, for other threads"""
+    def __init__(self, map):
+        read_fd, self.write_fd = os.pipe()
+        flags = fcntl.fcntl(self.write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        # file_dispatcher uses a copy of read_fd
+        asyncore.file_dispatcher.__init__(self, read_fd, map)
+        os.close(read_fd)
+        self.callbacks = deque()
+
+    def pull(self, callback):
+        """call callback() in the event loop thread"""
+        self.callbacks.append(callback)
+        try:
+            os.write(self.write_fd, 'x')
+        except OSError as e:
+            # the pipe is full, so the loop will wake anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except (OSError, socket.error):
+            pass
+        while self.callbacks:
+            self.callbacks.popleft()()
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        if self.write_fd is not None:
+            os.close(self.write_fd)
+            self.write_fd = None
+
+
+class Connection(asynchat.async_chat):
+    """A client connection. Requests are read into memory, then
+    handled by the server's workers one at a time"""
+    ac_in_buffer_size = 65536
+    ac_out_buffer_size = 65536
+
+    def __init__(self, server, sock, address):
+        asynchat.async_chat.__init__(self, sock, server.map)
+        self.server = server
+        self.client_address = address
+        self.buffer = []
+        self.length = 0
+        # request whose body is being read
+        self.request = None
+        # (request, body) waiting for a worker, or being handled
+        self.pending = deque()
+        self.closed = False
+        # after an error, until the response is sent
+        self.closing = False
+        self.last_active = time.time()
+        self.set_terminator('\r\n\r\n')
+        server.dirty.add(self._fileno)
+
+    def readable(self):
+        # don't read more requests while there are some to handle
+        return not self.pending and asynchat.async_chat.readable(self)
+
+    def collect_incoming_data(self, data):
+        if self.closing:
+            return
+        self.last_active = time.time()
+        self.length += len(data)
+        limit = MAX_BODY if self.request else MAX_HEADER
+        if self.length > limit:
+            status = ('413 Request Entity Too Large' if self.request
+                    else '431 Request Header Fields Too Large')
+            self.error(status)
+            return
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        if self.closing:
+            return
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.length = 0
+        if self.request is None:
+            if not data.strip('\r\n'):
+                return
+            try:
+                request = parse_request(data)
+                length = body_length(request[3])
+            except BadRequest as e:
+                self.error(e.args[0])
+                return
+            if length > MAX_BODY:
+                self.error('413 Request Entity Too Large')
+                return
+            if length > 0:
+                self.request = request
+                self.set_terminator(length)
+                return
+            body = ''
+        else:
+            request, body = self.request, data
+            self.request = None
+            self.set_terminator('\r\n\r\n')
+        self.pending.append((request, body))
+        if len(self.pending) == 1:
+            self.server.submit(self)
+
+    def finish(self, response, keep):
+        """send response to the current request, called in the event
+        loop when a worker has handled it"""
+        if self.closed:
+            return
+        self.server.dirty.add(self._fileno)
+        self.pending.popleft()
+        self.last_active = time.time()
+        self.push(response)
+        if not keep:
+            self.pending.clear()
+            self.close_when_done()
+        elif self.pending:
+            self.server.submit(self)
+
+    def error(self, status):
+        """send error status and close"""
+        self.pending.clear()
+        self.request = None
+        self.buffer = []
+        # ignore anything more the client sends
+        self.closing = True
+        self.set_terminator(None)
+        self.push(format_response(status, [('Content-Type', 'text/plain')],
+            status, False, False))
+        self.close_when_done()
+
+    def idle(self, now):
+        """True if this connection has had nothing to do for longer
+        than the server's timeout"""
+        return (not self.pending and not self.producer_fifo
+                and now - self.last_active > self.server.timeout)
+
+    def handle_error(self):
+        traceback.print_exc(file=sys.stderr)
+        self.close()
+
+    def close(self):
+        self.closed = True
+        self.server.connections.discard(self)
+        self.server.dirty.add(self._fileno)
+        asynchat.async_chat.close(self)
+
+
+class Server(asyncore.dispatcher):
+    """Serves app on address (host, port). workers threads run the app,
+    at most max_connections are accepted at once, and connections are
+    closed after timeout seconds without a request"""
+    def __init__(self, app, address, workers=8, max_connections=10000,
+            timeout=60, backlog=1024):
+        self.map = {}
+        # file descriptors whose registration with epoll may be wrong
+        self.dirty = set()
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.app = app
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(backlog)
+        self.server_address = self.socket.getsockname()
+        self.connections = set()
+        # don't accept until then, after running out of file descriptors
+        self.paused_until = 0
+        self.running = False
+        self.trigger = Trigger(self.map)
+        self.jobs = Queue.Queue()
+        self.workers = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.workers.append(thread)
+
+    def readable(self):
+        return (len(self.connections) < self.max_connections
+                and time.time() >= self.paused_until)
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        # accept everyone waiting, not one per time round the loop
+        while len(self.connections) < self.max_connections:
+            try:
+                pair = self.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EMFILE, errno.ENFILE):
+                    self.paused_until = time.time() + 0.1
+                    return
+                raise
+            if pair is None:
+                return
+            sock, address = pair
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections.add(Connection(self, sock, address))
+
+    def submit(self, connection):
+        """handle the first of connection's pending requests"""
+        request, body = connection.pending[0]
+        self.jobs.put((connection, request, body))
+
+    def work(self):
+        """run the app for requests from jobs until given None"""
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            connection, request, body = job
+            environ = make_environ(request, body, self.server_address,
+                    connection.client_address)
+            status, headers, content = run_app(self.app, environ)
+            keep = keep_alive(request)
+            response = format_response(status, headers, content,
+                    request[0] == 'HEAD', keep)
+            self.trigger.pull(functools.partial(connection.finish, response,
+                keep))
+
+    def serve_forever(self):
+        """run the event loop until stop() is called"""
+        self.running = True
+        poller = select.epoll() if hasattr(select, 'epoll') else None
+        registered = {}
+        self.dirty.update(self.map)
+        last_sweep = time.time()
+        try:
+            while self.running:
+                if poller is None:
+                    asyncore.loop(timeout=SWEEP_INTERVAL, use_poll=True,
+                            map=self.map, count=1)
+                else:
+                    self.poll(poller, registered, SWEEP_INTERVAL)
+                now = time.time()
+                if now - last_sweep >= SWEEP_INTERVAL:
+                    last_sweep = now
+                    for connection in [connection for connection
+                            in self.connections if connection.idle(now)]:
+                        connection.close()
+        finally:
+            if poller is not None:
+                poller.close()
+            for dispatcher in self.map.values():
+                dispatcher.close()
+
+    def poll(self, poller, registered, timeout):
+        """update the registrations (fd -> flags) of dirty file
+        descriptors with poller (an epoll object), then wait up to
+        timeout seconds for events and handle them"""
+        # the listener stops being readable when there are too many
+        # connections, and starts again when they are closed
+        self.dirty.add(self._fileno)
+        dirty, self.dirty = self.dirty, set()
+        for fd in dirty:
+            dispatcher = self.map.get(fd)
+            flags = 0
+            if dispatcher is not None:
+                if dispatcher.readable():
+                    flags |= select.EPOLLIN | select.EPOLLPRI
+                if dispatcher.writable() and not dispatcher.accepting:
+                    flags |= select.EPOLLOUT
+            if flags:
+                flags |= select.EPOLLERR | select.EPOLLHUP
+            if registered.get(fd, 0) == flags:
+                continue
+            if flags:
+                try:
+                    poller.modify(fd, flags)
+                except IOError:
+                    # closed and reused since it was registered
+                    poller.register(fd, flags)
+                registered[fd] = flags
+            elif fd in registered:
+                try:
+                    poller.unregister(fd)
+                except (IOError, ValueError):
+                    # already closed, which unregistered it
+                    pass
+                del registered[fd]
+        try:
+            events = poller.poll(timeout)
+        except IOError as e:
+            if e.errno == errno.EINTR:
+                return
+            raise
+        for fd, flags in events:
+            dispatcher = self.map.get(fd)
+            if dispatcher is not None:
+                self.dirty.add(fd)
+                asyncore.readwrite(dispatcher, flags)
+
+    def stop(self):
+        """stop serving, and stop the workers"""
+        def stop_loop():
+            self.running = False
+        self.trigger.pull(stop_loop)
+        for _ in self.workers:
+            self.jobs.put(None)
+
+    def handle_error(self):
+        traceback.print_exc(file=sys.stderr)
+
+
+def parse_address(address):
+    """returns (host, port) for host:port"""
+    host, _, port = address.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+
+def main(argv):
+    """command line entry point: serve the app on host:port (default
+    127.0.0.1:5000)"""
+    from monomotapa import app
+    address = parse_address(argv[0] if argv else '127.0.0.1:5000')
+    server = Server(app, address, app.config['server_workers'],
+            app.config['server_max_connections'],
+            app.config['server_timeout'])
+    print("Serving on http://%s:%d/" % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
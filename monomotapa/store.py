@@ -0,0 +1,348 @@
+"""Stores that let workers share what they have cached.
+
+By default each worker's caches (see cache.py) are its own, and empty
+after a restart. Set cache_backend in config.json to put rendered
+markdown and pages in a store as well, shared by every worker on the
+host and kept across restarts:
+
+    "memory"     the default: no store, each worker caches for itself
+    "sqlite"     an SQLite database file (cache_path)
+    "memcached"  a memcached server, or anything speaking its text
+                 protocol (cache_address, host:port). If there is no
+                 memcached, python run.py cache-server runs a stand-in.
+
+Workers still keep what they use in memory, and only go to the store
+when that misses (see LRUCache.share()). Keys are hashes of what the
+value is generated from (file contents, not inodes or mtimes, see
+views.file_digest), so every worker computes the same key for the same
+output, and output from files that have changed is never found. Keys
+are also prefixed with a hash of the code, the version of markdown and
+config.json (see code_version()), so output from before a deploy is not
+found either. The store is not cleared when either changes: stale
+entries are simply never asked for again, and age out (cache_store_size
+sets the size of an SQLite store, memcached has its own limit).
+
+Errors talking to a store are treated as misses: a broken store makes
+things slower, not broken.
+"""
+import os
+import os.path
+import sys
+import json
+import time
+import socket
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import SocketServer
+
+from monomotapa.cache import LRUCache, sizeof
+from monomotapa.config import ConfigError
+
+# flags for values, so unicode comes back as unicode
+BYTES = 0
+TEXT = 1
+# only record an entry as used again after this many seconds
+TOUCH_INTERVAL = 60
+# check the size of an SQLite store after this many writes
+CHECK_EVERY = 100
+
+
+def encode(value):
+    """returns (flag, bytes) for value"""
+    if isinstance(value, unicode):
+        return TEXT, value.encode('utf-8')
+    return BYTES, value
+
+
+def decode(flag, data):
+    """returns value for (flag, bytes)"""
+    if flag == TEXT:
+        return data.decode('utf-8')
+    return data
+
+
+def code_version(config):
+    """returns hash of what output depends on other than the site's
+    files: the python code of monomotapa (and its plugins), the version
+    of markdown and config (a dictionary, e.g. from config.json)"""
+    import markdown
+    digest = hashlib.sha1()
+    package = os.path.dirname(os.path.abspath(__file__))
+    for directory in [package, os.path.join(package, 'plugins')]:
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.py'):
+                with open(os.path.join(directory, name), 'rb') as f:
+                    digest.update(name + '\0' + f.read())
+    digest.update(markdown.__version__)
+    digest.update(json.dumps(config, sort_keys=True))
+    return digest.hexdigest()[:16]
+
+
+def default_cache_path():
+    """returns path of an SQLite store in the temporary directory,
+    specific to the site in the current directory"""
+    site = hashlib.sha1(os.getcwd()).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(),
+            'monomotapa-cache-%s.sqlite' % site)
+
+
+class SQLiteStore(object):
+    """Values in an SQLite database, shared by every process using the
+    file. Least recently used entries are deleted once the values add
+    up to more than max_bytes."""
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self.writes = 0
+        self.errors = 0
+
+    def connection(self):
+        """returns this thread's connection, creating the table if
+        need be"""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5,
+                    isolation_level=None)
+            connection.text_factory = str
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS cache '
+                    '(key TEXT PRIMARY KEY, value BLOB, flag INTEGER, '
+                    'size INTEGER, used REAL)')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def get(self, key):
+        """returns value for key, or None"""
+        try:
+            connection = self.connection()
+            row = connection.execute('SELECT value, flag, used FROM cache '
+                    'WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if now - row[2] > TOUCH_INTERVAL:
+                connection.execute('UPDATE cache SET used = ? '
+                        'WHERE key = ?', (now, key))
+            return decode(row[1], str(row[0]))
+        except sqlite3.Error:
+            self.errors += 1
+            return None
+
+    def set(self, key, value):
+        """store value as key"""
+        flag, data = encode(value)
+        if len(data) > self.max_bytes:
+            return
+        try:
+            connection = self.connection()
+            connection.execute('INSERT OR REPLACE INTO cache '
+                    '(key, value, flag, size, used) VALUES (?, ?, ?, ?, ?)',
+                    (key, sqlite3.Binary(data), flag, len(data), time.time()))
+            self.writes += 1
+            if self.writes % CHECK_EVERY == 1:
+                self.evict(connection)
+        except sqlite3.Error:
+            self.errors += 1
+
+    def evict(self, connection):
+        """delete least recently used entries until the rest fit"""
+        total = connection.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        keys = []
+        for key, size in connection.execute(
+                'SELECT key, size FROM cache ORDER BY used'):
+            keys.append((key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+        connection.executemany('DELETE FROM cache WHERE key = ?', keys)
+
+    def clear(self):
+        """delete everything"""
+        try:
+            self.connection().execute('DELETE FROM cache')
+        except sqlite3.Error:
+            self.errors += 1
+
+
+class MemcachedStore(object):
+    """Values in a memcached server (or anything speaking its text
+    protocol) at address, (host, port)"""
+    def __init__(self, address, timeout=1.0):
+        self.address = address
+        self.timeout = timeout
+        self.local = threading.local()
+        self.errors = 0
+
+    def connection(self):
+        """returns this thread's (file like) connection"""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            sock = socket.create_connection(self.address, self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = sock.makefile('rwb')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def disconnect(self):
+        """drop this thread's connection, after an error"""
+        self.errors += 1
+        connection = getattr(self.local, 'connection', None)
+        self.local.connection = None
+        if connection is not None:
+            try:
+                connection.close()
+            except socket.error:
+                pass
+
+    def get(self, key):
+        """returns value for key, or None"""
+        try:
+            connection = self.connection()
+            connection.write('get %s\r\n' % key)
+            connection.flush()
+            line = connection.readline()
+            if line.startswith('VALUE '):
+                _, _, flag, length = line.split()
+                data = connection.read(int(length) + 2)[:-2]
+                line = connection.readline()
+                if line == 'END\r\n':
+                    return decode(int(flag), data)
+            if line != 'END\r\n':
+                self.disconnect()
+            return None
+        except (socket.error, ValueError):
+            self.disconnect()
+            return None
+
+    def set(self, key, value):
+        """store value as key"""
+        flag, data = encode(value)
+        try:
+            connection = self.connection()
+            connection.write('set %s %d 0 %d\r\n%s\r\n'
+                    % (key, flag, len(data), data))
+            connection.flush()
+            if connection.readline() != 'STORED\r\n':
+                self.disconnect()
+        except socket.error:
+            self.disconnect()
+
+    def clear(self):
+        """delete everything"""
+        try:
+            connection = self.connection()
+            connection.write('flush_all\r\n')
+            connection.flush()
+            connection.readline()
+        except socket.error:
+            self.disconnect()
+
+
+def parse_address(address):
+    """returns (host, port) for host:port"""
+    host, _, port = address.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+
+def make_store(backend, path=None, address=None, max_bytes=None):
+    """returns store for backend (sqlite or memcached), None for memory.
+    Raises ConfigError for anything else"""
+    if backend == 'memory':
+        return None
+    elif backend == 'sqlite':
+        return SQLiteStore(path or default_cache_path(),
+                max_bytes or 256 * 1024 * 1024)
+    elif backend == 'memcached':
+        return MemcachedStore(parse_address(address or '127.0.0.1:11211'))
+    raise ConfigError("unknown cache_backend %s" % backend)
+
+
+# stand in memcached server
+
+class MemcachedHandler(SocketServer.StreamRequestHandler):
+    """handles get, set, delete, flush_all and version commands,
+    storing values in the server's LRUCache"""
+    def handle(self):
+        cache = self.server.cache
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.split()
+            if not parts:
+                continue
+            command = parts[0]
+            if command in ('get', 'gets'):
+                for key in parts[1:]:
+                    value = cache.get(key)
+                    if value is not None:
+                        flag, data = value
+                        self.wfile.write('VALUE %s %s %d\r\n%s\r\n'
+                                % (key, flag, len(data), data))
+                self.wfile.write('END\r\n')
+            elif command == 'set' and len(parts) >= 5:
+                data = self.rfile.read(int(parts[4]) + 2)[:-2]
+                cache.set(parts[1], (parts[2], data))
+                if parts[-1] != 'noreply':
+                    self.wfile.write('STORED\r\n')
+            elif command == 'delete' and len(parts) >= 2:
+                found = cache.get(parts[1]) is not None
+                cache.discard(lambda key: key == parts[1])
+                self.wfile.write('DELETED\r\n' if found else 'NOT_FOUND\r\n')
+            elif command == 'flush_all':
+                cache.clear()
+                self.wfile.write('OK\r\n')
+            elif command == 'version':
+                self.wfile.write('VERSION monomotapa\r\n')
+            elif command == 'quit':
+                return
+            else:
+                self.wfile.write('ERROR\r\n')
+            self.wfile.flush()
+
+
+class StoredValues(LRUCache):
+    """LRUCache of (flag, data) values"""
+    def set(self, key, value):
+        flag, data = value
+        size = sizeof(data)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            self._evict()
+
+
+class MemcachedServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """A stand in for memcached, holding up to max_bytes"""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, max_bytes):
+        SocketServer.TCPServer.__init__(self, address, MemcachedHandler)
+        self.cache = StoredValues(max_bytes)
+
+
+def main(argv):
+    """command line entry point: run the stand in server on
+    host:port (default 127.0.0.1:11211)"""
+    address = parse_address(argv[0] if argv else '127.0.0.1:11211')
+    server = MemcachedServer(address, 256 * 1024 * 1024)
+    print("Serving a memcached stand in on %s:%d" % server.server_address)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,134 @@
+"""Runs the unit tests in the background for /unit-tests.
+
+Only one run happens at a time: while the tests are running every caller
+sees the same run (and its output so far). The result of a run is kept
+until the code it tested changes, so repeated requests do not start
+new runs."""
+import os
+import os.path
+import sys
+import time
+import threading
+
+# files with these extensions count as code when deciding if a result
+# is out of date
+CODE_EXTENSIONS = ('.py', '.html')
+
+
+def code_signature(sources):
+    """returns tuple of (path, size, mtime) for files in sources
+    (files or directories, whose code files, but not subdirectories,
+    are included)"""
+    signature = []
+    for source in sources:
+        if os.path.isdir(source):
+            paths = [os.path.join(source, filename)
+                    for filename in os.listdir(source)
+                    if filename.endswith(CODE_EXTENSIONS)]
+        else:
+            paths = [source]
+        for path in sorted(paths):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            signature.append((path, st.st_size, st.st_mtime))
+    return tuple(signature)
+
+
+class TestRunner(object):
+    """Runs command in a background thread, capturing its output"""
+    def __init__(self, command, sources):
+        self.command = command
+        self.sources = sources
+        self.lock = threading.Lock()
+        self.running = False
+        self.output = ''
+        self.returncode = None
+        self.signature = None
+        self.started = None
+        self.finished = None
+
+    def current_signature(self):
+        """returns code_signature() of sources as they are now"""
+        return code_signature(self.sources)
+
+    def status(self, signature=None):
+        """returns dict describing current (or last) run.
+        state is one of idle, running, finished or stale (finished,
+        but the code has changed since). signature, if given, is
+        current_signature(), to save working it out again"""
+        if signature is None:
+            signature = self.current_signature()
+        with self.lock:
+            if self.running:
+                state = 'running'
+            elif self.finished is None:
+                state = 'idle'
+            elif self.signature != signature:
+                state = 'stale'
+            else:
+                state = 'finished'
+            return {'state' : state, 'output' : self.output,
+                    'returncode' : self.returncode,
+                    'passed' : self.returncode == 0,
+                    'started' : self.started, 'finished' : self.finished}
+
+    def start(self, signature=None):
+        """start a run unless one is already going, or the last result
+        is still valid. Returns True if a new run was started.
+        signature is as for status()"""
+        with self.lock:
+            if self.running:
+                return False
+            if signature is None:
+                signature = self.current_signature()
+            if self.finished is not None and self.signature == signature:
+                return False
+            self.running = True
+            self.signature = signature
+            self.output = ''
+            self.returncode = None
+            self.started = time.time()
+            self.finished = None
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _run(self):
+        """run command, collecting output as it is written"""
+        # only needed here, so not imported with the rest of the app
+        import subprocess
+        try:
+            process = subprocess.Popen(self.command,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            while True:
+                chunk = os.read(process.stdout.fileno(), 4096)
+                if not chunk:
+                    break
+                with self.lock:
+                    self.output += chunk.decode('utf-8', 'replace')
+            returncode = process.wait()
+        except OSError as e:
+            with self.lock:
+                self.output += str(e)
+            returncode = -1
+        with self.lock:
+            self.returncode = returncode
+            self.finished = time.time()
+            self.running = False
+
+    def wait(self, timeout=None):
+        """block until the current run finishes, returns status()"""
+        start = time.time()
+        while self.running:
+            if timeout is not None and time.time() - start > timeout:
+                break
+            time.sleep(0.05)
+        return self.status()
+
+
+runner = TestRunner([sys.executable, 'tests.py'], ['tests.py', 'monomotapa',
+    os.path.join('monomotapa', 'plugins'),
+    os.path.join('monomotapa', 'templates')])
@@ -47,22 +47,66 @@ paulmunday, or something similar,  as that would be strange.
 """
 
 
-from flask import render_template, abort, Markup, escape, request #, make_response
-
-from pygments import highlight
-from pygments.lexers import PythonLexer, HtmlDjangoLexer, TextLexer
-from pygments.formatters import HtmlFormatter
+from flask import render_template, abort, Markup, escape, request
+from flask import make_response, jsonify, url_for, stream_with_context
+from flask import send_file
+from flask.helpers import safe_join
+from werkzeug.exceptions import HTTPException
 
 import markdown
 
 import os.path
 import os
-import subprocess
+import re
+import hashlib
 import json
+from datetime import datetime
 from collections import OrderedDict
 
 from monomotapa import app
 from monomotapa.config import ConfigError
+from monomotapa.metadata import registry
+from monomotapa.cache import LRUCache
+from monomotapa.testrunner import runner
+from monomotapa.frontmatter import FrontMatterIndex, PageAttributes
+from monomotapa.frontmatter import split_front_matter
+from monomotapa.posts import PostIndex, paginate
+from monomotapa.routes import RouteIndex
+from monomotapa.plugin import plugin_index
+from monomotapa.metrics import metrics
+from monomotapa import assets
+from monomotapa.compression import Compressor
+from monomotapa.watcher import watcher
+from monomotapa.search import SearchIndex, read_text, snippet, tokenize
+
+# rendered markdown, keyed on (digest of the source, trusted).
+# Size is set from markdown_cache_size in config.json
+markdown_cache = LRUCache(16 * 1024 * 1024)
+# whole pages, keyed on the etag derived from their inputs.
+# Size is set from page_cache_size in config.json
+page_cache = LRUCache(32 * 1024 * 1024)
+# both are shared with other workers if cache_backend is set
+# in config.json, see store.py
+# highlighted source, keyed on (path, size, mtime, lexer, style).
+# Size is set from pygments_cache_size in config.json
+pygments_cache = LRUCache(8 * 1024 * 1024)
+# compresses responses, caching compressed pages in page_cache.
+# Installed (and configured) unless enable_compression is false
+compressor = Compressor(page_cache)
+
+# front matter of markdown files in src/, built at startup
+frontmatter_index = FrontMatterIndex(os.path.join('monomotapa', 'src'))
+# posts sorted by date, for listings. The interval new files are 
+# checked for is set from index_check_interval in config.json
+post_index = PostIndex(frontmatter_index, 
+        lambda: get_page_attributes('pages.json'))
+# pages served from markdown, so unknown ones are turned away cheaply
+route_index = RouteIndex(frontmatter_index,
+        lambda: get_page_attributes('pages.json'))
+# full text search. The file is set from search_index_file
+# in config.json, and loaded at startup
+search_index = SearchIndex(os.path.join('monomotapa', 'search.idx'),
+        frontmatter_index, lambda: get_page_attributes('pages.json'))
 
 class MonomotapaError(Exception):
     """create classs for own errors"""
@@ -74,10 +118,12 @@ def get_page_attributes(jsonfile):
     N.B. static pages do not need to have attributes defined there,
     it is sufficient to have a page.md in src for each /page 
     possible values are src (name of markdown file to be rendered)
-    heading, title, and trusted (i.e. allow embeded html in markdown)"""
+    heading, title, and trusted (i.e. allow embeded html in markdown)
+    These may also be set as front matter in the markdown (see frontmatter.py)
+    The json is held in memory by the metadata registry and only 
+    re-read when the file changes, so treat the result as read only."""
     try:
-        with open(src_file(jsonfile), 'r') as pagesfile:
-            page_attributes = json.load(pagesfile)
+        page_attributes = registry.get(src_file(jsonfile))
     except IOError:
         page_attributes = []
     return page_attributes
@@ -111,86 +157,212 @@ def top_navigation(page):
     generated with url_for(urlfor). url takes precendence so it makes
     no sense to supply both.
     Web Sign-in is supported by adding a "rel": "me" attribute.
+    The OrderedDict is only rebuilt when navigation.json changes, so
+    treat it as read only. 'html' is the navigation rendered as html,
+    see NavigationHTML.
     """
-    with open(src_file('navigation.json'), 'r') as  navfile:
-        navigation = json.load(navfile)
-    base_nav = OrderedDict({})
-    for key in navigation["nav_order"]:
-        nav = {}
-        nav['base'] = key
-        nav['link_text'] = key
-        if key in navigation["nav_elements"]:
-            elements = navigation["nav_elements"][key]
-            nav.update(elements)
-        base_nav[key] = nav
-    return {'navigation' :  base_nav, 'page' : page}
+    navigation = registry.get(src_file('navigation.json'))
+    cached = navigation_cache.get('elements')
+    if cached and cached[0] is navigation:
+        base_nav = cached[1]
+    else:
+        base_nav = OrderedDict({})
+        for key in navigation["nav_order"]:
+            nav = {}
+            nav['base'] = key
+            nav['link_text'] = key
+            if key in navigation["nav_elements"]:
+                elements = navigation["nav_elements"][key]
+                nav.update(elements)
+            base_nav[key] = nav
+        navigation_cache['elements'] = (navigation, base_nav)
+    return {'navigation' :  base_nav, 'page' : page, 
+            'html' : NavigationHTML(page)}
+
+
+# stands in for the current page when navigation is rendered
+NAVIGATION_PAGE = '__monomotapa_page__'
+# (navigation.json, OrderedDict) and
+# (navigation.json, script root, state of templates, html)
+navigation_cache = {}
+
+def navigation_templates():
+    """returns paths of the templates navigation is rendered from.
+    Not part of any page's extends chain, so pages list these as
+    dependencies too."""
+    return [src_file(template, 'templates')
+            for template in template_chain('navigation.html')]
+
+class NavigationHTML(object):
+    """The navigation as html (from navigation.html), rendered when
+    used in a template. The html is only rendered once, when 
+    navigation.json changes, with a placeholder for the current page,
+    so all that is done per page is to fill in the link to its source.
+    It is rendered again when navigation.json or the templates change."""
+    def __init__(self, page):
+        self.page = page
+
+    def __html__(self):
+        navigation = registry.get(src_file('navigation.json'))
+        templates = file_signature(navigation_templates())
+        cached = navigation_cache.get('html')
+        if (cached and cached[0] is navigation 
+                and cached[1] == request.script_root
+                and cached[2] == templates):
+            html = cached[3]
+        else:
+            html = render_template('navigation.html', 
+                    navigation = top_navigation(NAVIGATION_PAGE))
+            navigation_cache['html'] = (navigation, request.script_root,
+                    templates, html)
+        return html.replace(
+                escape(url_for('source', page=NAVIGATION_PAGE)),
+                escape(url_for('source', page=self.page)))
+
+    def __unicode__(self):
+        return self.__html__()
 
 
 # For pages
+class PageConfig(object):
+    """The configuration of a page: defaults.json, pages.json (merged 
+    with front matter) and any arguments given to Page, combined.
+    As this is the same for every request for the page it is worked 
+    out once (see page_config) and shared, so it is immutable.
+    context holds every attribute, for templates, so treat it as 
+    read only."""
+    __slots__ = ['name', 'title', 'heading', 'template', 'default_template',
+            'src', 'css', 'hlinks', 'trusted', 'stream', 'context']
+
+    def __init__(self, **values):
+        for slot in self.__slots__:
+            object.__setattr__(self, slot, values.get(slot))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PageConfig is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("PageConfig is immutable")
+
+
+def compile_page_config(page, kwargs, defaults, pages, default_title):
+    """returns PageConfig for page. 
+    If css is supplied it will overide any default css. To add additional
+    style sheets on a per page basis specifiy them in pages.json.
+    The same also applies with hlinks.
+    css is used to set locally hosted stylesheets only. To specify 
+    external stylesheets use hlinks: in config.json for 
+    default values that will apply on all pages unless overidden, set here
+    to override the default. Set in pages.json to add after default."""
+    try:
+        default_template = defaults['template']
+    except KeyError:
+        raise ConfigError('template not found in default.json')
+    entry = pages.get(page) or {}
+    # the defaults
+    attributes = {'name' : page, 'title' : page.lower(),
+            'heading' : page.capitalize(), 'footer' : None,
+            'css' : None , 'hlinks' :None, 'internal_css' : None,
+            'trusted': False, 'stream' : False}
+    # set from defaults
+    attributes.update(defaults)
+    # override with kwargs
+    attributes.update(kwargs)
+    # override attributes if set in pages.json
+    attributes.update(entry)
+    # reset these as we want to append rather than overwrite if supplied
+    css = kwargs.get('css', defaults.get('css'))
+    hlinks = kwargs.get('hlinks', defaults.get('hlinks'))
+    # append hlinks and css from pages.json rather than overwriting
+    # if css or hlinks are not supplied they are set to default
+    if 'css' in entry:
+        css = (css or []) + entry['css']
+    if 'hlinks' in entry:
+        hlinks = (hlinks or []) + entry['hlinks']
+    attributes['css'] = css
+    attributes['hlinks'] = hlinks
+    # append heading to default if set in config
+    if default_title:
+        attributes['title'] = default_title + attributes['title']
+    attributes['default_template'] = default_template
+    return PageConfig(name = attributes['name'], title = attributes['title'],
+            heading = attributes['heading'], 
+            template = entry.get('template'),
+            default_template = default_template, src = entry.get('src'),
+            css = css, hlinks = hlinks, trusted = attributes['trusted'],
+            stream = attributes['stream'], context = attributes)
+
+
+# (page, kwargs) -> (defaults.json, pages.json, front matter version,
+# default_title, PageConfig)
+page_configs = {}
+# forget them all once there are this many
+MAX_PAGE_CONFIGS = 10000
+
+def page_config(page, kwargs=None):
+    """returns PageConfig for page (and kwargs), only compiled again 
+    when defaults.json, pages.json or the front matter change"""
+    defaults = get_page_attributes('defaults.json')
+    pages = get_page_attributes('pages.json')
+    # re-read the page's front matter if its file has changed
+    try:
+        frontmatter_index.get(pages[page]['src'])
+    except (KeyError, TypeError):
+        frontmatter_index.get(page + '.md')
+    version = frontmatter_index.version
+    default_title = app.config['default_title']
+    key = (page, tuple(sorted(kwargs.items())) if kwargs else ())
+    try:
+        cached = page_configs.get(key)
+    except TypeError:
+        # unhashable arguments, can't be cached
+        key = cached = None
+    if (cached and cached[0] is defaults and cached[1] is pages
+            and cached[2] == version and cached[3] == default_title):
+        return cached[4]
+    config = compile_page_config(page, kwargs or {}, defaults, 
+            PageAttributes(pages, frontmatter_index), default_title)
+    if key is not None:
+        if len(page_configs) >= MAX_PAGE_CONFIGS:
+            page_configs.clear()
+        page_configs[key] = (defaults, pages, version, default_title, 
+                config)
+    return config
+
+
 class Page:
     """Generates  pages as objects"""
     def __init__(self, page, **kwargs):
         """Define attributes for  pages (if present).
         Sets self.name, self.title, self.heading, self.trusted etc
-        This is done through indirection so we can update the defaults 
-        (defined  in the 'attributes' dictionary) with values from config.json
-        or pages.json easily without lots of if else statements.
-        If css is supplied it will overide any default css. To add additional
-        style sheets on a per page basis specifiy them in pages.json.
-        The same also applies with hlinks.
-        css is used to set locally hosted stylesheets only. To specify 
-        external stylesheets use hlinks: in config.json for 
-        default values that will apply on all pages unless overidden, set here
-        to override the default. Set in pages.json to add after default.
+        from its PageConfig (see compile_page_config), which is
+        looked up rather than worked out on every request.
         """
-        # set default attributes
         self.page = page.rstrip('/')
-        self.defaults = get_page_attributes('defaults.json')
-        self.pages = get_page_attributes('pages.json')
-        title = page.lower()
-        heading = page.capitalize()
+        self.config = page_config(self.page, kwargs)
+        self.default_template = self.config.default_template
+        self.navigation = top_navigation(self.page)
+        self.plugins = None
+
+    def __getattr__(self, name):
+        """attributes of the page, e.g. self.title, from its config"""
+        if name == 'config':
+            raise AttributeError(name)
         try:
-            self.default_template = self.defaults['template']
+            return self.config.context[name]
         except KeyError:
-            raise ConfigError('template not found in default.json')
-        # will become self.name, self.title, self.heading, 
-        # self.footer, self.internal_css, self.trusted
-        attributes = {'name' : self.page, 'title' : title,
-                'navigation' : top_navigation(self.page),
-                'heading' : heading, 'footer' : None,
-                'css' : None , 'hlinks' :None, 'internal_css' : None,
-                'trusted': False}
-        # set from defaults
-        attributes.update(self.defaults)
-        # override with kwargs
-        attributes.update(kwargs)
-        # override attributes if set in pages.json
-        if page in self.pages:
-            attributes.update(self.pages[page])
-        # set attributes (as self.name etc)  using indirection
-        for attribute, value in attributes.iteritems():
-            setattr(self, attribute, value)
-            setattr(self,attribute, value)
-        # reset these as we want to append rather than overwrite if supplied
-        if 'css' in kwargs:
-            self.css = kwargs['css']
-        elif 'css' in self.defaults:
-            self.css = self.defaults['css']
-        if 'hlinks' in kwargs:
-            self.hlinks = kwargs['hlinks']
-        elif 'hlinks' in self.defaults:
-            self.hlinks = self.defaults['hlinks']
-        # append hlinks and css from pages.json rather than overwriting
-        # if css or hlinks are not supplied they are set to default
-        if page in self.pages:
-            if 'css' in self.pages[page]:
-                self.css = self.css + self.pages[page]['css']
-            if 'hlinks' in self.pages[page]:
-                self.hlinks = self.hlinks + self.pages[page]['hlinks']
-        # append heading to default if set in config
-        if app.config['default_title']:
-            self.title = app.config['default_title'] + self.title
+            raise AttributeError(name)
 
+    def template_context(self):
+        """returns dictionary of values for templates: the page's
+        attributes, navigation and the output of any plugins"""
+        context = dict(self.config.context)
+        context['page'] = self.page
+        context['navigation'] = self.navigation
+        # output of any plugins enabled for this page, see plugin.py
+        self.plugins = plugin_index.output(self.page, context)
+        context['plugins'] = self.plugins
+        return context
 
     def _get_markdown(self):
         """returns rendered markdown or 404 if source does not exist"""
@@ -198,7 +370,7 @@ class Page:
         if src is None:
             abort(404)
         else:
-            return render_markdown(src, self.trusted)
+            return render_markdown(src, self.config.trusted)
 
     def get_page_src(self, page, directory=None, ext=None):
         """"return path of file (used to generate page) if it exists,
@@ -208,20 +380,37 @@ class Page:
         It will optionally add an extension, to allow 
         specifiying pages by route."""
         # is it stored in a config
-        pagename = get_page_attribute(self.pages, page, 'src')
+        if page == self.page:
+            pagename = self.config.src
+        else:
+            pagename = page_config(page).src
         if not pagename:
             pagename = page + get_extension(ext)
-        if os.path.exists(src_file(pagename , directory)):
+        if directory == 'src':
+            # avoid a separate stat, the front matter index checks
+            exists = frontmatter_index.exists(pagename)
+        else:
+            exists = watcher.signature(
+                    src_file(pagename , directory)) is not None
+        if exists:
             return src_file(pagename, directory)
         else:
             return None
 
     def get_template(self, page):
         """returns the template for the page"""
-        pagetemplate = get_page_attribute(self.pages, page, 'template')
+        if page == self.page:
+            pagetemplate = self.config.template
+        else:
+            pagetemplate = page_config(page).template
         if not pagetemplate:
             pagetemplate = self.default_template
-        if os.path.exists(src_file(pagetemplate , 'templates')):
+        # templates found at startup are known to exist, only
+        # check the disk for ones added since
+        if pagetemplate in known_templates:
+            return pagetemplate
+        elif os.path.exists(src_file(pagetemplate , 'templates')):
+            known_templates.add(pagetemplate)
             return pagetemplate
         else:
             raise MonomotapaError("Template: %s not found" % pagetemplate)
@@ -233,12 +422,140 @@ class Page:
         N.B. See note above in about headers"""
         if not contents:
             contents = self._get_markdown()
+        elif not isinstance(contents, basestring):
+            # sections, as used by stream_page
+            contents = ''.join(contents)
         template = self.get_template(self.page)
         return render_template(template, 
                 contents = Markup(contents),
-                **vars(self)
+                **self.template_context()
                 )
 
+    def stream_page(self, contents=None):
+        """Like generate_page but returns a generator, so the page can
+        be sent as it is rendered. Everything before the contents 
+        (i.e. head, navigation and heading) is sent before the contents
+        are rendered, then each section of the contents as it is ready.
+        contents may be an iterable of sections. 
+        Set "stream": true for a page in pages.json to use this."""
+        if contents is None:
+            contents = self._markdown_sections()
+        elif isinstance(contents, basestring):
+            contents = [contents]
+        template = app.jinja_env.get_template(self.get_template(self.page))
+        context = self.template_context()
+        context['contents'] = Markup(STREAM_MARKER)
+        app.update_template_context(context)
+        return stream_sections(template.generate(context), contents)
+
+    def _markdown_sections(self):
+        """rendered markdown, as a generator so it is rendered lazily"""
+        yield self._get_markdown()
+
+    def get_dependencies(self, page=None):
+        """returns list of files a page is generated from:
+        its markdown source (if any), the chain of templates used
+        to render it and the navigation, the json files in which it is
+        configured, plugin.json and the static assets manifest."""
+        if page is None:
+            page = self.page
+        dependencies = []
+        src = self.get_page_src(page, 'src', 'md')
+        if src:
+            dependencies.append(src)
+        for template in template_chain(self.get_template(page)):
+            dependencies.append(src_file(template, 'templates'))
+        dependencies.extend(navigation_templates())
+        for jsonfile in ['defaults.json', 'pages.json', 'navigation.json']:
+            dependencies.append(src_file(jsonfile))
+        if plugin_index.path:
+            dependencies.append(plugin_index.path)
+        # urls of static files come from here
+        dependencies.append(assets.manifest_path(app.static_folder))
+        return dependencies
+
+    def cached_page(self, contents=None, dependencies=None, version=None):
+        """Like generate_page but returns a response with ETag and
+        Last-Modified headers, derived from the files the page depends on.
+        Conditional requests for unchanged pages get a 304 without
+        anything being rendered, otherwise the body comes from the 
+        page cache if possible.
+        contents, if supplied, should be a function returning the 
+        page contents, dependencies the files they are generated from
+        (in addition to those returned by get_dependencies).
+        version, if supplied, should change whenever anything else
+        the contents are generated from does (then only the ETag is
+        used to validate requests, see conditional_response).
+        Pages using plugins that aren't cacheable are rendered for
+        every request, without an ETag."""
+        if contents is None and self.get_page_src(
+                self.page, 'src', 'md') is None:
+            abort(404)
+        if not plugin_index.cacheable(self.page):
+            if self.config.stream:
+                return app.response_class(stream_with_context(
+                    self.stream_page(contents and contents())))
+            return make_response(self.generate_page(contents and contents()))
+        files = self.get_dependencies()
+        if dependencies:
+            files = dependencies + files
+        key = (request.full_path, app.config['default_title'],
+                app.config['enable_unit_tests'], version)
+        if self.config.stream:
+            stream = lambda: self.stream_page(contents and contents())
+        else:
+            stream = None
+        return conditional_response(key, files,
+                lambda: self.generate_page(contents and contents()),
+                stream = stream, versioned = version is not None)
+
+# templates, see precompile_templates
+known_templates = set()
+
+def precompile_templates():
+    """Load (so compile) every template, so this is not done on first
+    use. With a bytecode cache (see template_cache_dir in config.json)
+    the compiled code is shared by every worker and survives restarts,
+    so the templates are only compiled from source when they change.
+    Also records the templates that exist, in known_templates.
+    Returns list of templates loaded."""
+    templates = app.jinja_env.list_templates()
+    for template in templates:
+        app.jinja_env.get_template(template)
+    known_templates.update(templates)
+    return templates
+
+def preload():
+    """Do the work of the first requests before serving any: load the
+    json, compile the templates, build the indexes and render every
+    page into the page cache (compressed too, if compression is on).
+    Set preload to true in config.json to do this at startup.
+    Returns list of pages rendered."""
+    for jsonfile in ['defaults.json', 'pages.json', 'navigation.json']:
+        get_page_attributes(jsonfile)
+    precompile_templates()
+    frontmatter_index.scan()
+    route_index.update()
+    post_index.update()
+    search_index.update()
+    rendered = []
+    for page in sorted(route_index.valid):
+        # as it would be from the url, so the cache key is the same
+        page = page.decode('utf-8') if isinstance(page, str) else page
+        path = '/' if page == 'index' else '/' + page
+        with app.test_request_context(path, 
+                headers={'Accept-Encoding' : 'gzip'}):
+            try:
+                response = Page(page).cached_page()
+            except (HTTPException, MonomotapaError):
+                continue
+            # streamed pages are cached once they have been sent
+            response.get_data()
+            if app.config['enable_compression']:
+                compressor.process(response)
+        rendered.append(page)
+    return rendered
+
 # helper functions
 def src_file(name, directory=None):
     """return potential path to file in this app"""
@@ -248,6 +565,160 @@ def src_file(name, directory=None):
         return os.path.join('monomotapa', directory, name)
 
 
+# {% extends "base.html" %}
+EXTENDS = re.compile(r"""{%-?\s*extends\s+["']([^"']+)["']""")
+# template -> (mtime, template it extends)
+template_parents = {}
+
+def template_chain(template):
+    """returns list of templates used to render template,
+    e.g. ['post.html', 'base.html']"""
+    chain = []
+    while template and template not in chain:
+        chain.append(template)
+        path = src_file(template, 'templates')
+        signature = watcher.signature(path)
+        if signature is None:
+            break
+        mtime = signature[2]
+        cached = template_parents.get(template)
+        if cached and cached[0] == mtime:
+            template = cached[1]
+        else:
+            with open(path, 'r') as f:
+                match = EXTENDS.search(f.read())
+            parent = match.group(1) if match else None
+            template_parents[template] = (mtime, parent)
+            template = parent
+    return chain
+
+
+def file_signature(files):
+    """returns tuple of (path, inode, size, mtime) for files,
+    (path, None, None, None) for any that are missing"""
+    signature = []
+    for path in files:
+        state = watcher.signature(path)
+        if state is None:
+            signature.append((path, None, None, None))
+        else:
+            signature.append((path,) + state)
+    return tuple(signature)
+
+
+# path -> ((inode, size, mtime), sha1 of contents)
+file_digests = {}
+
+def file_digest(path, signature=None):
+    """returns sha1 hex digest of the contents of path, or None if it
+    does not exist. Only read again when its signature changes"""
+    if signature is None:
+        signature = watcher.signature(path)
+        if signature is None:
+            return None
+    cached = file_digests.get(path)
+    if cached and cached[0] == signature:
+        return cached[1]
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(65536), ''):
+                digest.update(block)
+    except IOError:
+        return None
+    digest = digest.hexdigest()
+    file_digests[path] = (signature, digest)
+    return digest
+
+
+def conditional_response(key, files, render, mimetype=None, stream=None,
+        versioned=False):
+    """returns response for a page generated by render() from files.
+    The (strong) ETag is a hash of key and the contents of files, so
+    is the same in every worker, and across restarts, until they
+    change. Last-Modified is that of the newest file. Requests whose 
+    If-None-Match/If-Modified-Since headers match get a 304 
+    without render being called, otherwise the page is served from
+    page_cache, or rendered and cached. If stream is supplied it 
+    should return a generator, which is used (and cached) instead of
+    render.
+    versioned should be true if key includes a version of something
+    other than files (e.g. which posts there are): Last-Modified can't
+    show when that changes, so If-Modified-Since is ignored."""
+    signature = file_signature(files)
+    contents = tuple((sig[0], sig[1] and file_digest(sig[0], sig[1:]))
+            for sig in signature)
+    etag = hashlib.sha1(repr((key, contents))).hexdigest()
+    mtimes = [sig[3] for sig in signature if sig[3] is not None]
+    last_modified = datetime.utcfromtimestamp(int(max(mtimes or [0])))
+    if request.if_none_match:
+        # weak, as compressed responses have a weak etag
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        not_modified = (not versioned
+                and request.if_modified_since is not None
+                and last_modified <= request.if_modified_since)
+    if not_modified:
+        response = app.response_class(status=304)
+    else:
+        body = page_cache.get(etag)
+        if body is None and stream is not None:
+            response = app.response_class(
+                    stream_with_context(cache_stream(etag, stream())))
+        else:
+            if body is None:
+                body = render()
+                page_cache.set(etag, body)
+            response = make_response(body)
+    if mimetype:
+        response.mimetype = mimetype
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return response
+
+
+# stands in for the contents of a page when it is streamed
+STREAM_MARKER = '<!--monomotapa:contents-->'
+# send output in chunks of at least this size, other than the head
+STREAM_BUFFER = 8192
+
+def stream_sections(generator, contents):
+    """yields output of a template generator, buffered, with the 
+    sections in contents rendered in place of STREAM_MARKER.
+    Everything before the marker is sent before the first section
+    is rendered."""
+    buffered = []
+    length = 0
+    for chunk in generator:
+        if STREAM_MARKER in chunk:
+            before, after = chunk.split(STREAM_MARKER, 1)
+            buffered.append(before)
+            yield ''.join(buffered)
+            for section in contents:
+                yield section
+            buffered = [after]
+            length = len(after)
+            continue
+        buffered.append(chunk)
+        length += len(chunk)
+        if length >= STREAM_BUFFER:
+            yield ''.join(buffered)
+            buffered = []
+            length = 0
+    if buffered:
+        yield ''.join(buffered)
+
+
+def cache_stream(key, generator):
+    """yields from generator, adding what it yields to page_cache
+    as key when it is finished"""
+    chunks = []
+    for chunk in generator:
+        chunks.append(chunk)
+        yield chunk
+    page_cache.set(key, ''.join(chunks))
+
+
 def get_extension(ext):
     '''constructs extension, adding or stripping leading . as needed.
     Return null string for None'''
@@ -262,40 +733,111 @@ def render_markdown(srcfile, trusted=False):
     """Return markdown file rendered as html. Defaults to untrusted:
         html characters (and character entities) are escaped 
         so will not be rendered. This departs from markdown spec 
-        which allows embedded html."""
+        which allows embedded html.
+        Rendered html is cached until the source file changes."""
+    digest = file_digest(srcfile)
+    if digest is None:
+        return None
+    key = (digest, trusted == True)
+    html = markdown_cache.get(key)
+    if html is not None:
+        return html
     try:
         with open(srcfile, 'r') as f:
             src = f.read()
             src = src.decode('utf-8')
+            front_matter, src = split_front_matter(src)
             if trusted == True:
-                return markdown.markdown(src)
+                html = markdown.markdown(src)
             else:
-                return markdown.markdown(escape(src))
+                html = markdown.markdown(escape(src))
     except IOError:
         return None
+    markdown_cache.set(key, html)
+    return html
 
-def render_pygments(srcfile, lexer_type):
-    """returns src(file) marked up with pygments"""
-    if lexer_type == 'python':
-        with open(srcfile, 'r') as f:
-            src = f.read()
-            contents = highlight(src, PythonLexer(), HtmlFormatter())
-    elif lexer_type == 'html':
-        with open(srcfile, 'r') as f:
-            src = f.read()
-            contents = highlight(src, HtmlDjangoLexer(), HtmlFormatter())
-    # default to TextLexer for everything else
+# pygments is only needed for /source and /unit-tests so it is 
+# imported when first used, not by every worker at startup.
+# lexer type -> name of pygments lexer, TextLexer for everything else
+LEXERS = {'python' : 'PythonLexer', 'html' : 'HtmlDjangoLexer'}
+DEFAULT_LEXER = 'TextLexer'
+FORMATTER_STYLE = 'default'
+# lexers and formatter are reused rather than created per call,
+# lexer name (or 'formatter') -> object
+pygments_objects = {}
+# style -> css
+pygments_css = {}
+
+def get_pygments_object(name):
+    """returns (shared) pygments lexer called name, or the html 
+    formatter for 'formatter', importing pygments on first use"""
+    try:
+        return pygments_objects[name]
+    except KeyError:
+        pass
+    if name == 'formatter':
+        from pygments.formatters import HtmlFormatter
+        obj = HtmlFormatter(style=FORMATTER_STYLE)
     else:
+        from pygments import lexers
+        obj = getattr(lexers, name)()
+    pygments_objects[name] = obj
+    return obj
+
+def render_pygments(srcfile, lexer_type):
+    """returns src(file) marked up with pygments.
+    Output is cached until the file changes."""
+    lexer = LEXERS.get(lexer_type, DEFAULT_LEXER)
+    signature = watcher.signature(srcfile)
+    if signature is None:
+        raise OSError("%s not found" % srcfile)
+    key = (srcfile, signature[1], signature[2], lexer, FORMATTER_STYLE)
+    contents = pygments_cache.get(key)
+    if contents is None:
+        from pygments import highlight
         with open(srcfile, 'r') as f:
             src = f.read()
-            contents = highlight(src, TextLexer(), HtmlFormatter())
+        contents = highlight(src, get_pygments_object(lexer),
+                get_pygments_object('formatter'))
+        pygments_cache.set(key, contents)
     return contents
 
 def get_pygments_css(style=None):
-    """returns css for pygments, use as internal_css"""
+    """returns css for pygments, use as internal_css.
+    Generated once per style."""
     if style is None:
         style = 'friendly'
-    return HtmlFormatter(style=style).get_style_defs('.highlight')
+    try:
+        return pygments_css[style]
+    except KeyError:
+        from pygments.formatters import HtmlFormatter
+        css = HtmlFormatter(style=style).get_style_defs('.highlight')
+        pygments_css[style] = css
+        return css
+
+
+def invalidate(path):
+    """drop anything cached from the file at path, called by the 
+    watcher (see watcher.py) when it changes"""
+    from_path = lambda key: os.path.normpath(key[0]) == path
+    # markdown_cache is keyed on contents, so is never stale
+    for name in [name for name in file_digests
+            if os.path.normpath(name) == path]:
+        file_digests.pop(name, None)
+    pygments_cache.discard(from_path)
+    templates = os.path.normpath(src_file('templates'))
+    if path.startswith(templates + os.sep):
+        template = os.path.relpath(path, templates)
+        template_parents.pop(template, None)
+        if watcher.signature(path) is None:
+            known_templates.discard(template)
+        else:
+            known_templates.add(template)
+        if template == 'navigation.html':
+            navigation_cache.clear()
+    srcdir = os.path.normpath(frontmatter_index.srcdir)
+    if path.startswith(srcdir + os.sep) and path.endswith('.md'):
+        frontmatter_index.get(os.path.relpath(path, srcdir))
 
 
 def heading(text, level):
@@ -304,32 +846,87 @@ def heading(text, level):
     return '\n<%s>%s</%s>\n' % (heading_level, text, heading_level)
 
 
+# static files
+
+@app.template_global()
+def asset_url(filename):
+    """returns url for static file filename, that of its fingerprinted
+    copy if assets have been built (see assets.py)"""
+    try:
+        manifest = registry.get(assets.manifest_path(app.static_folder))
+    except IOError:
+        manifest = {}
+    if filename in manifest:
+        filename = '%s/%s' % (assets.BUILD_DIR, manifest[filename])
+    return url_for('static', filename=filename)
+
+def static_file(filename):
+    """serves static files, replacing flask's static view.
+    Fingerprinted files (under build/) never change so are sent with 
+    immutable Cache-Control headers, using a precompressed copy if 
+    the client accepts it. The manifest does change, so is not."""
+    if (not filename.startswith(assets.BUILD_DIR + '/')
+            or filename == assets.BUILD_DIR + '/' + assets.MANIFEST):
+        return app.send_static_file(filename)
+    path = safe_join(app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    encoding, sendpath = assets.choose_encoding(request.accept_encodings, 
+            path)
+    response = send_file(sendpath, mimetype=assets.guess_type(filename),
+            cache_timeout=assets.MAX_AGE, conditional=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = (
+            'public, max-age=%d, immutable' % assets.MAX_AGE)
+    return response
+
+app.view_functions['static'] = static_file
+
 # Define routes
 
+# (defaults.json, pages.json, navigation.json, key, html)
+not_found_cache = {}
+
 @app.errorhandler(404)
 def page_not_found(e):
-    """ provides basic 404 page"""
+    """ provides basic 404 page.
+    It is rendered once and reused until the json or templates 
+    it is generated from change."""
     defaults = get_page_attributes('defaults.json')
+    pages = get_page_attributes('pages.json')
+    navigation = get_page_attributes('navigation.json')
+    files = [src_file(template, 'templates') 
+            for template in template_chain('static.html')]
+    files.extend(navigation_templates())
+    files.append(assets.manifest_path(app.static_folder))
+    key = (request.script_root, file_signature(files))
+    cached = not_found_cache.get('html')
+    if (cached and cached[0] is defaults and cached[1] is pages 
+            and cached[2] is navigation and cached[3] == key):
+        return cached[4], 404
     try:
         css = defaults['css']
     except KeyError:
         css = None
-    pages = get_page_attributes('pages.json')
     if '404' in pages:
         if'css' in pages['404']:
             css = pages['404']['css']
-    return render_template('static.html', 
+    html = render_template('static.html', 
             title = "404::page not found", heading = "Page Not Found", 
             navigation = top_navigation('404'),
             css = css,
             contents = Markup(
-                "This page is not there, try somewhere else.")), 404
+                "This page is not there, try somewhere else."))
+    not_found_cache['html'] = (defaults, pages, navigation, key, html)
+    return html, 404
 
 @app.route("/")
 def index():
     """provides index page"""
     index_page = Page('index')
-    return index_page.generate_page()
+    return index_page.cached_page()
 
 # default route is it doe not exist elsewhere
 @app.route("/<path:page>")
@@ -337,9 +934,12 @@ def staticpage(page):
     """ display a static page rendered from markdown in src
     i.e. displays /page or /page/ as long as src/page.md exists.
     srcfile, title and heading may be set in the pages global 
-    (ordered) dictionary but are not required"""
+    (ordered) dictionary but are not required.
+    Pages without markdown are turned away before any work is done."""
+    if not route_index.exists(page.rstrip('/')):
+        abort(404)
     static_page = Page(page)
-    return static_page.generate_page()
+    return static_page.cached_page()
 
 # specialized pages
 @app.route("/source")
@@ -352,62 +952,257 @@ def source():
     # get source for markdown if any. 404's for non-existant markdown
     # unless special page eg source
     pagesrc = source_page.get_page_src(page, 'src', 'md')
-    special_pages = ['source', 'unit-tests', '404']
+    special_pages = ['source', 'unit-tests', '404', 'posts', 'archive',
+            'tags', 'search']
     if not page in special_pages and pagesrc is None:
         abort(404)
-    # set enable_unit_tests  to true  in config.json to allow 
-    #  unit tests to be run  through the source page
-    if app.config['enable_unit_tests']:
-        contents = '''<p><a href="/unit-tests" class="button">Run unit tests
-    </a></p>'''
-        # render tests.py if needed
-        if page == 'unit-tests':
-            contents += heading('tests.py', 2)
-            contents += render_pygments('tests.py', 'python')
-    else:
-        contents = ''
-    # render views.py
-    contents += heading('views.py', 2)
-    contents += render_pygments(source_page.get_page_src('views.py'), 
-            'python')
-    # render markdown if present
-    if pagesrc:
-        contents += heading(os.path.basename(pagesrc), 2)
-        contents += render_pygments(pagesrc, 'markdown')
-    # render jinja templates
-    contents += heading('base.html', 2)
-    contents += render_pygments(
-            source_page.get_page_src('base.html', 'templates'), 'html')
     template = source_page.get_template(page)
-    contents += heading(template, 2)
-    contents += render_pygments(
-            source_page.get_page_src(template, 'templates'), 'html')
-    return source_page.generate_page(contents)
+    show_tests = app.config['enable_unit_tests'] and page == 'unit-tests'
+    dependencies = [source_page.get_page_src('views.py')]
+    if show_tests:
+        dependencies.append('tests.py')
+    if pagesrc:
+        dependencies.append(pagesrc)
+    dependencies.append(source_page.get_page_src('base.html', 'templates'))
+    dependencies.append(source_page.get_page_src(template, 'templates'))
+
+    def render_contents():
+        """render the source files, one section at a time"""
+        # set enable_unit_tests  to true  in config.json to allow 
+        #  unit tests to be run  through the source page
+        if app.config['enable_unit_tests']:
+            yield '''<p><a href="/unit-tests" class="button">Run unit tests
+        </a></p>'''
+            # render tests.py if needed
+            if show_tests:
+                yield (heading('tests.py', 2) 
+                        + render_pygments('tests.py', 'python'))
+        # render views.py
+        yield (heading('views.py', 2)
+                + render_pygments(source_page.get_page_src('views.py'), 
+                'python'))
+        # render markdown if present
+        if pagesrc:
+            yield (heading(os.path.basename(pagesrc), 2)
+                    + render_pygments(pagesrc, 'markdown'))
+        # render jinja templates
+        yield (heading('base.html', 2) + render_pygments(
+                source_page.get_page_src('base.html', 'templates'), 'html'))
+        yield (heading(template, 2) + render_pygments(
+                source_page.get_page_src(template, 'templates'), 'html'))
+    return source_page.cached_page(render_contents, dependencies)
+
+# post listings
+def post_listing(page, posts, number, heading, endpoint, **args):
+    """returns page number of a listing of posts, 404 if there are none
+    (or not that many pages)"""
+    per_page = app.config['posts_per_page']
+    selected, pages = paginate(posts, number, per_page)
+    if not selected and (number > 1 or page != 'posts'):
+        abort(404)
+    listing = Page(page, heading = heading)
+    def render_contents():
+        return render_template('postlist.html', posts = selected,
+                number = number, pages = pages, endpoint = endpoint,
+                args = args)
+    dependencies = [src_file('postlist.html', 'templates')]
+    dependencies += [src_file(post.src, 'src') for post in selected]
+    return listing.cached_page(render_contents, dependencies,
+            post_index.key)
+
+@app.route("/posts/", defaults={'number' : 1})
+@app.route("/posts/page/<int:number>")
+def posts(number):
+    """list all posts, newest first"""
+    post_index.update()
+    return post_listing('posts', post_index.posts, number, "Posts",
+            'posts')
+
+@app.route("/archive/<int:year>/", defaults={'number' : 1})
+@app.route("/archive/<int:year>/page/<int:number>")
+def archive_year(year, number):
+    """list posts from year"""
+    post_index.update()
+    return post_listing('archive', post_index.by_year.get(year, []),
+            number, "Posts from %d" % year, 'archive_year', year = year)
+
+@app.route("/archive/<int:year>/<int:month>/", defaults={'number' : 1})
+@app.route("/archive/<int:year>/<int:month>/page/<int:number>")
+def archive_month(year, month, number):
+    """list posts from month"""
+    post_index.update()
+    return post_listing('archive', 
+            post_index.by_month.get((year, month), []), number,
+            "Posts from %d-%02d" % (year, month), 'archive_month', 
+            year = year, month = month)
+
+@app.route("/tags/<tag>/", defaults={'number' : 1})
+@app.route("/tags/<tag>/page/<int:number>")
+def tag(tag, number):
+    """list posts tagged tag"""
+    post_index.update()
+    return post_listing('tags', post_index.by_tag.get(tag, []), number,
+            "Posts tagged %s" % tag, 'tag', tag = tag)
+
+# search
+def highlight_snippet(text, matches):
+    """returns text as html, with matches ((start, end) of words in 
+    text) marked"""
+    html = []
+    position = 0
+    for start, end in matches:
+        html.append(escape(text[position:start]))
+        html.append(Markup('<mark>%s</mark>') % text[start:end])
+        position = end
+    html.append(escape(text[position:]))
+    return Markup('').join(html)
+
+@app.route("/search")
+def search():
+    """full text search of pages, ?q=words"""
+    query = request.args.get('q', '').strip()
+    search_page = Page('search', title = 'search', heading = 'Search')
+    search_index.update()
+    def render_contents():
+        results = []
+        terms = set(tokenize(query))
+        for document, score in search_index.search(query, 
+                app.config['search_results']):
+            text = read_text(src_file(document[1], 'src')) or ''
+            if document[5]:
+                text = '%s %s' % (document[5], text)
+            results.append({'page' : document[0], 'heading' : document[4],
+                'snippet' : highlight_snippet(*snippet(text, terms))})
+        return render_template('searchresults.html', query = query,
+                results = results)
+    # results change with pages that aren't dependencies, which the
+    # index key (so the ETag) follows but Last-Modified can't
+    dependencies = [src_file('searchresults.html', 'templates')]
+    return search_page.cached_page(render_contents, dependencies,
+            search_index.key)
+
+# feeds
+def feed_response(render, mimetype):
+    """returns response for a feed of the most recent posts, 
+    only generated when posts change, with ETag/Last-Modified set."""
+    post_index.update()
+    posts = post_index.recent(app.config['feed_size'])
+    files = [src_file(post.src, 'src') for post in posts]
+    files += [src_file('feed.xml', 'templates'), src_file('pages.json')]
+    # urls in feeds are absolute
+    key = (request.url, app.config['default_title'], post_index.key)
+    return conditional_response(key, files, lambda: render(posts), mimetype,
+            versioned = True)
+
+def feed_entries(posts):
+    """returns list of dicts with each post's url, last updated
+    time and contents, rendered from markdown"""
+    entries = []
+    for post in posts:
+        if post.date:
+            updated = '%sT00:00:00Z' % post.date[:10]
+        else:
+            updated = '1970-01-01T00:00:00Z'
+        content = render_markdown(src_file(post.src, 'src'), post.trusted)
+        entries.append({'post' : post, 'updated' : updated,
+            'content' : content or '',
+            'url' : url_for('staticpage', page=post.name, _external=True)})
+    return entries
+
+def feed_title():
+    """returns title for feeds"""
+    return app.config['default_title'] or 'Monomotapa'
+
+@app.route("/feed.atom")
+def atom_feed():
+    """atom feed of the most recent posts"""
+    def render(posts):
+        entries = feed_entries(posts)
+        if entries:
+            updated = max(entry['updated'] for entry in entries)
+        else:
+            updated = '1970-01-01T00:00:00Z'
+        # atom requires an author, for the feed if not every entry
+        return render_template('feed.xml', title = feed_title(),
+                author = feed_title(), updated = updated,
+                entries = entries)
+    return feed_response(render, 'application/atom+xml')
+
+@app.route("/feed.json")
+def json_feed():
+    """JSON feed (https://jsonfeed.org/version/1.1) of the 
+    most recent posts"""
+    def render(posts):
+        items = []
+        for entry in feed_entries(posts):
+            post = entry['post']
+            item = {'id' : entry['url'], 'url' : entry['url'],
+                    'title' : post.heading, 
+                    'content_html' : entry['content'],
+                    'date_published' : entry['updated']}
+            if post.summary:
+                item['summary'] = post.summary
+            if post.author:
+                item['authors'] = [{'name' : post.author}]
+            if post.tags:
+                item['tags'] = post.tags
+            items.append(item)
+        feed = {'version' : 'https://jsonfeed.org/version/1.1',
+                'title' : feed_title(),
+                'home_page_url' : url_for('index', _external=True),
+                'feed_url' : url_for('json_feed', _external=True),
+                'items' : items}
+        return json.dumps(feed, indent=1)
+    return feed_response(render, 'application/feed+json')
+
+@app.route("/metrics")
+def metrics_page():
+    """timings and cache statistics in Prometheus text format.
+    Set enable_metrics to true in config.json to enable"""
+    if not metrics.enabled:
+        abort(404)
+    return app.response_class(metrics.render(), 
+            content_type = 'text/plain; version=0.0.4; charset=utf-8')
 
 @app.route("/unit-tests")
 def unit_tests():
-    """display results of unit tests"""
+    """display results of unit tests.
+    The tests are run in the background by testrunner (at most one run 
+    at a time, and only when the code has changed since the last one)
+    so this returns at once with the last result, or the output so far
+    if they are still running. Poll /unit-tests/status for progress."""
     unittests = Page('unit-tests', heading = "Test Results", 
             internal_css = get_pygments_css())
-    # exec unit tests in subprocess, capturing stderr
-    capture = subprocess.Popen(["python", "tests.py"], 
-            stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-    output = capture.communicate()
-    results = output[1]
+    signature = runner.current_signature()
+    runner.start(signature)
+    status = runner.status(signature)
     contents = '''<p>
     <a href="/unit-tests" class="button">Run unit tests</a>
     </p><br>\n
     <div class="output" style="background-color:'''
-    if 'OK' in results:
+    if status['state'] in ['idle', 'running']:
+        color = "#ffffdd"
+        result = "TESTS RUNNING"
+    elif status['passed']:
         color = "#ddffdd"
         result = "TESTS PASSED"
     else:
         color = "#ffaaaa"
         result = "TESTS FAILING"
     contents += ('''%s">\n<strong>%s</strong>\n<pre>%s</pre>\n</div>\n'''
-            % (color, result, results))
+            % (color, result, escape(status['output'])))
     # render test.py 
     contents += heading('tests.py', 2)
     contents += render_pygments('tests.py', 'python')
     return unittests.generate_page(contents)
 
+@app.route("/unit-tests/status")
+def unit_tests_status():
+    """returns state of the unit tests as json. 
+    Output is returned from offset (default 0) onwards, so pollers 
+    can pass the length of what they have already seen."""
+    status = runner.status()
+    offset = request.args.get('offset', 0, type=int)
+    status['offset'] = offset
+    status['output'] = status['output'][offset:]
+    return jsonify(status)
@@ -0,0 +1,295 @@
+"""Watches the site's files so caches don't have to stat them.
+
+A Watcher holds the (inode, size, mtime) of every file in the
+directories it watches, kept up to date by a background thread using
+inotify (on Linux) or, failing that, by polling every interval seconds.
+signature(path) answers from memory for files in those directories,
+so looking a file up on the request path costs no system calls.
+
+Each file has a generation, incremented whenever it changes, and
+there is an overall generation incremented whenever any file does.
+Subscribers (see subscribe()) are called with the path of every file
+that changes so they can invalidate what they have cached.
+
+Every worker process runs its own watcher, and the generations are
+its own: they are not shared between workers (e.g. in a file). Each
+worker's caches are invalidated by its own watcher, and anything that
+must agree across workers, such as ETags, is keyed on the contents of
+files rather than their generations, so sharing them would cost a lock
+and a write on every change for nothing. The thread is started by
+start(), which does nothing if it is already running in this process,
+so it is safe to call it after a fork.
+
+Enable by setting watch_files to true in config.json.
+N.B. a change is seen a moment after it happens, not on the next
+request.
+"""
+import os
+import os.path
+import sys
+import errno
+import select
+import struct
+import threading
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+        | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+# struct inotify_event, without the name that follows it
+EVENT = struct.Struct('iIII')
+
+def stat_signature(path):
+    """returns (inode, size, mtime) of path, or None if missing"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+class Inotify(object):
+    """Minimal inotify(7) binding using ctypes"""
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                use_errno=True)
+        self.add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def watch(self, path):
+        """watch directory path, returns watch descriptor"""
+        wd = self.add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+        return wd
+
+    def read(self):
+        """blocks until there are events, returns list of
+        (watch descriptor, mask, name)"""
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+
+def inotify_available():
+    """True if inotify can be used here"""
+    return (ctypes is not None and sys.platform.startswith('linux')
+            and ctypes.util.find_library('c') is not None)
+
+
+class Watcher(object):
+    """Keeps track of the files in a set of directories"""
+    def __init__(self, interval=1.0, use_inotify=None):
+        self.interval = interval
+        self.use_inotify = use_inotify
+        # (directory, recursive) as passed to watch()
+        self.roots = []
+        # every directory being watched
+        self.directories = set()
+        # path -> (inode, size, mtime), only for files that exist
+        self.files = {}
+        # path -> generation
+        self.generations = {}
+        self.generation = 0
+        self.subscribers = []
+        self.pid = None
+        self.running = False
+        self.backend = None
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = threading.Event()
+        # watch descriptor -> directory
+        self.wds = {}
+
+    def watch(self, directory, recursive=False):
+        """watch files in directory (and below it if recursive).
+        Call before start()"""
+        self.roots.append((os.path.normpath(directory), recursive))
+
+    def subscribe(self, callback):
+        """call callback(path) whenever a file changes"""
+        self.subscribers.append(callback)
+
+    def signature(self, path):
+        """returns (inode, size, mtime) of path, or None if it does not
+        exist. From memory for watched files, otherwise by stat"""
+        if self.running:
+            path = os.path.normpath(path)
+            if os.path.dirname(path) in self.directories:
+                return self.files.get(path)
+        return stat_signature(path)
+
+    def generation_of(self, path):
+        """returns generation of path (0 if never seen)"""
+        return self.generations.get(os.path.normpath(path), 0)
+
+    def start(self):
+        """scan the watched directories and start watching them in a
+        background thread, unless that has been done in this process"""
+        if self.running and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.running and self.pid == os.getpid():
+                return
+            self.running = False
+            self.directories = set()
+            self.wds = {}
+            use_inotify = self.use_inotify
+            if use_inotify is None:
+                use_inotify = inotify_available()
+            inotify = None
+            if use_inotify:
+                try:
+                    inotify = Inotify()
+                except OSError:
+                    inotify = None
+            self.backend = 'inotify' if inotify else 'poll'
+            # watches are added before scanning so nothing is missed
+            paths = self.scan(inotify)
+            self.update(paths, initial=True)
+            self.pid = os.getpid()
+            self.running = True
+            self.stopping.clear()
+            if inotify:
+                target, args = self.run_inotify, (inotify,)
+            else:
+                target, args = self.run_poll, ()
+            self.thread = threading.Thread(target=target, args=args)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """stop watching, within interval seconds. signature() goes
+        back to using stat"""
+        self.running = False
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def scan(self, inotify=None, roots=None):
+        """returns list of files in the watched directories, recording
+        the directories (and watching them with inotify)"""
+        paths = []
+        for root, recursive in roots or self.roots:
+            if not os.path.isdir(root):
+                continue
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirpath = os.path.normpath(dirpath)
+                self.directories.add(dirpath)
+                if inotify is not None:
+                    try:
+                        self.wds[inotify.watch(dirpath)] = (dirpath,
+                                recursive)
+                    except OSError:
+                        pass
+                paths.extend(os.path.join(dirpath, filename)
+                        for filename in filenames)
+                if not recursive:
+                    break
+        return paths
+
+    def run_inotify(self, inotify):
+        """handle inotify events until stopped"""
+        try:
+            while not self.stopping.is_set():
+                self.handle_events(inotify)
+        finally:
+            os.close(inotify.fd)
+
+    def handle_events(self, inotify):
+        """wait up to interval seconds for events, and handle them"""
+        try:
+            ready = select.select([inotify.fd], [], [], self.interval)[0]
+            if not ready:
+                return
+            events = inotify.read()
+        except (OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        changed = []
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # events were lost: check everything
+                changed.extend(self.scan())
+                changed.extend(self.files)
+                continue
+            if wd not in self.wds:
+                continue
+            directory, recursive = self.wds[wd]
+            if mask & IN_IGNORED:
+                del self.wds[wd]
+                self.directories.discard(directory)
+                continue
+            if not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                    changed.extend(self.scan(inotify, [(path, recursive)]))
+                continue
+            changed.append(path)
+        if changed:
+            self.update(changed)
+
+    def run_poll(self):
+        """stat every file every interval seconds, until stopped"""
+        while not self.stopping.wait(self.interval):
+            changed = [path for path in self.scan()
+                    if self.files.get(path) != stat_signature(path)]
+            # removed files
+            changed.extend(path for path in list(self.files)
+                    if not os.path.exists(path))
+            if changed:
+                self.update(changed)
+
+    def update(self, paths, initial=False):
+        """record the current state of paths, incrementing the
+        generation of any that have changed, and notify subscribers
+        (unless initial). Returns the paths that changed"""
+        changed = []
+        for path in set(os.path.normpath(path) for path in paths):
+            signature = stat_signature(path)
+            if self.files.get(path) != signature:
+                changed.append(path)
+                self.generations[path] = self.generations.get(path, 0) + 1
+                self.generation += 1
+            if signature is None:
+                self.files.pop(path, None)
+            else:
+                self.files[path] = signature
+        if not initial:
+            for path in sorted(changed):
+                for callback in self.subscribers:
+                    callback(path)
+        return changed
+
+
+watcher = Watcher()
@@ -37,6 +37,24 @@ You are therefore free to add templates and style sheets under your own terms th
 ough I would be happy if you chose to license them in the same way. 
 """
 
+import sys
+
 from monomotapa import app
 if __name__ == "__main__": 
-    app.run()
+    if len(sys.argv) > 1 and sys.argv[1] == 'export':
+        from monomotapa import export
+        export.main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'assets':
+        from monomotapa import assets
+        assets.main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'search':
+        from monomotapa import search
+        search.main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'cache-server':
+        from monomotapa import store
+        store.main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        from monomotapa import server
+        server.main(sys.argv[2:])
+    else:
+        app.run()
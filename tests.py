@@ -37,10 +37,29 @@ ough I would be happy if you chose to license them in the same way.
 """
 
 import monomotapa
+import monomotapa.export
+import monomotapa.testrunner
+import monomotapa.frontmatter
+import monomotapa.posts
+import monomotapa.assets
+import monomotapa.compression
+import monomotapa.watcher
+import monomotapa.search
+import monomotapa.store
+import monomotapa.server
 import unittest
+import sys
+import json
 import tempfile
+import shutil
 import os
 import os.path
+import zlib
+import threading
+import time
+import subprocess
+import socket
+import httplib
 
 
 class TestCase(unittest.TestCase):
@@ -69,6 +88,26 @@ class TestCase(unittest.TestCase):
         self.assertEquals(staticpage.heading, self.route.capitalize())
         self.assertFalse(staticpage.trusted)
    
+    def test_page_config_cached(self):
+        first = monomotapa.views.page_config('index')
+        self.assertIs(monomotapa.views.page_config('index'), first)
+        self.assertIsNot(monomotapa.views.page_config('index', 
+            {'heading' : 'other'}), first)
+        self.assertEquals(first.template, 'home.html')
+        self.assertEquals(first.src, 'home.md')
+
+    def test_page_config_immutable(self):
+        config = monomotapa.views.page_config('index')
+        self.assertRaises(AttributeError, setattr, config, 'title', 'x')
+        self.assertFalse(hasattr(config, '__dict__'))
+
+    def test_page_config_merges_css(self):
+        config = monomotapa.views.compile_page_config('test', {}, 
+                {'template' : 'static.html', 'css' : ['style.css']}, 
+                {'test' : {'css' : ['test.css']}}, 'Test:::')
+        self.assertEquals(config.css, ['style.css', 'test.css'])
+        self.assertEquals(config.title, 'Test:::test')
+
     # test generate page via call to home page
     
     def test_generate_page_with_template(self):
@@ -162,15 +201,143 @@ class TestCase(unittest.TestCase):
         self.assertIn('<pre>', results)
         self.assertIn('test', results)
 
+    def test_pygments_renderer_cached(self):
+        cache = monomotapa.views.pygments_cache
+        monomotapa.views.render_pygments(self.tmpfile.name, 'markdown')
+        hits = cache.stats()['hits']
+        results = monomotapa.views.render_pygments(self.tmpfile.name,
+                'markdown')
+        self.assertEquals(cache.stats()['hits'], hits + 1)
+        self.assertIn('test', results)
+
+    def test_pygments_renderer_cache_keyed_on_lexer(self):
+        text = monomotapa.views.render_pygments('tests.py', 'markdown')
+        python = monomotapa.views.render_pygments('tests.py', 'python')
+        self.assertNotEquals(text, python)
+
     def test_get_pygments_css(self):
         css = monomotapa.views.get_pygments_css()
         self.assertIn('.highlight', css)
+        self.assertIs(monomotapa.views.get_pygments_css(), css)
 
     def test_heading(self):
         expected = '\n<h1>test</h1>\n'
         result = monomotapa.views.heading('test', 1)
         self.assertEquals(result, expected)
-    
+
+    # Test metadata registry
+
+    def test_registry_returns_cached_json(self):
+        registry = monomotapa.metadata.MetadataRegistry()
+        first = registry.get('monomotapa/pages.json')
+        self.assertIs(registry.get('monomotapa/pages.json'), first)
+
+    def test_registry_reloads_changed_file(self):
+        registry = monomotapa.metadata.MetadataRegistry()
+        jsonfile = tempfile.NamedTemporaryFile(suffix=".json", delete=False)
+        try:
+            with open(jsonfile.name, 'w') as f:
+                f.write('{"a": 1}')
+            self.assertEquals(registry.get(jsonfile.name), {'a' : 1})
+            with open(jsonfile.name, 'w') as f:
+                f.write('{"a": 22}')
+            self.assertEquals(registry.get(jsonfile.name), {'a' : 22})
+        finally:
+            os.unlink(jsonfile.name)
+
+    def test_registry_missing_file(self):
+        registry = monomotapa.metadata.MetadataRegistry()
+        self.assertRaises(IOError, registry.get, 'non_existant.json')
+
+    # Test caches
+
+    def test_lru_cache_evicts_by_size(self):
+        cache = monomotapa.cache.LRUCache(10)
+        cache.set('a', 'aaaa')
+        cache.set('b', 'bbbb')
+        cache.get('a')
+        cache.set('c', 'cccc')
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEquals(cache.stats()['bytes'], 8)
+
+    def test_lru_cache_counts_hits_and_misses(self):
+        cache = monomotapa.cache.LRUCache(10)
+        cache.set('a', 'aaaa')
+        cache.get('a')
+        cache.get('b')
+        stats = cache.stats()
+        self.assertEquals((stats['hits'], stats['misses']), (1, 1))
+
+    def test_render_markdown_cached(self):
+        cache = monomotapa.views.markdown_cache
+        monomotapa.views.render_markdown(self.tmpfile.name)
+        hits = cache.stats()['hits']
+        monomotapa.views.render_markdown(self.tmpfile.name)
+        self.assertEquals(cache.stats()['hits'], hits + 1)
+
+    def test_render_markdown_cache_keyed_on_contents(self):
+        cache = monomotapa.views.markdown_cache
+        html = monomotapa.views.render_markdown(self.tmpfile.name)
+        with tempfile.NamedTemporaryFile(suffix='.md') as copy:
+            with open(self.tmpfile.name) as f:
+                copy.write(f.read())
+            copy.flush()
+            hits = cache.stats()['hits']
+            self.assertEquals(monomotapa.views.render_markdown(copy.name),
+                    html)
+            self.assertEquals(cache.stats()['hits'], hits + 1)
+
+    def test_lru_cache_shared(self):
+        path = tempfile.mktemp(suffix='.sqlite')
+        self.addCleanup(os.remove, path)
+        first = monomotapa.cache.LRUCache(100)
+        first.share(monomotapa.store.SQLiteStore(path, 1000), 'test')
+        second = monomotapa.cache.LRUCache(100)
+        second.share(monomotapa.store.SQLiteStore(path, 1000), 'test')
+        first.set(('a', True), u'\u2135')
+        self.assertEquals(second.get(('a', True)), u'\u2135')
+        self.assertIn(('a', True), second)
+        self.assertEquals(second.stats()['store_hits'], 1)
+        self.assertIsNone(second.get('b'))
+
+    def test_sqlite_store_evicts(self):
+        path = tempfile.mktemp(suffix='.sqlite')
+        self.addCleanup(os.remove, path)
+        store = monomotapa.store.SQLiteStore(path, 10)
+        store.set('a', 'aaaaaa')
+        store.set('b', 'bbbbbb')
+        store.evict(store.connection())
+        self.assertIsNone(store.get('a'))
+        self.assertEquals(store.get('b'), 'bbbbbb')
+
+    def test_code_version(self):
+        code_version = monomotapa.store.code_version
+        self.assertEquals(code_version({'a' : 1}), code_version({'a' : 1}))
+        self.assertNotEquals(code_version({'a' : 1}),
+                code_version({'a' : 2}))
+
+    def test_memcached_store(self):
+        server = monomotapa.store.MemcachedServer(('127.0.0.1', 0), 1000)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        store = monomotapa.store.MemcachedStore(server.server_address)
+        store.set('a', u'\u2135\r\nEND')
+        self.assertEquals(store.get('a'), u'\u2135\r\nEND')
+        self.assertIsNone(store.get('b'))
+        store.clear()
+        self.assertIsNone(store.get('a'))
+        self.assertEquals(store.errors, 0)
+
+    def test_render_markdown_cache_keyed_on_trusted(self):
+        monomotapa.views.render_markdown(self.tmpfile.name)
+        markdown = monomotapa.views.render_markdown(self.tmpfile.name,
+                trusted=True)
+        self.assertIn('&aleph;', markdown)
+
 
     # Test page display/routes
     # Some of these  are dependent on templates and contents supplied,
@@ -257,5 +424,944 @@ class TestCase(unittest.TestCase):
         source_page = self.app.get('/source?page=%s' % 'index')
         # always true if this test is rendered
         self.assertIn('home.html', source_page.data)
+
+    # Test conditional responses
+
+    def test_static_page_etag(self):
+        static_page = self.app.get('/' + self.route)
+        self.assertIsNotNone(static_page.headers.get('ETag'))
+        self.assertIsNotNone(static_page.headers.get('Last-Modified'))
+
+    def test_static_page_304_if_none_match(self):
+        etag = self.app.get('/' + self.route).headers['ETag']
+        static_page = self.app.get('/' + self.route,
+                headers={'If-None-Match' : etag})
+        self.assertEquals(static_page.status_code, 304)
+        self.assertEquals(static_page.data, '')
+
+    def test_static_page_304_if_modified_since(self):
+        last_modified = self.app.get('/' + self.route).headers['Last-Modified']
+        static_page = self.app.get('/' + self.route,
+                headers={'If-Modified-Since' : last_modified})
+        self.assertEquals(static_page.status_code, 304)
+
+    def test_static_page_changed_etag(self):
+        etag = self.app.get('/' + self.route).headers['ETag']
+        with open(self.tmpfile.name ,'w') as f:
+            f.write("changed test")
+        static_page = self.app.get('/' + self.route,
+                headers={'If-None-Match' : etag})
+        self.assertEquals(static_page.status_code, 200)
+        self.assertIn('changed', static_page.data)
+
+    def test_source_page_304(self):
+        etag = self.app.get('/source?page=index').headers['ETag']
+        source_page = self.app.get('/source?page=index',
+                headers={'If-None-Match' : etag})
+        self.assertEquals(source_page.status_code, 304)
+
+    def test_template_chain(self):
+        result = monomotapa.views.template_chain('post.html')
+        self.assertEquals(result, ['post.html', 'base.html'])
+
+    # Test static export
+
+    def test_export_get_routes(self):
+        routes = monomotapa.export.get_routes()
+        self.assertIn('index', routes)
+        self.assertIn(self.route, routes)
+        self.assertNotIn('home', routes)
+
+    def test_export_generated_urls(self):
+        urls = monomotapa.export.get_generated_urls()
+        for url in ['/posts/', '/feed.atom', '/feed.json', '/search']:
+            self.assertIn(url, urls)
+        self.assertEquals(monomotapa.export.generated_path('out',
+            '/feed.atom'), 'out/feed.atom')
+        self.assertEquals(monomotapa.export.generated_path('out',
+            '/tags/a%20b/'), 'out/tags/a b/index.html')
+
+    def test_export_output_path(self):
+        self.assertEquals(monomotapa.export.output_path('out', 'index'),
+                'out/index.html')
+        self.assertEquals(monomotapa.export.output_path('out', 'a/b'),
+                'out/a/b/index.html')
+
+    def test_export(self):
+        outdir = tempfile.mkdtemp()
+        try:
+            monomotapa.export.export(outdir, 2)
+            for path in ['index.html', '404.html', 'static/style.css',
+                    'posts/index.html', 'feed.atom',
+                    os.path.join(self.route, 'index.html')]:
+                self.assertTrue(os.path.exists(os.path.join(outdir, path)))
+            with open(os.path.join(outdir, 'index.html')) as f:
+                self.assertIn('<div id="home">', f.read())
+        finally:
+            shutil.rmtree(outdir)
+
+    def test_export_incremental(self):
+        outdir = tempfile.mkdtemp()
+        try:
+            written = monomotapa.export.export(outdir, 2)
+            self.assertIn(os.path.join(outdir, 'static', 'style.css'),
+                    written)
+            # copies may have lost a fraction of a second of mtime
+            dest = os.path.join(outdir, 'static', 'style.css')
+            st = os.stat(dest)
+            os.utime(dest, (st.st_atime, int(st.st_mtime) + 0.25))
+            self.assertEquals(monomotapa.export.export(outdir, 2), [])
+            with open(self.tmpfile.name ,'w') as f:
+                f.write("changed test page")
+            written = monomotapa.export.export(outdir, 2)
+            self.assertEquals(written, [monomotapa.export.output_path(
+                outdir, self.route)])
+        finally:
+            shutil.rmtree(outdir)
+
+    def test_export_dependencies(self):
+        dependencies = monomotapa.export.page_dependencies('test-post')
+        self.assertIn('monomotapa/src/test-post.md', dependencies)
+        self.assertIn('monomotapa/templates/post.html', dependencies)
+        self.assertIn('monomotapa/templates/base.html', dependencies)
+        self.assertIn('pages.json#test-post', dependencies)
+
+    # Test background test runner
+    # (with a trivial command, not tests.py)
+
+    def test_runner_runs_once(self):
+        runner = monomotapa.testrunner.TestRunner(
+                [sys.executable, '-c', 'print("ran")'], [self.tmpfile.name])
+        self.assertTrue(runner.start())
+        self.assertFalse(runner.start())
+        status = runner.wait(10)
+        self.assertEquals(status['state'], 'finished')
+        self.assertTrue(status['passed'])
+        self.assertIn('ran', status['output'])
+        # result is cached until the code changes
+        self.assertFalse(runner.start())
+
+    def test_runner_stale(self):
+        runner = monomotapa.testrunner.TestRunner(
+                [sys.executable, '-c', 'import sys; sys.exit(1)'],
+                [self.tmpfile.name])
+        runner.start()
+        self.assertFalse(runner.wait(10)['passed'])
+        with open(self.tmpfile.name ,'w') as f:
+            f.write("changed test page")
+        self.assertEquals(runner.status()['state'], 'stale')
+        self.assertTrue(runner.start())
+        runner.wait(10)
+
+    def test_runner_code_signature(self):
+        paths = [path for path, _, _ in monomotapa.testrunner.runner.
+                current_signature()]
+        self.assertIn('tests.py', paths)
+        self.assertIn(os.path.join('monomotapa', 'views.py'), paths)
+        self.assertIn(os.path.join('monomotapa', 'templates', 'base.html'),
+                paths)
+        # pages and static files are not code
+        self.assertFalse([path for path in paths
+            if path.endswith(('.md', '.css', '.json'))])
+
+    def test_unit_tests_status(self):
+        status = self.app.get('/unit-tests/status')
+        self.assertEquals(status.status_code, 200)
+        self.assertIn('state', status.data)
+
+    # Test front matter
+
+    def write_front_matter(self):
+        with open(self.tmpfile.name ,'w') as f:
+            f.write('---\n{"title": "matter", "heading": "Front"}\n---\n'
+                    '&aleph; test')
+
+    def test_split_front_matter(self):
+        result = monomotapa.frontmatter.split_front_matter(
+                '---\n{"a": 1}\n---\nbody')
+        self.assertEquals(result, ('{"a": 1}', 'body'))
+
+    def test_split_front_matter_none(self):
+        result = monomotapa.frontmatter.split_front_matter('---\nbody')
+        self.assertEquals(result, (None, '---\nbody'))
+
+    def test_split_front_matter_horizontal_rules(self):
+        src = '---\n\nIntro paragraph that matters.\n\n---\n\nRest.\n'
+        self.assertEquals(monomotapa.frontmatter.split_front_matter(src),
+                (None, src))
+        with open(self.tmpfile.name ,'w') as f:
+            f.write(src)
+        html = monomotapa.views.render_markdown(self.tmpfile.name)
+        self.assertIn('Intro paragraph that matters.', html)
+        self.assertIn('Intro paragraph', monomotapa.search.read_text(
+            self.tmpfile.name))
+        index = monomotapa.frontmatter.FrontMatterIndex('monomotapa/src')
+        self.assertEquals(index.get(self.filename), {})
+
+    def test_front_matter_index(self):
+        index = monomotapa.frontmatter.FrontMatterIndex('monomotapa/src')
+        index.scan()
+        self.assertEquals(index.get(self.filename), {})
+        self.write_front_matter()
+        self.assertEquals(index.get(self.filename)['title'], 'matter')
+        self.assertIsNone(index.get('non_existant.md'))
+
+    def test_Page_front_matter(self):
+        self.write_front_matter()
+        staticpage = monomotapa.views.Page(self.route)
+        self.assertIn('matter', staticpage.title)
+        self.assertEquals(staticpage.heading, 'Front')
+
+    def test_Page_pages_json_overrides_front_matter(self):
+        pages = {self.route : {'heading' : 'pages.json'}}
+        self.write_front_matter()
+        attributes = monomotapa.frontmatter.PageAttributes(pages,
+                monomotapa.views.frontmatter_index)
+        self.assertEquals(attributes[self.route]['heading'], 'pages.json')
+        self.assertEquals(attributes[self.route]['title'], 'matter')
+
+    def test_static_page_front_matter_not_rendered(self):
+        self.write_front_matter()
+        static_page = self.app.get('/' + self.route)
+        self.assertIn('<h1>Front</h1>', static_page.data)
+        self.assertNotIn('---', static_page.data)
+
+    # Test post listings
+
+    def write_post(self):
+        with open(self.tmpfile.name ,'w') as f:
+            f.write('---\n{"type": "post", "heading": "Tmp Post", '
+                    '"attributes": {"date": "2001-02-03", "tags": "a, b"}}'
+                    '\n---\n&aleph; test')
+        monomotapa.views.frontmatter_index.scan()
+
+    def test_paginate(self):
+        posts = range(25)
+        self.assertEquals(monomotapa.posts.paginate(posts, 3, 10),
+                ([20, 21, 22, 23, 24], 3))
+
+    def test_post_index(self):
+        self.write_post()
+        index = monomotapa.views.post_index.update()
+        names = [post.name for post in index.posts]
+        self.assertIn('test-post', names)
+        self.assertIn(self.route, names)
+        # sorted newest first
+        self.assertLess(names.index('test-post'), names.index(self.route))
+        self.assertEquals(index.by_tag['b'][0].name, self.route)
+        self.assertEquals(index.by_month[(2001, 2)][0].name, self.route)
+
+    def test_post_index_key(self):
+        self.write_post()
+        index = monomotapa.views.post_index
+        key = index.update().key
+        other = monomotapa.posts.PostIndex(index.index, index.get_pages)
+        # the same in every process
+        self.assertEquals(other.update().key, key)
+        with open(self.tmpfile.name ,'w') as f:
+            f.write('---\n{"type": "post", "heading": "Renamed"}\n---\n')
+        monomotapa.views.frontmatter_index.scan()
+        self.assertNotEquals(index.update().key, key)
+
+    def test_posts_page(self):
+        self.write_post()
+        posts_page = self.app.get('/posts/')
+        self.assertEquals(posts_page.status_code, 200)
+        self.assertIn('Tmp Post', posts_page.data)
+        self.assertIn('A Post', posts_page.data)
+
+    def test_archive_page(self):
+        self.write_post()
+        archive = self.app.get('/archive/2001/')
+        self.assertIn('Tmp Post', archive.data)
+        self.assertNotIn('A Post', archive.data)
+
+    def test_tag_page(self):
+        self.write_post()
+        self.assertIn('Tmp Post', self.app.get('/tags/a/').data)
+
+    def test_posts_page_post_removed(self):
+        self.write_post()
+        last_modified = self.app.get('/posts/').headers['Last-Modified']
+        # no longer a post, none of the files listed have changed
+        with open(self.tmpfile.name ,'w') as f:
+            f.write('&aleph; test')
+        monomotapa.views.frontmatter_index.scan()
+        posts_page = self.app.get('/posts/',
+                headers={'If-Modified-Since' : last_modified})
+        self.assertEquals(posts_page.status_code, 200)
+        self.assertNotIn('Tmp Post', posts_page.data)
+        etag = posts_page.headers['ETag']
+        self.assertEquals(self.app.get('/posts/',
+            headers={'If-None-Match' : etag}).status_code, 304)
+
+    def test_archive_page_404(self):
+        archive = self.app.get('/archive/1900/')
+        self.assertEquals(archive.status_code, 404)
+
+    # Test feeds
+
+    def test_atom_feed(self):
+        self.write_post()
+        feed = self.app.get('/feed.atom')
+        self.assertEquals(feed.mimetype, 'application/atom+xml')
+        self.assertIn('<title>Tmp Post</title>', feed.data)
+        self.assertIn('<category term="a"/>', feed.data)
+
+    def test_atom_feed_author(self):
+        default_title = monomotapa.app.config['default_title']
+        self.addCleanup(monomotapa.app.config.__setitem__, 'default_title',
+                default_title)
+        monomotapa.app.config['default_title'] = None
+        feed = self.app.get('/feed.atom').data
+        self.assertIn('<author><name>Monomotapa</name></author>', feed)
+        self.assertNotIn('None', feed)
+
+    def test_json_feed(self):
+        self.write_post()
+        feed = json.loads(self.app.get('/feed.json').data)
+        titles = [item['title'] for item in feed['items']]
+        self.assertIn('Tmp Post', titles)
+        self.assertIn('A Post', titles)
+
+    def test_feed_post_removed(self):
+        self.write_post()
+        last_modified = self.app.get('/feed.atom').headers['Last-Modified']
+        with open(self.tmpfile.name ,'w') as f:
+            f.write('&aleph; test')
+        monomotapa.views.frontmatter_index.scan()
+        feed = self.app.get('/feed.atom',
+                headers={'If-Modified-Since' : last_modified})
+        self.assertEquals(feed.status_code, 200)
+        self.assertNotIn('Tmp Post', feed.data)
+
+    def test_feed_304(self):
+        etag = self.app.get('/feed.atom').headers['ETag']
+        feed = self.app.get('/feed.atom', headers={'If-None-Match' : etag})
+        self.assertEquals(feed.status_code, 304)
+
+    # Test plugins
+
+    def test_load_plugins(self):
+        plugins = monomotapa.plugin.load_plugins('monomotapa.plugins',
+                {'sampleplugin' : '*'})
+        self.assertEquals(plugins['sampleplugin'][0].__name__, 'Sampleplugin')
+
+    def test_load_plugins_not_found(self):
+        self.assertRaises(monomotapa.plugin.PluginError,
+                monomotapa.plugin.load_plugins, 'monomotapa.plugins',
+                {'non_existant' : '*'})
+
+    def test_plugin_index_applies_to(self):
+        index = monomotapa.plugin.PluginIndex()
+        index.index({'all' : (None, '*'), 'posts' : (None, 'posts/*'),
+            'deep' : (None, ['posts/2014/*', 'colophon'])})
+        self.assertEquals(index.applies_to('index'), ['all'])
+        self.assertEquals(index.applies_to('colophon'), ['all', 'deep'])
+        self.assertEquals(index.applies_to('posts/a'), ['all', 'posts'])
+        self.assertEquals(index.applies_to('posts/2014/a'),
+                ['all', 'posts', 'deep'])
+
+    def test_plugin_output_cached(self):
+        plugins = monomotapa.plugin.load_plugins('monomotapa.plugins',
+                {'sampleplugin' : '*'})
+        index = monomotapa.plugin.PluginIndex()
+        index.index(plugins)
+        first = index.output('test', {'page' : 'test'})
+        self.assertEquals(first['sampleplugin']['page_name'],
+                'My name is test')
+        second = index.output('test', {'page' : 'test'})
+        self.assertIs(first['sampleplugin'], second['sampleplugin'])
+
+    def test_plugin_not_cacheable(self):
+        calls = []
+        class counter(monomotapa.plugin.Plugin):
+            cacheable = False
+            def __init__(self, **kwargs):
+                pass
+            def output(self):
+                calls.append(1)
+                return {'class_name' : 'counter', 'count' : len(calls)}
+        index = monomotapa.views.plugin_index
+        self.addCleanup(index.__dict__.update, dict(vars(index)))
+        index.index({'counter' : (counter, self.route)})
+        self.assertFalse(index.cacheable(self.route))
+        self.assertTrue(index.cacheable('index'))
+        first = self.app.get('/' + self.route)
+        second = self.app.get('/' + self.route)
+        self.assertEquals(second.status_code, 200)
+        self.assertEquals(len(calls), 2)
+        self.assertIsNone(second.headers.get('ETag'))
+
+    def test_plugin_file_is_dependency(self):
+        page = monomotapa.views.Page(self.route)
+        self.assertIn(monomotapa.views.plugin_index.path,
+                page.get_dependencies())
+
+    # Test metrics
+
+    def test_histogram(self):
+        histogram = monomotapa.metrics.Histogram()
+        histogram.observe(0.003)
+        histogram.observe(100)
+        self.assertEquals(histogram.count, 2)
+        self.assertEquals(histogram.counts[-1], 1)
+
+    def test_metrics_timed(self):
+        metrics = monomotapa.metrics.Metrics()
+        timed = metrics.timed('phase', lambda x: x * 2)
+        self.assertEquals(timed(2), 4)
+        self.assertEquals(metrics.phases[('phase', 'none')].count, 1)
+
+    def test_metrics_render(self):
+        metrics = monomotapa.metrics.Metrics()
+        metrics.caches = {'markdown' : monomotapa.views.markdown_cache}
+        metrics.observe_request('index', 0.002, 200)
+        metrics.observe_request('404', 0.001, 404)
+        text = metrics.render()
+        self.assertIn('monomotapa_request_seconds_bucket'
+                '{le="0.0025",route="index"} 1', text)
+        self.assertIn('monomotapa_request_seconds_count{route="index"} 1',
+                text)
+        self.assertIn('monomotapa_responses_total{status="404"} 1', text)
+        self.assertIn('monomotapa_cache_hit_ratio{cache="markdown"}', text)
+
+    def test_metrics_disabled(self):
+        self.assertEquals(self.app.get('/metrics').status_code, 404)
+
+    # Test navigation
+
+    def test_top_navigation_cached(self):
+        first = monomotapa.views.top_navigation('a')
+        second = monomotapa.views.top_navigation('b')
+        self.assertIs(first['navigation'], second['navigation'])
+        self.assertEquals(second['page'], 'b')
+
+    def test_navigation_html_rendered_once(self):
+        self.app.get('/colophon')
+        html = monomotapa.views.navigation_cache['html'][3]
+        self.app.get('/' + self.route)
+        self.assertIs(monomotapa.views.navigation_cache['html'][3], html)
+
+    def test_navigation_template_is_dependency(self):
+        path = monomotapa.views.src_file('navigation.html', 'templates')
+        with open(path) as f:
+            original = f.read()
+        st = os.stat(path)
+        def restore():
+            with open(path, 'w') as f:
+                f.write(original)
+            # so the real site's ETags and Last-Modified don't change
+            os.utime(path, (st.st_atime, st.st_mtime))
+        self.addCleanup(restore)
+        page = monomotapa.views.Page(self.route)
+        self.assertIn(path, page.get_dependencies())
+        etag = self.app.get('/' + self.route).headers['ETag']
+        with open(path, 'w') as f:
+            f.write(original + '<!--edited-->')
+        response = self.app.get('/' + self.route,
+                headers={'If-None-Match' : etag})
+        self.assertEquals(response.status_code, 200)
+        self.assertIn('<!--edited-->', response.data)
+        self.assertIn('<!--edited-->', self.app.get('/no-such-page').data)
+
+    def test_navigation_source_link(self):
+        static_page = self.app.get('/' + self.route)
+        self.assertIn('/source?page=%s"' % self.route, static_page.data)
+        self.assertNotIn(monomotapa.views.NAVIGATION_PAGE, static_page.data)
+
+    # Test streaming
+
+    def test_stream_sections(self):
+        marker = monomotapa.views.STREAM_MARKER
+        generator = iter(['<head>', 'nav ' + marker + ' foot', '</html>'])
+        chunks = list(monomotapa.views.stream_sections(generator,
+            ['one', 'two']))
+        self.assertEquals(chunks, ['<head>nav ', 'one', 'two',
+            ' foot</html>'])
+
+    def test_stream_page_matches_generate_page(self):
+        with monomotapa.app.test_request_context('/' + self.route):
+            page = monomotapa.views.Page(self.route)
+            streamed = ''.join(page.stream_page())
+            self.assertEquals(streamed, page.generate_page())
+
+    def test_static_page_streamed(self):
+        with open(self.tmpfile.name ,'w') as f:
+            f.write('---\n{"stream": true}\n---\n&aleph; test')
+        static_page = self.app.get('/' + self.route)
+        self.assertIn('test</p>', static_page.data)
+        self.assertIn('</html>', static_page.data)
+        # the streamed body is cached
+        etag = static_page.headers['ETag'].strip('"')
+        self.assertEquals(monomotapa.views.page_cache.get(etag),
+                static_page.data.decode('utf-8'))
+
+    # Test templates
+
+    def test_precompile_templates(self):
+        templates = monomotapa.views.precompile_templates()
+        self.assertIn('base.html', templates)
+        self.assertIn('post.html', monomotapa.views.known_templates)
+
+    def test_bytecode_cache(self):
+        self.assertIsNotNone(monomotapa.app.jinja_env.bytecode_cache)
+
+    def test_get_template_not_found(self):
+        page = monomotapa.views.Page(self.route)
+        page.default_template = 'non_existant.html'
+        self.assertRaises(monomotapa.views.MonomotapaError,
+                page.get_template, self.route)
+
+    # Test static assets
+
+    def test_assets_build(self):
+        static_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(static_dir, 'test.css'), 'w') as f:
+                f.write('body {}')
+            manifest = monomotapa.assets.build(static_dir)
+            built = os.path.join(static_dir, 'build', manifest['test.css'])
+            self.assertRegexpMatches(manifest['test.css'],
+                    r'^test\.[0-9a-f]{12}\.css$')
+            self.assertTrue(os.path.exists(built))
+            self.assertTrue(os.path.exists(built + '.gz'))
+            self.assertTrue(os.path.exists(
+                monomotapa.assets.manifest_path(static_dir)))
+        finally:
+            shutil.rmtree(static_dir)
+
+    def test_assets_build_keeps_old(self):
+        static_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(static_dir, 'test.css'), 'w') as f:
+                f.write('body {}')
+            old = monomotapa.assets.build(static_dir)['test.css']
+            old = os.path.join(static_dir, 'build', old)
+            with open(os.path.join(static_dir, 'test.css'), 'w') as f:
+                f.write('p {}')
+            new = monomotapa.assets.build(static_dir)['test.css']
+            new = os.path.join(static_dir, 'build', new)
+            # pages still linking the old file can load it
+            self.assertTrue(os.path.exists(old))
+            self.assertTrue(os.path.exists(old + '.gz'))
+            # until it has not been built for keep_age
+            os.utime(old, (0, 0))
+            os.utime(old + '.gz', (0, 0))
+            monomotapa.assets.build(static_dir)
+            self.assertFalse(os.path.exists(old))
+            self.assertFalse(os.path.exists(old + '.gz'))
+            self.assertTrue(os.path.exists(new))
+            self.assertTrue(os.path.exists(
+                monomotapa.assets.manifest_path(static_dir)))
+        finally:
+            shutil.rmtree(static_dir)
+
+    def temp_static_folder(self):
+        """point the app at a copy of its static folder (without any
+        build), so building assets leaves the real one alone"""
+        static_dir = os.path.join(tempfile.mkdtemp(), 'static')
+        self.addCleanup(shutil.rmtree, os.path.dirname(static_dir))
+        shutil.copytree(monomotapa.app.static_folder, static_dir,
+                ignore=shutil.ignore_patterns(monomotapa.assets.BUILD_DIR))
+        self.addCleanup(setattr, monomotapa.app, 'static_folder',
+                monomotapa.app.static_folder)
+        monomotapa.app.static_folder = static_dir
+        return static_dir
+
+    def test_assets_manifest_not_immutable(self):
+        monomotapa.assets.build(self.temp_static_folder())
+        manifest = self.app.get('/static/build/manifest.json')
+        self.assertEquals(manifest.status_code, 200)
+        self.assertNotIn('immutable',
+                manifest.headers.get('Cache-Control', ''))
+
+    def test_static_file_precompressed(self):
+        monomotapa.assets.build(self.temp_static_folder())
+        page = self.app.get('/' + self.route).data
+        self.assertIn('/static/build/style.', page)
+        url = page.split('href="/static/build/')[1].split('"')[0]
+        asset = self.app.get('/static/build/' + url,
+                headers={'Accept-Encoding' : 'gzip'})
+        self.assertEquals(asset.headers['Content-Encoding'], 'gzip')
+        self.assertIn('immutable', asset.headers['Cache-Control'])
+        self.assertEquals(asset.mimetype, 'text/css')
+        asset = self.app.get('/static/build/' + url)
+        self.assertNotIn('Content-Encoding', asset.headers)
+
+    def test_asset_url_unbuilt(self):
+        self.temp_static_folder()
+        with monomotapa.app.test_request_context('/'):
+            self.assertEquals(monomotapa.views.asset_url('style.css'),
+                    '/static/style.css')
+
+    # Test compression
+
+    def test_static_page_compressed(self):
+        plain = self.app.get('/' + self.route)
+        static_page = self.app.get('/' + self.route,
+                headers={'Accept-Encoding' : 'gzip'})
+        self.assertEquals(static_page.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', static_page.headers['Vary'])
+        self.assertEquals(zlib.decompress(static_page.data,
+            16 + zlib.MAX_WBITS), plain.data)
+        # the compressed body is cached next to the page
+        etag = plain.headers['ETag'].strip('"')
+        self.assertEquals(monomotapa.views.page_cache.get((etag, 'gzip')),
+                static_page.data)
+        self.assertEquals(static_page.headers['ETag'], 'W/"%s"' % etag)
+
+    def test_compressed_page_304(self):
+        etag = self.app.get('/' + self.route,
+                headers={'Accept-Encoding' : 'gzip'}).headers['ETag']
+        static_page = self.app.get('/' + self.route,
+                headers={'Accept-Encoding' : 'gzip', 'If-None-Match' : etag})
+        self.assertEquals(static_page.status_code, 304)
+
+    def test_compression_min_size(self):
+        status = self.app.get('/unit-tests/status',
+                headers={'Accept-Encoding' : 'gzip'})
+        self.assertNotIn('Content-Encoding', status.headers)
+
+    def test_compress_stream(self):
+        chunks = monomotapa.compression.compress_stream(['abc', 'def'], 6)
+        self.assertEquals(zlib.decompress(''.join(chunks),
+            16 + zlib.MAX_WBITS), 'abcdef')
+
+    def test_static_page_streamed_compressed(self):
+        with open(self.tmpfile.name ,'w') as f:
+            f.write('---\n{"stream": true}\n---\n&aleph; test')
+        static_page = self.app.get('/' + self.route,
+                headers={'Accept-Encoding' : 'gzip'})
+        self.assertEquals(static_page.headers['Content-Encoding'], 'gzip')
+        self.assertIn('</html>', zlib.decompress(static_page.data,
+            16 + zlib.MAX_WBITS))
+
+    # Test file watcher
+
+    def watch_tempdir(self, use_inotify):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, 'test.md'), 'w') as f:
+            f.write('test')
+        watcher = monomotapa.watcher.Watcher(interval=0.05,
+                use_inotify=use_inotify)
+        watcher.watch(os.path.join(directory, 'src'), recursive=True)
+        watcher.watch(directory)
+        self.addCleanup(watcher.stop)
+        return directory, watcher
+
+    def wait_for_size(self, watcher, path, size):
+        """wait until watcher has seen path grow to size (truncating
+        and writing a file may be seen as two changes)"""
+        for _ in range(100):
+            signature = watcher.signature(path)
+            if signature and signature[1] == size:
+                return
+            time.sleep(0.05)
+
+    def check_watcher(self, use_inotify):
+        directory, watcher = self.watch_tempdir(use_inotify)
+        path = os.path.join(directory, 'test.md')
+        changed = threading.Event()
+        watcher.subscribe(lambda changed_path: changed_path == path
+                and changed.set())
+        watcher.start()
+        self.assertEquals(watcher.signature(path),
+                monomotapa.watcher.stat_signature(path))
+        self.assertEquals(watcher.generation_of(path), 1)
+        with open(path, 'w') as f:
+            f.write('changed test')
+        self.assertTrue(changed.wait(5))
+        self.wait_for_size(watcher, path, len('changed test'))
+        self.assertGreater(watcher.generation_of(path), 1)
+        self.assertEquals(watcher.signature(path)[1], len('changed test'))
+        changed.clear()
+        os.unlink(path)
+        self.assertTrue(changed.wait(5))
+        self.assertIsNone(watcher.signature(path))
+
+    def test_watcher_poll(self):
+        self.check_watcher(False)
+
+    def test_watcher_inotify(self):
+        if not monomotapa.watcher.inotify_available():
+            self.skipTest('inotify not available')
+        self.check_watcher(True)
+        
+    def test_watcher_update(self):
+        directory, watcher = self.watch_tempdir(False)
+        path = os.path.join(directory, 'test.md')
+        seen = []
+        watcher.subscribe(seen.append)
+        # not started, so the background thread can't see it first
+        watcher.update([path], initial=True)
+        self.assertEquals(watcher.update([path]), [])
+        with open(path, 'w') as f:
+            f.write('changed test')
+        self.assertEquals(watcher.update([path]), [path])
+        self.assertEquals(seen, [path])
+        self.assertEquals(watcher.generation_of(path), 2)
+        self.assertEquals(watcher.generation, 2)
+
+    def test_watcher_invalidates_views(self):
+        # set up as with watch_files on (see __init__.py)
+        watcher = monomotapa.watcher.Watcher(interval=0.05)
+        watcher.watch('monomotapa')
+        watcher.watch(os.path.join('monomotapa', 'src'), recursive=True)
+        watcher.watch(os.path.join('monomotapa', 'templates'),
+                recursive=True)
+        watcher.subscribe(monomotapa.views.invalidate)
+        path = os.path.join('monomotapa', 'src', self.filename)
+        self.addCleanup(setattr, monomotapa.views, 'watcher',
+                monomotapa.views.watcher)
+        monomotapa.views.watcher = watcher
+        watcher.start()
+        self.addCleanup(watcher.stop)
+        etag = self.app.get('/' + self.route).headers['ETag']
+        self.assertIn(path, monomotapa.views.file_digests)
+        text = 'changed by the watcher test'
+        with open(path, 'w') as f:
+            f.write(text)
+        self.wait_for_size(watcher, path, len(text))
+        self.assertNotIn(path, monomotapa.views.file_digests)
+        self.assertGreater(watcher.generation_of(path), 1)
+        static_page = self.app.get('/' + self.route,
+                headers={'If-None-Match' : etag})
+        self.assertEquals(static_page.status_code, 200)
+        self.assertIn('changed by the watcher test', static_page.data)
+
+    def test_invalidate(self):
+        path = os.path.normpath(self.tmpfile.name)
+        monomotapa.views.render_markdown(path)
+        self.assertIn(path, monomotapa.views.file_digests)
+        monomotapa.views.invalidate(path)
+        self.assertNotIn(path, monomotapa.views.file_digests)
+
+    # Test search
+
+    def search_index(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        srcdir = os.path.join(directory, 'src')
+        os.mkdir(srcdir)
+        for name, text in [('cats', 'cats cats cats and a dog'),
+                ('dogs', 'dogs and a cat'), ('birds', 'birds only')]:
+            with open(os.path.join(srcdir, name + '.md'), 'w') as f:
+                f.write(text)
+        index = monomotapa.frontmatter.FrontMatterIndex(srcdir)
+        index.scan()
+        pages = {'birds' : {'attributes' : {'summary' : 'about cats'}}}
+        return srcdir, monomotapa.search.SearchIndex(
+                os.path.join(directory, 'search.idx'), index, 
+                lambda: pages)
+
+    def test_search_ranking(self):
+        srcdir, index = self.search_index()
+        results = index.search('cats', 10)
+        self.assertEquals([document[0] for document, score in results],
+                ['cats', 'birds'])
+        self.assertEquals(index.search('dog', 10)[0][0][0], 'cats')
+        self.assertEquals(index.search('fish', 10), [])
+
+    def test_search_index_file(self):
+        srcdir, index = self.search_index()
+        index.update()
+        self.assertTrue(os.path.exists(index.path))
+        loaded = monomotapa.search.SearchIndex(index.path, index.index,
+                index.get_pages)
+        loaded.load()
+        self.assertIsNotNone(loaded.map)
+        self.assertEquals(loaded.search('birds', 10)[0][0][0], 'birds')
+        # the same in every process
+        self.assertEquals(loaded.key, index.key)
+
+    def test_search_index_incremental(self):
+        srcdir, index = self.search_index()
+        key = index.update().key
+        with open(os.path.join(srcdir, 'birds.md'), 'w') as f:
+            f.write('birds and fish, fish')
+        index.index.scan()
+        self.assertEquals(index.search('fish', 10)[0][0][0], 'birds')
+        self.assertEquals(len(index.deleted), 1)
+        self.assertEquals(len(index.search('birds', 10)), 1)
+        self.assertNotEquals(index.key, key)
+
+    def quiet_search_log(self):
+        self.addCleanup(setattr, monomotapa.search.log, 'disabled', False)
+        monomotapa.search.log.disabled = True
+
+    def test_search_index_unwritable(self):
+        self.quiet_search_log()
+        srcdir, index = self.search_index()
+        index.path = '/proc/nonexistent/search.idx'
+        self.assertEquals(index.search('birds', 10)[0][0][0], 'birds')
+        self.assertTrue(index.save_failed)
+        self.assertIsNone(index.map)
+        # not tried again on every update
+        with open(os.path.join(srcdir, 'birds.md'), 'w') as f:
+            f.write('birds and fish')
+        index.index.scan()
+        index.save = lambda: self.fail('saved again')
+        self.assertEquals(index.search('fish', 10)[0][0][0], 'birds')
+
+    def test_search_page_unwritable_index(self):
+        self.quiet_search_log()
+        index = monomotapa.views.search_index
+        self.addCleanup(index.__dict__.update, dict(vars(index)))
+        index.clear()
+        index.pages = None
+        index.path = '/proc/nonexistent/search.idx'
+        with open(self.tmpfile.name ,'w') as f:
+            f.write("findable words")
+        monomotapa.views.frontmatter_index.scan()
+        for _ in range(2):
+            search_page = self.app.get('/search?q=findable')
+            self.assertEquals(search_page.status_code, 200)
+            self.assertIn('<mark>findable</mark> words', search_page.data)
+
+    def test_search_page_new_result(self):
+        search_page = self.app.get('/search?q=findable')
+        self.assertNotIn('href="/%s"' % self.route, search_page.data)
+        with open(self.tmpfile.name ,'w') as f:
+            f.write("findable words")
+        monomotapa.views.frontmatter_index.scan()
+        search_page = self.app.get('/search?q=findable',
+                headers={'If-Modified-Since' :
+                    search_page.headers['Last-Modified']})
+        self.assertEquals(search_page.status_code, 200)
+        self.assertIn('href="/%s"' % self.route, search_page.data)
+
+    def test_search_snippet(self):
+        text, matches = monomotapa.search.snippet('a *cat* sat', 
+                set(['cat']))
+        self.assertEquals(text, 'a cat sat')
+        self.assertEquals(matches, [(2, 5)])
+
+    def test_search_page(self):
+        with open(self.tmpfile.name ,'w') as f:
+            f.write("findable words")
+        monomotapa.views.frontmatter_index.scan()
+        search_page = self.app.get('/search?q=findable')
+        self.assertEquals(search_page.status_code, 200)
+        self.assertIn('<mark>findable</mark> words', search_page.data)
+        self.assertIn('href="/%s"' % self.route, search_page.data)
+
+    # Test route index
+
+    def test_route_index(self):
+        route_index = monomotapa.views.route_index
+        self.assertTrue(route_index.exists(self.route))
+        self.assertTrue(route_index.exists('index'))
+        self.assertFalse(route_index.exists('wp-login.php'))
+        self.assertIn('wp-login.php', route_index.missing)
+
+    def test_not_found_rendered_once(self):
+        first = self.app.get('/.env')
+        html = monomotapa.views.not_found_cache['html'][4]
+        second = self.app.get('/wp-login.php')
+        self.assertEquals(second.status_code, 404)
+        self.assertIs(monomotapa.views.not_found_cache['html'][4], html)
+        self.assertEquals(first.data, second.data)
+        self.assertIn('Page Not Found', second.data)
+
+    # Test startup
+
+    def test_pygments_imported_lazily(self):
+        code = 'import sys, monomotapa; print("pygments" in sys.modules)'
+        output = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEquals(output.strip(), 'False')
+
+    def test_preload(self):
+        rendered = monomotapa.views.preload()
+        self.assertIn('index', rendered)
+        self.assertIn(self.route, rendered)
+        page_cache = monomotapa.views.page_cache
+        hits = page_cache.hits
+        self.app.get('/' + self.route)
+        self.assertEquals(page_cache.hits, hits + 1)
+
+    # Test event loop server
+
+    def start_server(self, workers=2):
+        server = monomotapa.server.Server(monomotapa.app,
+                ('127.0.0.1', 0), workers)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.stop)
+        return server
+
+    def test_server_keep_alive(self):
+        server = self.start_server()
+        connection = httplib.HTTPConnection(*server.server_address)
+        connection.request('GET', '/')
+        response = connection.getresponse()
+        self.assertEquals(response.status, 200)
+        self.assertIn('Monomotapa', response.read())
+        sock = connection.sock
+        connection.request('GET', '/no-such-page')
+        response = connection.getresponse()
+        self.assertEquals(response.status, 404)
+        response.read()
+        self.assertIs(connection.sock, sock)
+        connection.close()
+
+    def test_server_slow_client(self):
+        server = self.start_server(workers=1)
+        slow = socket.create_connection(server.server_address)
+        self.addCleanup(slow.close)
+        slow.sendall('GET /%s HTTP/1.1\r\nHost: localhost\r\n'
+                % self.route)
+        # the only worker isn't waiting for the slow client
+        connection = httplib.HTTPConnection(*server.server_address,
+                timeout=5)
+        connection.request('GET', '/')
+        self.assertEquals(connection.getresponse().status, 200)
+        connection.close()
+        slow.sendall('Connection: close\r\n\r\n')
+        response = httplib.HTTPResponse(slow)
+        response.begin()
+        self.assertEquals(response.status, 200)
+
+    def test_server_bad_request(self):
+        server = self.start_server()
+        sock = socket.create_connection(server.server_address)
+        self.addCleanup(sock.close)
+        sock.sendall('nonsense\r\n\r\n')
+        response = httplib.HTTPResponse(sock)
+        response.begin()
+        self.assertEquals(response.status, 400)
+        response.read()
+        self.assertEquals(sock.recv(10), '')
+
+    def test_server_ambiguous_length(self):
+        body_length = monomotapa.server.body_length
+        self.assertEquals(body_length([('Content-Length', '5')]), 5)
+        for headers, status in [
+                ([('Transfer-Encoding', 'chunked')], '501'),
+                ([('Content-Length', '5'), ('Transfer-Encoding', 'chunked')],
+                    '400'),
+                ([('Content-Length', '5'), ('content-length', '5')], '400'),
+                ([('Content-Length', '-5')], '400'),
+                ([('Content-Length', '5x')], '400')]:
+            with self.assertRaises(monomotapa.server.BadRequest) as raised:
+                body_length(headers)
+            self.assertTrue(raised.exception.args[0].startswith(status))
+
+    def test_server_no_smuggling(self):
+        server = self.start_server()
+        sock = socket.create_connection(server.server_address)
+        self.addCleanup(sock.close)
+        sock.sendall('POST / HTTP/1.1\r\nHost: a\r\nContent-Length: 5\r\n'
+                'Transfer-Encoding: chunked\r\n\r\n0\r\n\r\n'
+                'GET /colophon HTTP/1.1\r\nHost: a\r\n\r\n')
+        response = httplib.HTTPResponse(sock)
+        response.begin()
+        self.assertEquals(response.status, 400)
+        response.read()
+        self.assertEquals(sock.recv(10), '')
+
 if __name__ == '__main__':
     unittest.main()